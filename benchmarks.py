@@ -0,0 +1,246 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
+import argparse
+import glob
+import json
+import resource
+import shutil
+import socket
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import data_generators
+import utility
+
+"""
+    Benchmarks to choose data pipeline settings for a host. Benchmark specific arguments are passed first,
+        all remaining arguments are the usual train.py arguments
+
+    Example of how to use
+        Compare the on-disk size against the read throughput of each dataset cache compression, using 50 training batches
+        python3 benchmarks.py cache -bb 50 -bdir "/local_scratch/bench" -mn "TRUNET" -ctsm "1979_1982_1983" -mts "{'location':['London']}" -dd "./Data" -bs 16
+
+        Compare the step time and peak memory of training with and without XLA on the CPU, over 20 steps
+        python3 benchmarks.py xla -bb 20 -mn "HCGRU" -ctsm "1979_1982_1983" -mts "{'location':['London']}" -dd "./Data" -bs 16
+
+        Compare the step time and peak memory of each precision policy on the CPU
+        python3 benchmarks.py precision -bb 20 -mn "HCGRU" ...
+
+        Compare the step time and peak memory of each gradient checkpointing mode, with the memory saved against no recomputation
+        python3 benchmarks.py recompute -bb 20 -mn "TRUNET" -bs 32 ...
+
+        Time the training step with the current arguments only
+        python3 benchmarks.py step -bb 20 -xla True -mn "UNET" ...
+
+    Reports are saved to './Output/benchmarks/{benchmark}_{hostname}.csv'
+"""
+
+def benchmark_cache(t_params, m_params, bench_batches, bench_dir, read_passes=3):
+    """Caches the same training batches with each cache compression, and with the RAM tier,
+        then times repeated reads from the cache
+
+        Args:
+            t_params (dict): params for training
+            m_params (dict): params for model
+            bench_batches (int): number of batches to cache
+            bench_dir (str): directory for the on-disk caches, should be on the disk that will hold the cache
+            read_passes (int, optional): number of passes over the cached batches to time. Defaults to 3.
+
+        Returns:
+            pd.DataFrame: Size on disk, write time and read throughput for each cache setting
+    """
+    era5_eobs = data_generators.Era5_Eobs( t_params, m_params )
+    ds, _ = era5_eobs.load_data_era5eobs( bench_batches, t_params['start_date'], t_params['parallel_calls'],
+                                            window_dates=t_params.get('train_window_dates', None) )
+    ds = ds.take(bench_batches)
+
+    element = next(iter(ds))
+    element_mb = data_generators.element_nbytes( element ) / 2**20
+    element_shapes = [ tensor.shape.as_list() for tensor in element ]
+
+    li_records = []
+    for compression in ['ram'] + list(data_generators.CACHE_COMPRESSIONS.keys()):
+        fp_cache = os.path.join( bench_dir, "bench_cache" )
+        _remove_cache(fp_cache)
+
+        if compression == 'ram':
+            ds_cached, _ = data_generators.cache_dataset( lambda first_batch, batch_count: ds.skip(first_batch).take(batch_count), fp_cache, bench_batches, 
+                                                            memory_budget_mb=bench_batches*element_mb + 1, element_shapes=element_shapes )
+        else:
+            ds_cached, _ = data_generators.cache_dataset( lambda first_batch, batch_count: ds.skip(first_batch).take(batch_count), fp_cache, bench_batches, compression )
+
+        # First pass decodes the source data and writes the cache
+        start_time = time.time()
+        batch_count = sum( 1 for _ in ds_cached )
+        write_time = time.time() - start_time
+
+        start_time = time.time()
+        for _ in range(read_passes):
+            for _ in ds_cached:
+                pass
+        read_time = (time.time() - start_time)/read_passes
+
+        size_mb = 0 if compression == 'ram' else _path_size(fp_cache) / 2**20
+
+        li_records.append( { 'Cache':compression, 'Batches':batch_count, 'Size_MB':size_mb, 'Size_Ratio':size_mb/(batch_count*element_mb),
+                                'Write_s':write_time, 'Read_Batches_per_s':batch_count/read_time, 'Read_MB_per_s':batch_count*element_mb/read_time } )
+        print("{}: {:.1f} MB on disk, {:.1f} batches/s".format(compression, size_mb, batch_count/read_time))
+
+        _remove_cache(fp_cache)
+
+    return pd.DataFrame(li_records)
+
+def benchmark_step(t_params, m_params, bench_batches, warmup_batches=3):
+    """Times the training step on synthetic batches, using the current training arguments.
+        No data is read, so only the model's compute is measured. Also run by train.py --benchmark
+
+        Args:
+            t_params (dict): params for training
+            m_params (dict): params for model
+            bench_batches (int): number of timed steps
+            warmup_batches (int, optional): untimed steps after the first (compiling) step. Defaults to 3.
+
+        Returns:
+            pd.DataFrame: compile and warm-up times, step time, throughput and peak memory
+    """
+    # train is only imported by the benchmarks that build the model
+    import train
+    import tensorflow as tf
+    import custom_losses as cl
+
+    weather_model = train.WeatherModel( t_params, m_params )
+    weather_model.initialize_model()
+    bounds = cl.central_region_bounds( m_params['region_grid_params'] )
+
+    feature_shape, target_shape, mask_shape = weather_model.static_shapes()
+    feature = tf.random.normal( feature_shape, dtype=tf.keras.backend.floatx() )
+    target = tf.random.gamma( target_shape, alpha=0.5, dtype=tf.float32 )
+    mask = tf.random.uniform( mask_shape ) > 0.2
+
+    # the batch is distributed as in training, so that it matches the input signature of the training step
+    feature, target, mask = next( iter( weather_model.distribute_dataset( lambda: tf.data.Dataset.from_tensors( (feature, target, mask) ) ) ) )
+    
+    # with gradient accumulation, the optimizer update of every grad_accum-th step is part of the step's time
+    weather_model.accum_start_batch = 0
+    def train_step(batch):
+        weather_model.distributed_train_step( feature, target, mask, bounds, 0.0 )
+        weather_model.apply_accumulated_gradients( batch, np.inf )
+        weather_model.loss_agg_batch.result().numpy()  # waiting for the step to complete
+
+    start_time = time.time()
+    train_step(1)
+    compile_time = time.time() - start_time
+
+    start_time = time.time()
+    for batch in range(2, 2+warmup_batches):
+        train_step(batch)
+    warmup_time = time.time() - start_time
+    
+    li_step_times = []
+    for batch in range(2+warmup_batches, 2+warmup_batches+bench_batches):
+        start_time = time.time()
+        train_step(batch)
+        li_step_times.append( time.time() - start_time )
+    
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 #ru_maxrss is in KB on linux
+
+    return pd.DataFrame( [ { 'Model':m_params['model_name'], 'XLA':t_params.get('xla', False), 'Precision':t_params.get('precision', 'mixed_float16'), 'Recompute':t_params.get('recompute', 'none'), 
+                                'Batch_Size':t_params['batch_size'], 'Grad_Accum':weather_model.grad_accum, 'Replicas':weather_model.strategy.num_replicas_in_sync,
+                                'Intra_Op_Threads':t_params.get('intra_op_threads', 0), 'Inter_Op_Threads':t_params.get('inter_op_threads', 0),
+                                'Compile_s':compile_time, 'Warmup_s':warmup_time, 'Step_ms':1000*np.mean(li_step_times), 'Step_ms_std':1000*np.std(li_step_times), 
+                                'Examples_per_s':t_params['batch_size']/np.mean(li_step_times), 'Peak_RSS_MB':peak_rss_mb } ] )
+
+def compare_steps(bench_batches, train_args, arg_name, li_values):
+    """Runs the step benchmark on the CPU once for each value of a training argument. Each run is in a separate process, 
+        so that the peak memory of one run does not hide another's
+
+        Args:
+            bench_batches (int): number of timed steps
+            train_args (list): training arguments
+            arg_name (str): long name of the training argument to vary, e.g. 'xla'
+            li_values (list): values of the argument
+
+        Returns:
+            pd.DataFrame: one row per run of benchmark_step
+    """
+    env = dict(os.environ)
+    env['CUDA_VISIBLE_DEVICES'] = ""
+
+    li_dfs = []
+    for value in li_values:
+        cmd = [ sys.executable, os.path.realpath(__file__), 'step', '-bb', str(bench_batches) ] + train_args + [ '--'+arg_name, str(value) ]
+        result, returncode = utility.run_for_result( cmd, env )
+        if result == None:
+            raise RuntimeError("Step benchmark with {}={} failed with exit code {}".format(arg_name, value, returncode))
+        
+        li_dfs.append( pd.DataFrame( result ) )
+        print("{}={}: {:.1f} ms per step".format( arg_name, value, li_dfs[-1]['Step_ms'].iloc[0] ))
+
+    return pd.concat( li_dfs, ignore_index=True )
+
+def _path_size(fp_prefix):
+    """Returns the size in bytes of all files and directories starting with fp_prefix"""
+    size = 0
+    for path in glob.glob( fp_prefix+"*" ):
+        if os.path.isdir(path):
+            size += sum( os.path.getsize(os.path.join(root, fn)) for root, _, fns in os.walk(path) for fn in fns )
+        else:
+            size += os.path.getsize(path)
+    return size
+
+def _remove_cache(fp_prefix):
+    for path in glob.glob( fp_prefix+"*" ):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+if __name__ == "__main__":
+    s_dir = utility.get_script_directory(sys.argv[0])
+
+    parser = argparse.ArgumentParser(description="Receive benchmark params, remaining params are passed to utility.parse_arguments", allow_abbrev=False)
+
+    parser.add_argument('benchmark', type=str, choices=['cache','step','xla','precision','recompute'])
+
+    parser.add_argument('-bb','--bench_batches', type=int, required=False, default=50, help="number of batches to benchmark on")
+
+    parser.add_argument('-bdir','--bench_dir', type=str, required=False, default="./Data/data_cache/bench", help="directory for on-disk caches")
+
+    parser.add_argument('-brp','--bench_read_passes', type=int, required=False, default=3, help="number of timed passes over the cached batches")
+
+    bench_args, remaining_args = parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining_args
+    args_dict = utility.parse_arguments(s_dir)
+
+    t_params, m_params = utility.load_params(args_dict)
+
+    if bench_args.benchmark == 'cache':
+        os.makedirs( bench_args.bench_dir, exist_ok=True )
+        df_report = benchmark_cache( t_params, m_params, bench_args.bench_batches, bench_args.bench_dir, bench_args.bench_read_passes )
+    
+    elif bench_args.benchmark == 'step':
+        df_report = benchmark_step( t_params, m_params, bench_args.bench_batches )
+        utility.print_subprocess_result( json.loads( df_report.to_json(orient='records') ) )
+
+    elif bench_args.benchmark == 'xla':
+        df_report = compare_steps( bench_args.bench_batches, remaining_args, 'xla', [False, True] )
+
+    elif bench_args.benchmark == 'precision':
+        df_report = compare_steps( bench_args.bench_batches, remaining_args, 'precision', utility.PRECISIONS )
+
+    elif bench_args.benchmark == 'recompute':
+        df_report = compare_steps( bench_args.bench_batches, remaining_args, 'recompute', ['none','layer','step'] )
+        df_report['Memory_Saved_MB'] = df_report['Peak_RSS_MB'].iloc[0] - df_report['Peak_RSS_MB']
+
+    f_dir = os.path.join( t_params['output_dir'], "benchmarks" )
+    os.makedirs( f_dir, exist_ok=True )
+    fp_report = os.path.join( f_dir, "{}_{}.csv".format(bench_args.benchmark, socket.gethostname()) )
+    df_report.to_csv( fp_report, index=False )
+
+    print(df_report.to_string(index=False))
+    print("Report saved to {}".format(fp_report))
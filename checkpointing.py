@@ -0,0 +1,233 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+import tensorflow as tf
+
+# The background writer uses TensorFlow's internal saving modules, whose interfaces are those of TF 2.3.
+    # Other versions save synchronously with tf.train.CheckpointManager
+ASYNC_TF_VERSION = "2.3."
+if tf.__version__.startswith(ASYNC_TF_VERSION):
+    from tensorflow.python.training.saving import functional_saver, saveable_object
+    from tensorflow.python.training.tracking import base as trackable_base
+    from tensorflow.python.training.tracking import graph_view
+
+"""
+    Asynchronous checkpoint saving. On save, the training thread only copies the checkpoint's variables to host memory,
+        and a background thread serializes the copies to file, so training continues while the checkpoint is written
+
+    Example of how to use
+        ckpt = tf.train.Checkpoint(model=model, optimizer=optimizer)
+        ckpt_mngr = AsyncCheckpointer( ckpt, "checkpoints/modelcode/epoch", max_to_keep=5 )
+        ckpt_path = ckpt_mngr.save()          # returns immediately, the path is written in the background
+        ckpt_mngr.after_written( fn )         # fn is called from the writer thread once the earlier saves are written
+        ckpt_mngr.close()                     # waits for all pending saves
+
+    The records shared by train.py and the sidecar evaluator (evaluator.py) are also kept here
+        checkpoints/{modelcode}/candidates/             : the trainer's checkpoint of each epoch, removed once evaluated
+        checkpoints/{modelcode}/candidates/epochs.jsonl : one record per saved candidate, a {"resumed_at_epoch":epoch} record
+                                                            when training resumes, and a final {"finished":true}
+        checkpoints/{modelcode}/evaluator_state.json    : the evaluator's progress and its early stopping decision
+
+    With TensorFlow versions other than 2.3, saves are made synchronously by a tf.train.CheckpointManager, with the same interface.
+    Checkpoints are written in the format of tf.train.Checkpoint, and are restored as usual with ckpt.restore(path).
+        Saves are written in the order they are made, and the directory's 'checkpoint' state file only
+        lists a checkpoint once its files are complete. At most max_pending snapshots wait to be written,
+        a further save blocks the training thread until the oldest is written, which bounds the host memory of the snapshots
+"""
+
+class AsyncCheckpointer():
+    """Saves a tf.train.Checkpoint from a background thread, with the interface of tf.train.CheckpointManager used in train.py
+    """
+
+    def __init__(self, checkpoint, directory, max_to_keep=5, max_pending=1):
+        """
+            Args:
+                checkpoint (tf.train.Checkpoint): checkpoint to save
+                directory (str): directory of the checkpoints and the 'checkpoint' state file
+                max_to_keep (int, optional): number of most recent checkpoints to keep, None to keep all. Defaults to 5.
+                max_pending (int, optional): number of enqueued saves and callbacks not yet written, before save blocks. Defaults to 1.
+        """
+        self.checkpoint = checkpoint
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+        self.prefix = os.path.join( directory, "ckpt" )
+
+        # continuing the records of checkpoints saved by an earlier job
+        ckpt_state = tf.train.get_checkpoint_state( directory )
+        self.li_saved = list( ckpt_state.all_model_checkpoint_paths ) if ckpt_state != None else []
+        self._latest_checkpoint = ckpt_state.model_checkpoint_path if ckpt_state != None else None
+
+        self.error = None
+        self.synchronous = not tf.__version__.startswith(ASYNC_TF_VERSION)
+        if self.synchronous:
+            self.manager = tf.train.CheckpointManager( checkpoint, directory, max_to_keep=max_to_keep )
+            return
+
+        self.queue = queue.Queue( maxsize=max_pending )
+        self.thread = threading.Thread(target=self._run, name="AsyncCheckpointer", daemon=True)
+        self.thread.start()
+        atexit.register( self.close )
+
+    @property
+    def latest_checkpoint(self):
+        """Path of the most recent completely written checkpoint, None if there is none"""
+        if self.synchronous:
+            return self.manager.latest_checkpoint
+        return self._latest_checkpoint
+
+    # region --- training thread methods
+    def save(self, checkpoint_number=None):
+        """Snapshots the checkpoint's variables and enqueues the snapshot to be written
+
+            Args:
+                checkpoint_number (int, optional): number of the checkpoint's path. Defaults to None, the checkpoint's save_counter is incremented and used.
+
+            Returns:
+                str: path of the checkpoint, readable once it is written
+        """
+        self._raise_error()
+        if self.synchronous:
+            return self.manager.save( checkpoint_number=checkpoint_number )
+
+        if checkpoint_number == None:
+            checkpoint_number = int( self.checkpoint.save_counter.assign_add(1) )
+        save_path = "{}-{}".format( self.prefix, checkpoint_number )
+
+        self.queue.put( (save_path, self._snapshot()) )
+        return save_path
+
+    def after_written(self, fn):
+        """Enqueues fn to be called from the writer thread, once all earlier saves are written.
+            fn is not called if an earlier save failed
+
+            Args:
+                fn (function): function without arguments, e.g. writing records that refer to the saved checkpoints
+        """
+        self._raise_error()
+        if self.synchronous:
+            fn()
+            return
+        self.queue.put( fn )
+
+    def flush(self):
+        """Blocks until all enqueued checkpoints are written"""
+        if self.synchronous:
+            return
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Writes all enqueued checkpoints and stops the writer thread"""
+        if self.synchronous:
+            return
+        if self.thread.is_alive():
+            self.queue.put( None )
+            self.thread.join()
+        self._raise_error()
+
+    def _snapshot(self):
+        """Returns the checkpoint's saveable objects, with each value copied to host memory"""
+        named_saveables, graph_proto, _ = graph_view.ObjectGraphView( self.checkpoint ).serialize_object_graph()
+
+        li_snapshot = []
+        with tf.device("/cpu:0"):
+            for saveable in named_saveables:
+                specs = [ saveable_object.SaveSpec( self._host_copy(spec.tensor), spec.slice_spec, spec.name, dtype=spec.dtype, device="/cpu:0" )
+                            for spec in saveable.specs ]
+                li_snapshot.append( saveable_object.SaveableObject( None, specs, saveable.name ) )
+
+            li_snapshot.append( trackable_base.NoRestoreSaveable( tensor=tf.constant( graph_proto.SerializeToString(), dtype=tf.string ),
+                                                                    name=trackable_base.OBJECT_GRAPH_PROTO_KEY ) )
+        return li_snapshot
+
+    def _host_copy(self, tensor):
+        """Returns a copy of a value in host memory. The value is read on its variable's device, and the copy is placed on the CPU"""
+        with tf.device("/cpu:0"):
+            return tf.identity(tensor)
+
+    def _raise_error(self):
+        if self.error != None:
+            error, self.error = self.error, None
+            raise RuntimeError("AsyncCheckpointer: a checkpoint save failed") from error
+    # endregion
+
+    # region --- writer thread methods
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record == None:
+                self.queue.task_done()
+                break
+
+            try:
+                if callable(record):
+                    if self.error == None:
+                        record()
+                else:
+                    save_path, li_snapshot = record
+                    self._write(save_path, li_snapshot)
+            except Exception as e:
+                print("AsyncCheckpointer: failed to write {}: {}".format(save_path if not callable(record) else record, e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, save_path, li_snapshot):
+        start_time = time.time()
+        functional_saver.MultiDeviceSaver( li_snapshot ).save( save_path )
+
+        # the state file is updated after the checkpoint's files are complete
+        if save_path in self.li_saved:
+            self.li_saved.remove(save_path)
+        self.li_saved.append( save_path )
+
+        if self.max_to_keep != None:
+            for old_path in self.li_saved[:-self.max_to_keep]:
+                tf.compat.v1.train.remove_checkpoint( old_path )
+            self.li_saved = self.li_saved[-self.max_to_keep:]
+        else:
+            # checkpoints removed by another process, i.e. candidates removed by the sidecar evaluator
+            self.li_saved = [ path for path in self.li_saved if tf.io.gfile.exists( path+".index" ) or path == save_path ]
+
+        tf.compat.v1.train.update_checkpoint_state( self.directory, save_path, all_model_checkpoint_paths=self.li_saved )
+        self._latest_checkpoint = save_path
+
+        print("AsyncCheckpointer: saved {} in {:.1f}s".format(save_path, time.time()-start_time))
+    # endregion
+
+# region --- sidecar evaluation records
+SIDECAR_CANDIDATES_DIR = "candidates"
+SIDECAR_MANIFEST_FN = "epochs.jsonl"
+SIDECAR_STATE_FN = "evaluator_state.json"
+
+def append_jsonl(fp, record):
+    """Appends a record as one line of json"""
+    with open(fp, "a") as f:
+        f.write( json.dumps(record) + "\n" )
+
+def read_jsonl(fp):
+    """Returns the complete records of a json lines file, [] if there is no file"""
+    if not os.path.exists(fp):
+        return []
+    with open(fp, "r") as f:
+        # a last line without a newline may still be being written
+        return [ json.loads(line) for line in f.readlines() if line.endswith("\n") ]
+
+def read_json(fp, default):
+    """Returns the contents of a json file, or default if there is no file"""
+    if not os.path.exists(fp):
+        return default
+    with open(fp, "r") as f:
+        return json.load(f)
+
+def write_json(fp, record):
+    """Writes a json file, replacing it in one step so that readers never see a partial file"""
+    fp_tmp = fp + ".{}.tmp".format(os.getpid())
+    with open(fp_tmp, "w") as f:
+        json.dump(record, f)
+    os.replace(fp_tmp, fp)
+# endregion
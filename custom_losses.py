@@ -27,12 +27,71 @@ def mse( obs, preds, count=None):
 
     return mse
 
-def rNmse(obs, preds , N):
-    rN_mask = tf.where( obs >= N, True, False )
+def masked_mse( obs, preds, mask ):
+    """Calculates MSE over the points where mask is True.
+        Masked out points are given zero weight, so unlike tf.boolean_mask the tensor shapes stay static
 
-    mse =tf.keras.metrics.MSE( tf.boolean_mask( obs, rN_mask), tf.boolean_mask(preds, rN_mask)  )    
+    Args:
+        obs (tensor): True values
+        preds (tensor): Predicted values
+        mask (tensor): bool, True for points to include. Or float32 per point weights, e.g. importance sampling weights
 
-    return mse
+    Returns:
+        mse (float32): mean squared error value, equal to mse(boolean_mask(obs, mask), boolean_mask(preds, mask)). 0.0 if no points are unmasked.
+            With weights, the weighted sum of squared errors is divided by the number of points with a non zero weight, not by the
+            sum of the weights, so that importance weights are not normalised away within each batch
+    """
+    weights = tf.cast( mask, tf.float32 )
+    sq_err = tf.square( tf.cast(obs, tf.float32) - tf.cast(preds, tf.float32) )
+    return tf.reduce_sum( sq_err*weights ) / tf.maximum( tf.reduce_sum( tf.cast(weights > 0.0, tf.float32) ), 1.0 )
+
+def masked_bce( labels, probs, mask ):
+    """Calculates binary cross entropy over the points where mask is True, with static tensor shapes
+
+    Args:
+        labels (tensor): True labels, 1.0 or 0.0
+        probs (tensor): Predicted probabilities
+        mask (tensor): bool, True for points to include. Or float32 per point weights, see masked_mse
+
+    Returns:
+        bce (float32): mean binary cross entropy
+    """
+    weights = tf.cast( mask, tf.float32 )
+    bce = tf.keras.backend.binary_crossentropy( tf.cast(labels, tf.float32), tf.cast(probs, tf.float32), from_logits=False )
+    return tf.reduce_sum( bce*weights ) / tf.maximum( tf.reduce_sum( tf.cast(weights > 0.0, tf.float32) ), 1.0 )
+
+def masked_cond_rain_mse( obs, vals, probs, mask, threshold=0.5 ):
+    """Calculates the MSE of the conditional rain predictions, see cond_rain, over the points where mask is True
+
+    Args:
+        obs (tensor): True values
+        vals (tensor): Predicted conditional values
+        probs (tensor): Predicted probabilities of rain
+        mask (tensor): bool, True for points to include
+        threshold (float, optional): predicted values are set to 0 where probs is at or below threshold. Defaults to 0.5.
+
+    Returns:
+        mse (float32): mean squared error value
+    """
+    return masked_mse( obs, cond_rain(vals, probs, threshold), mask )
+
+def masked_rNmse( obs, preds, mask, N ):
+    """Calculates the MSE over the points where mask is True and the true value is at least N, with static tensor shapes
+
+    Args:
+        obs (tensor): True values
+        preds (tensor): Predicted values
+        mask (tensor): bool, True for points to include. Or float32 per point weights
+        N (float): minimum true value for a point to be included
+
+    Returns:
+        mse (float32): mean squared error value
+    """
+    return masked_mse( obs, preds, tf.cast( mask, tf.float32 ) * tf.cast( obs >= N, tf.float32 ) )
+
+def rNmse(obs, preds , N):
+    """Calculates the MSE over the points where the true value is at least N, see masked_rNmse"""
+    return masked_rNmse( obs, preds, tf.ones_like( obs, dtype=tf.bool ), N )
 
 def cond_rain(vals, probs, threshold=0.5):
     """
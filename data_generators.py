@@ -8,6 +8,7 @@ import json
 import os
 import pickle
 
+import shared_cache
 import utility
 
 import xarray as xr
@@ -33,18 +34,24 @@ class Generator():
             datum = next(iter(grib_gen))
     """
     
-    def __init__(self, fp, all_at_once=False):
+    cache_block_len = 256   # frames per block in the shared frame cache
+    cache_tag = ""          # describes the decoding, part of the shared frame cache key
+
+    def __init__(self, fp, all_at_once=False, frame_cache=None):
         """Extendable Class handling the generation of model field and rain data
             from E-Obs and ERA5 datasets
 
         Args:
             fp (str): Filepath of netCDF4 file containing data.
             all_at_once (bool, optional): Whether or not to load all the data in RAM or not. Defaults to False.
+            frame_cache (shared_cache.FrameCache, optional): host-wide cache of decoded frames to consult before reading fp. Defaults to None.
             
         """        
         self.generator = None
         self.all_at_once = all_at_once
         self.fp = fp
+        self.spans = None   # optional list of (start_idx, end_idx) time spans to read, set via set_spans
+        self.frame_cache = frame_cache
         self.city_latlon = {
             "London": [51.5074, -0.1278],
             "Cardiff": [51.4816 + 0.15, -3.1791 -0.05], #1st Rainiest
@@ -88,6 +95,58 @@ class Generator():
     def yield_iter(self):
         pass
     
+    def set_spans(self, spans):
+        """Restricts the generator to only read the given time spans
+
+            Args:
+                spans (list): list of (start_idx, end_idx) pairs, in time steps of the underlying file.
+                    Pass None to read contiguously from start_idx
+        """        
+        self.spans = spans
+
+    def decode_frames(self, start_idx, end_idx, src=None):
+        pass
+
+    def read_frames(self, start_idx, end_idx, src=None):
+        """Returns the decoded frames between start_idx and end_idx. If a frame_cache is set, the frames are
+            assembled from cached blocks, and any missing block is decoded once and added to the cache
+
+            Args:
+                start_idx (int): first frame
+                end_idx (int): end frame (exclusive)
+                src (optional): open handle on fp, passed to decode_frames. Defaults to None.
+
+            Returns:
+                tuple: (data, mask) arrays with time as the first dimension
+        """
+        if self.frame_cache == None:
+            return self.decode_frames(start_idx, end_idx, src)
+
+        li_data, li_mask, li_keys = [], [], []
+        for block_idx in range( start_idx//self.cache_block_len, (end_idx-1)//self.cache_block_len + 1 ):
+            block_start = block_idx*self.cache_block_len
+            block_end = min( block_start + self.cache_block_len, self.data_len )
+            
+            key = self.frame_cache.key( self.fp, self.cache_tag, block_idx, self.cache_block_len )
+            block = self.frame_cache.get(key)
+            if block == None:
+                block = self.decode_frames(block_start, block_end, src)
+                self.frame_cache.put(key, *block)
+            else:
+                li_keys.append(key)
+
+            _slice = slice( max(start_idx, block_start) - block_start, min(end_idx, block_end) - block_start )
+            li_data.append( block[0][_slice] )
+            li_mask.append( block[1][_slice] )
+
+        data, mask = np.concatenate(li_data), np.concatenate(li_mask)
+        
+        # frames have been copied out of the cached blocks
+        for key in li_keys:
+            self.frame_cache.release(key)
+        
+        return data, mask
+    
     def __call__(self, ):
         if(self.all_at_once):
             return self.yield_all()
@@ -224,6 +283,9 @@ class Generator_rain(Generator):
         A python generator for the rain data
         
     """
+    cache_block_len = 64
+    cache_tag = "rr"
+
     def __init__(self, **generator_params ):
         super(Generator_rain, self).__init__(**generator_params)
         
@@ -237,10 +299,32 @@ class Generator_rain(Generator):
     def yield_iter(self):
         """ Return data in chunks"""
         ds = Dataset(self.fp, "r", format="NETCDF4", keepweakref=True)
-        for chunk in ds.variables['rr'][:]:
-            data = np.ma.getdata(chunk)
-            mask = np.logical_not( np.ma.getmask(chunk) )
-            yield data[ ::-1 , :], mask[::-1, :]
+        
+        if self.spans == None and self.frame_cache == None:
+            for chunk in ds.variables['rr'][:]:
+                data = np.ma.getdata(chunk)
+                mask = np.logical_not( np.ma.getmask(chunk) )
+                yield data[ ::-1 , :], mask[::-1, :]
+        
+        else:
+            # seeking directly to each selected span
+            spans = self.spans if self.spans != None else [ (0, self.data_len) ]
+            
+            for start_idx, end_idx in spans:
+                for idx in range(start_idx, end_idx, self.cache_block_len):
+                    data, mask = self.read_frames( idx, min(idx+self.cache_block_len, end_idx), ds )
+                    for frame_data, frame_mask in zip(data, mask):
+                        yield frame_data, frame_mask
+
+    def decode_frames(self, start_idx, end_idx, src=None):
+        """Returns the rain data and mask between start_idx and end_idx, aligned north to south"""
+        ds = src if src != None else Dataset(self.fp, "r", format="NETCDF4", keepweakref=True)
+        
+        _data = ds.variables['rr'][start_idx:end_idx]
+        data = np.ma.getdata(_data)
+        mask = np.logical_not( np.ma.getmaskarray(_data) )
+        
+        return np.ascontiguousarray(data[:, ::-1, :]), np.ascontiguousarray(mask[:, ::-1, :])
 
 
     def __call__(self):
@@ -262,6 +346,7 @@ class Generator_mf(Generator):
         self.seq_len = seq_len*25 if seq_len else 1400
         self.start_idx = 0
         self.end_idx =0 
+        self.cache_tag = "_".join(self.vars_for_feature)
         #self.ds = Dataset(self.fp, "r", format="NETCDF4")
 
 
@@ -279,26 +364,42 @@ class Generator_mf(Generator):
 
     def yield_iter(self):
         xr_gn = xr.open_dataset(self.fp, cache=False, decode_times=False, decode_cf=False)
+
+        spans = self.spans if self.spans != None else [ (self.start_idx, self.data_len) ]
         
-        idx = self.start_idx
+        for span_start, span_end in spans:
+            for data_mask in self.yield_span(xr_gn, span_start, min(span_end, self.data_len) ):
+                yield data_mask
+
+    def yield_span(self, xr_gn, span_start, span_end):
+        """Yields the data between span_start and span_end in chunks of seq_len"""        
+        idx = span_start
         
-        while idx < self.data_len:
+        while idx < span_end:
 
-            adj_seq_len = min(self.seq_len, self.data_len - idx )
+            adj_seq_len = min(self.seq_len, span_end - idx )
 
-            _slice = slice( idx , idx  + adj_seq_len)
-            next_marray = [ xr_gn[name].isel(time=_slice).to_masked_array(copy=True) for name in self.vars_for_feature ]
-            
-            list_datamask = [(np.ma.getdata(_mar), np.ma.getmask(_mar)) for _mar in next_marray]
-            
-            _data, _masks = list(zip(*list_datamask))
-            _masks = [ np.logical_not(_mask_val) for _mask_val in _masks] 
-            stacked_data = np.stack(_data, axis=-1)
-            stacked_masks = np.stack(_masks, axis=-1)
+            stacked_data, stacked_masks = self.read_frames( idx, idx + adj_seq_len, xr_gn )
 
             idx += adj_seq_len
             
-            yield stacked_data[ :, 1:-2, 2:-2, :], stacked_masks[ :, 1:-2 , 2:-2, :] #(100,140,6) 
+            yield stacked_data, stacked_masks #(100,140,6)
+
+    def decode_frames(self, start_idx, end_idx, src=None):
+        """Returns the stacked model fields and masks between start_idx and end_idx, cropped to the (100,140) grid"""
+        xr_gn = src if src is not None else xr.open_dataset(self.fp, cache=False, decode_times=False, decode_cf=False)
+
+        _slice = slice( start_idx , end_idx )
+        next_marray = [ xr_gn[name].isel(time=_slice).to_masked_array(copy=True) for name in self.vars_for_feature ]
+        
+        list_datamask = [(np.ma.getdata(_mar), np.ma.getmaskarray(_mar)) for _mar in next_marray]
+        
+        _data, _masks = list(zip(*list_datamask))
+        _masks = [ np.logical_not(_mask_val) for _mask_val in _masks] 
+        stacked_data = np.stack(_data, axis=-1)
+        stacked_masks = np.stack(_masks, axis=-1)
+
+        return np.ascontiguousarray(stacked_data[ :, 1:-2, 2:-2, :]), np.ascontiguousarray(stacked_masks[ :, 1:-2 , 2:-2, :]) 
 
 class Era5_Eobs():
 
@@ -314,13 +415,20 @@ class Era5_Eobs():
 
         data_dir = self.t_params['data_dir']
 
+        # Optional host-wide cache of decoded frames, shared with other jobs running on this host
+        t_settings = self.t_params.get('t_settings', {})
+        if t_settings.get('frame_cache_mb', 0) > 0:
+            frame_cache = shared_cache.FrameCache( t_settings['frame_cache_mb'], t_settings.get('frame_cache_dir', "/dev/shm/trunet_frame_cache") )
+        else:
+            frame_cache = None
+
         # Create python generator for rain data
         fp_rain = data_dir+"/" + self.t_params.get('rain_fn',"eobs_true_rainfall_197901-201907_uk.nc")
-        self.rain_data = Generator_rain(fp=fp_rain, all_at_once=False)
+        self.rain_data = Generator_rain(fp=fp_rain, all_at_once=False, frame_cache=frame_cache)
 
         # Create python generator for model field data 
         mf_fp = data_dir + "/" + self.t_params.get('mf_fn', "model_fields_linearly_interpolated_1979-2019.nc")
-        self.mf_data = Generator_mf(fp=mf_fp, vars_for_feature=self.t_params['vars_for_feature'], all_at_once=False, seq_len=self.t_params.get('lookback_feature',None) )
+        self.mf_data = Generator_mf(fp=mf_fp, vars_for_feature=self.t_params['vars_for_feature'], all_at_once=False, seq_len=self.t_params.get('lookback_feature',None), frame_cache=frame_cache )
 
         # Update information on the locations of interest to extract data from
         self.location_size_calc()
@@ -346,7 +454,7 @@ class Era5_Eobs():
         
             
 
-    def load_data_era5eobs(self, batch_count, start_date,_num_parallel_calls=-1, prefetch=-1):
+    def load_data_era5eobs(self, batch_count, start_date,_num_parallel_calls=-1, prefetch=-1, window_dates=None, loc_idxs=None):
         """Produces Tensorflow Datasets for the ERA5 and E-obs dataset
 
             Args:
@@ -355,6 +463,9 @@ class Era5_Eobs():
                 batch_count int: Number of batches to extract for evaluation
                 
                 _num_parallel_calls (int, optional): Number of parallel calls to use in tensorflow dataset loading operations. Defaults to -1.
+                window_dates (np.ndarray, optional): window index, start dates of the target windows to extract. 
+                    If passed, start_date is ignored and only the selected windows are read. Defaults to None.
+                loc_idxs (list, optional): indexes of the locations to extract, within li_loc. Defaults to None, all locations.
                 data_dir (str, optional): path of Data directory. Defaults to "./Data/Rain_Data_Nov19".
 
             Raises:
@@ -368,7 +479,17 @@ class Era5_Eobs():
         """    
         
         # Retreiving one index for each of the feature and target data. This index indicates the first value in the dataset to use
-        start_idx_feat, start_idx_tar = self.get_start_idx(start_date)
+        if window_dates is None:
+            start_idx_feat, start_idx_tar = self.get_start_idx(start_date)
+            self.mf_data.set_spans(None)
+            self.rain_data.set_spans(None)
+        else:
+            # Generators seek directly to the spans covered by the window index
+            li_spans_feat, li_spans_tar = self.get_spans(window_dates)
+            self.mf_data.set_spans(li_spans_feat)
+            self.rain_data.set_spans(li_spans_tar)
+            start_idx_feat, start_idx_tar = li_spans_feat[0][0], 0
+
         self.mf_data.start_idx = start_idx_feat
 
         
@@ -406,7 +527,7 @@ class Era5_Eobs():
         ds = tf.data.Dataset.zip( (ds_feat, ds_tar) ) #( model_fields, (rain, rain_mask) ) 
         
         #if self.time_sequential == True:
-        ds, idx_loc_in_region = self.location_extractor( ds, self.li_loc, batch_count  )
+        ds, idx_loc_in_region = self.location_extractor( ds, self.li_loc, batch_count, loc_idxs )
         ds = ds.prefetch(prefetch)
         return ds, idx_loc_in_region
         
@@ -415,6 +536,40 @@ class Era5_Eobs():
         #     ds = ds.prefetch(prefetch)
         #     return ds, None        
 
+    def load_batch_range(self, first_batch, batch_count, total_batch_count, start_date, _num_parallel_calls=-1, prefetch=-1, window_dates=None):
+        """Returns the batches [first_batch, first_batch+batch_count) of load_data_era5eobs( total_batch_count, start_date, window_dates=window_dates ),
+            reading only the windows of those batches. As there, the batches of each location follow each other
+
+            Args:
+                first_batch (int): first batch of the range
+                batch_count (int): number of batches in the range
+                total_batch_count (int): number of batches of the whole dataset, over all locations
+                start_date (np.datetime64): start date of the contiguous windows, used if window_dates is None
+                window_dates (np.ndarray, optional): window index of each location's batches. Defaults to None, contiguous windows from start_date.
+
+            Returns:
+                tf.data.Dataset: batches of the range
+        """
+        bs = self.t_params['batch_size']
+        batches_per_loc = int( total_batch_count/self.loc_count )
+        if window_dates is None:
+            window_dates = np.datetime64(start_date, 'D') + np.arange( batches_per_loc*bs )*self.t_params['window_shift']
+
+        ds_range = None
+        for loc_idx in range(self.loc_count):
+            start = max( first_batch - loc_idx*batches_per_loc, 0 )
+            end = min( first_batch + batch_count - loc_idx*batches_per_loc, batches_per_loc )
+            if end <= start:
+                continue
+
+            # each range has its own generators, since the generators hold the spans they read
+            era5_eobs = Era5_Eobs( self.t_params, self.m_params )
+            era5_eobs.location_size_calc( self.li_loc )
+            ds, _ = era5_eobs.load_data_era5eobs( end-start, None, _num_parallel_calls, prefetch, window_dates=window_dates[ start*bs:end*bs ], loc_idxs=[loc_idx] )
+            ds_range = ds if ds_range is None else ds_range.concatenate(ds)
+
+        return ds_range
+
     def get_start_idx(self, start_date):
         """ Returns two indexes
                 The first index is the idx at which to start extracting data from the feature dataset
@@ -436,6 +591,59 @@ class Era5_Eobs():
 
         return feat_start_idx, tar_start_idx
     
+    def get_spans(self, window_dates):
+        """ Converts a window index into the time spans to read from the feature and target datasets
+                Adjacent windows are merged into a single span, so each span is a whole number of windows
+
+            Args:
+                window_dates (np.ndarray): sorted start dates, np.datetime64[D], of the target windows
+            Returns:
+                tuple (list, list): spans (start_idx, end_idx) for the feature data, spans for the target data
+        """
+        window_len = self.t_params['window_shift']
+        window_dates = np.asarray(window_dates, dtype='datetime64[D]')
+        
+        # splitting the index wherever consecutive windows are not adjacent
+        bool_new_span = np.diff(window_dates).astype(int) != window_len
+        span_starts = np.concatenate( [ window_dates[:1], window_dates[1:][bool_new_span] ] )
+        span_ends = np.concatenate( [ window_dates[:-1][bool_new_span], window_dates[-1:] ] ) + window_len
+
+        li_spans_feat = [ ( np.timedelta64(s - self.t_params['feature_start_date'],'6h').astype(int),
+                            np.timedelta64(e - self.t_params['feature_start_date'],'6h').astype(int) ) for s, e in zip(span_starts, span_ends) ]
+        li_spans_tar = [ ( np.timedelta64(s - self.t_params['target_start_date'],'D').astype(int),
+                            np.timedelta64(e - self.t_params['target_start_date'],'D').astype(int) ) for s, e in zip(span_starts, span_ends) ]
+
+        return li_spans_feat, li_spans_tar
+
+    def shard_windows(self, window_dates, worker_idx, worker_count):
+        """ Returns a worker's shard of a window index. Shards are contiguous, to keep each worker's reads sequential,
+                and of equal length, so every worker runs the same number of steps
+
+            Args:
+                window_dates (np.ndarray): window index
+                worker_idx (int): index of worker
+                worker_count (int): number of workers
+            Returns:
+                np.ndarray: window index for the worker
+        """
+        shard_len = len(window_dates) // worker_count
+        return np.array_split( window_dates, worker_count )[worker_idx][:shard_len]
+
+    def stream_order(self, window_dates, batch_size):
+        """ Reorders a window index into batch_size contiguous streams, interleaved so that 
+                the i-th element of every batch holds consecutive windows of the i-th stream.
+                Used by stateful training, where each batch element carries its hidden state on to the next batch
+
+            Args:
+                window_dates (np.ndarray): window index, in date order
+                batch_size (int): number of streams
+            Returns:
+                np.ndarray: window index of length batch_size*(len(window_dates)//batch_size)
+        """
+        stream_len = len(window_dates) // batch_size
+        streams = np.reshape( window_dates[:stream_len*batch_size], [batch_size, stream_len] )
+        return np.reshape( np.transpose(streams), [-1] )
+
     def mask_rain(self, arr_rain, arr_mask):
         """Mask rain by applying fill_value to masked points
 
@@ -468,12 +676,13 @@ class Era5_Eobs():
         arr_data = tf.where( arr_mask, arr_data, self.t_params['mask_fill_value']['model_field'])
         return arr_data #(h,w,c)
 
-    def location_extractor(self, ds, locations, batch_count):
+    def location_extractor(self, ds, locations, batch_count, loc_idxs=None):
         """Extracts the temporal slice of patches corresponding to the locations of interest 
 
                 Args:
                     ds (tf.Data.dataset): dataset containing temporal slices of the regions surrounding the locations of interest
                     locations (list): list of locations (strings) to extract
+                    loc_idxs (list, optional): indexes of the locations to extract. Defaults to None, all locations
 
                 Returns:
                     tuple: (tf.data.Dataset, [int, int] ) tuple containing dataset and [h,w] of indexes of the central region
@@ -488,6 +697,9 @@ class Era5_Eobs():
         else:
             li_hw_idxs = [ self.rain_data.find_idx_of_loc_region( _loc, self.m_params['region_grid_params'] ) for _loc in locations ] #[ (h_idx,w_idx), ... ]
         
+        if loc_idxs != None:
+            li_hw_idxs = [ li_hw_idxs[idx] for idx in loc_idxs ]
+        
         # Creating seperate datasets for each location
         li_ds = [ ds.map( lambda mf, rain, rmask : self.select_region(mf, rain, rmask, _idx[0], _idx[1]), num_parallel_calls=-1) for _idx in li_hw_idxs ]
         
@@ -528,3 +740,182 @@ class Era5_Eobs():
             
         return tf.expand_dims(mf,axis=0), tf.expand_dims(rain,axis=0), tf.expand_dims(rain_mask,axis=0) #Note: expand_dim for unbatch/batch compatibility
 # endregion
+
+# region -- Caching
+CACHE_COMPRESSIONS = { "none":None, "zlib":"GZIP", "snappy":"SNAPPY" }
+
+def cache_dataset(ds_range_fn, fp_cache, batch_count, compression="none", memory_budget_mb=0, element_shapes=None):
+    """Caches a dataset after its pre-processing steps. Batches are held in RAM up to a memory budget,
+        the remainder is cached on local disk with the selected compression
+
+        Args:
+            ds_range_fn (function): ds_range_fn(first_batch, batch_count) returns the dataset's batches from first_batch,
+                reading only those batches, e.g. Era5_Eobs.load_batch_range. The RAM and disk tiers each read their own range
+            fp_cache (str): path prefix for the on-disk cache
+            batch_count (int): number of elements in ds
+            compression (str, optional): codec for the on-disk cache, one of "none", "zlib", "snappy". 
+                "none" uses the tf.data file cache, "zlib" and "snappy" write a tf.data snapshot 
+                compressed with GZIP or SNAPPY. Defaults to "none".
+            memory_budget_mb (int, optional): RAM available to this dataset's cache in MB. Defaults to 0.
+            element_shapes (list, optional): shape of each component of a batch, for the dimensions unknown in the dataset's element_spec. Defaults to None.
+
+        Returns:
+            tuple: (tf.data.Dataset, float) the cached dataset, and the MB of the memory budget it uses
+    """
+    if compression not in CACHE_COMPRESSIONS:
+        raise ValueError("Invalid cache compression: {}. Choose from {}".format(compression, list(CACHE_COMPRESSIONS.keys())))
+
+    # number of batches held in RAM. The batch size is computed from the element's shapes, so no batch is read
+    ds = ds_range_fn( 0, batch_count )
+    ram_batches = 0
+    element_mb = 0
+    if memory_budget_mb > 0 and batch_count > 0:
+        element_mb = element_spec_nbytes( ds.element_spec, element_shapes ) / 2**20
+        ram_batches = min( batch_count, int(memory_budget_mb // element_mb) )
+
+    if ram_batches == batch_count:
+        return ds.cache(), ram_batches*element_mb
+
+    # The disk tier holds a different set of batches for each RAM/disk split
+    if ram_batches > 0:
+        fp_cache = fp_cache + "_from{}".format(ram_batches)
+    
+    ds_disk = ds_range_fn( ram_batches, batch_count-ram_batches ) if ram_batches > 0 else ds
+    if compression == "none":
+        ds_disk = ds_disk.cache(fp_cache)
+    else:
+        ds_disk = ds_disk.apply( tf.data.experimental.snapshot( fp_cache+"_"+compression, compression=CACHE_COMPRESSIONS[compression] ) )
+
+    if ram_batches == 0:
+        return ds_disk, 0
+    
+    ds_ram = ds_range_fn( 0, ram_batches ).cache()
+    return ds_ram.concatenate(ds_disk), ram_batches*element_mb
+
+def batch_shapes(t_params, m_params):
+    """Returns the shapes of a (feature, target, mask) batch
+
+        Returns:
+            tuple: feature shape, target shape, mask shape
+    """
+    bs = t_params['batch_size']
+    h_w = m_params['region_grid_params']['outer_box_dims']
+
+    if m_params['time_sequential'] == True:
+        feature_shape = [bs, t_params['lookback_feature']] + h_w + [len(t_params['vars_for_feature'])]
+        target_shape = [bs, t_params['lookback_target']] + h_w
+    else:
+        feature_shape = [bs] + h_w + [ int(t_params['lookback_feature']*len(t_params['vars_for_feature'])) ]
+        target_shape = [bs] + h_w
+    
+    return feature_shape, target_shape, target_shape
+
+def element_spec_nbytes(element_spec, element_shapes=None):
+    """Returns the size in bytes of a dataset element from its element_spec, with unknown dimensions taken from element_shapes"""
+    nbytes = 0
+    for idx, spec in enumerate( tf.nest.flatten(element_spec) ):
+        shape = spec.shape.as_list() if spec.shape.rank != None else None
+        if shape is None or None in shape:
+            if element_shapes is None:
+                raise ValueError("Dataset element {} has shape {}, element_shapes is needed for its unknown dimensions".format(idx, spec.shape))
+            shape = element_shapes[idx] if shape is None else [ dim if dim != None else element_shapes[idx][dim_idx] for dim_idx, dim in enumerate(shape) ]
+        nbytes += int( np.prod(shape) )*spec.dtype.size
+    return nbytes
+
+def element_nbytes(element):
+    """Returns the size in bytes of a (nested) dataset element"""
+    return sum( [ t.numpy().nbytes for t in tf.nest.flatten(element) ] )
+
+def cast_features(ds, dtype):
+    """Casts the model fields of a (feature, target, mask) dataset. Model fields are produced and cached as float16
+
+        Args:
+            ds (tf.data.Dataset): dataset of (feature, target, mask)
+            dtype (str): dtype of the model's inputs
+
+        Returns:
+            tf.data.Dataset: dataset with the features cast to dtype
+    """
+    if tf.as_dtype(dtype) == tf.float16:
+        return ds
+    return ds.map( lambda feature, target, mask: (tf.cast(feature, dtype), target, mask), num_parallel_calls=tf.data.experimental.AUTOTUNE )
+# endregion
+
+# region -- Window store
+WINDOW_STORE_INDEX_FN = "window_index.json"
+
+def save_window_store(ds, store_dir, window_dates, loc_count, compression="none"):
+    """Saves pre-processed windows once, for several training splits to select their windows from, see kfold.py.
+        The index file is written last, so a store without it is incomplete
+
+        Args:
+            ds (tf.data.Dataset): unbatched dataset of (feature, target, mask), for each location in turn the windows of window_dates
+            store_dir (str): directory of the store
+            window_dates (np.ndarray): window index of the windows of each location
+            loc_count (int): number of locations
+            compression (str, optional): one of CACHE_COMPRESSIONS. Defaults to "none".
+    """
+    # each window carries its position in the store, so windows are selected by position rather than by reading order
+    ds = tf.data.Dataset.zip( (ds, tf.data.Dataset.range( len(window_dates)*loc_count )) ).map( lambda window, idx: (*window, idx) )
+
+    # a single shard keeps the windows in order when loaded
+    tf.data.experimental.save( ds, store_dir, compression=CACHE_COMPRESSIONS[compression], shard_func=lambda *element: tf.constant(0, dtype=tf.int64) )
+
+    index = { 'window_dates':[ str(date) for date in window_dates ], 'loc_count':loc_count, 'compression':compression,
+                'element_spec':[ [ spec.shape.as_list(), spec.dtype.name ] for spec in ds.element_spec ] }
+    fp_tmp = os.path.join( store_dir, WINDOW_STORE_INDEX_FN + ".tmp" )
+    with open(fp_tmp, "w") as f:
+        json.dump(index, f)
+    os.replace( fp_tmp, os.path.join(store_dir, WINDOW_STORE_INDEX_FN) )
+
+def window_store_complete(store_dir):
+    """Returns True if the window store has been completely written"""
+    return os.path.exists( os.path.join(store_dir, WINDOW_STORE_INDEX_FN) )
+
+def read_window_store_dates(store_dir):
+    """Returns the window index of a complete window store"""
+    with open( os.path.join(store_dir, WINDOW_STORE_INDEX_FN), "r" ) as f:
+        return np.array( json.load(f)['window_dates'], dtype='datetime64[D]' )
+
+def window_store_dataset(store_dir, window_dates, batch_size, first_batch=0, batch_count=None):
+    """Returns the batches of a split's windows from a window store. As with Era5_Eobs.load_data_era5eobs, 
+        the batches of each location follow each other, and each location's windows are truncated to whole batches.
+        The store is read in order up to the last selected window, so the returned dataset is to be cached, see cache_dataset
+
+        Args:
+            store_dir (str): directory of the store
+            window_dates (np.ndarray): window index of the split's training or validation windows
+            batch_size (int): batch size
+            first_batch (int, optional): first of the split's batches to return. Defaults to 0.
+            batch_count (int, optional): number of batches to return. Defaults to None, all batches from first_batch.
+
+        Returns:
+            tf.data.Dataset: batched dataset of (feature, target, mask)
+    """
+    with open( os.path.join(store_dir, WINDOW_STORE_INDEX_FN), "r" ) as f:
+        index = json.load(f)
+
+    store_dates = np.array( index['window_dates'], dtype='datetime64[D]' )
+    window_dates = np.asarray( window_dates, dtype='datetime64[D]' )
+    if not np.all( np.isin(window_dates, store_dates) ):
+        raise ValueError("The window store {} does not hold all the windows of this split".format(store_dir))
+    
+    selected_idxs = np.where( np.isin(store_dates, window_dates) )[0]
+    selected_idxs = selected_idxs[ : (len(selected_idxs)//batch_size)*batch_size ]
+    keep = np.zeros( [ index['loc_count'], len(store_dates) ], dtype=bool )
+    keep[:, selected_idxs] = True
+    keep = np.reshape(keep, [-1])
+
+    # only the selected windows within the requested range of batches are kept
+    batch_idxs = ( np.cumsum(keep) - 1 ) // batch_size
+    total_batches = int( np.sum(keep) ) // batch_size
+    batch_count = total_batches - first_batch if batch_count is None else min( batch_count, total_batches - first_batch )
+    keep = keep & (batch_idxs >= first_batch) & (batch_idxs < first_batch + batch_count)
+
+    element_spec = tuple( tf.TensorSpec(shape, dtype) for shape, dtype in index['element_spec'] )
+    ds = tf.data.experimental.load( store_dir, element_spec, compression=CACHE_COMPRESSIONS[index['compression']] )
+    ds = ds.filter( lambda *element: tf.gather(tf.constant(keep), element[-1]) ).map( lambda *element: element[:-1] )
+
+    # reading stops after the range's last window
+    return ds.take( batch_count*batch_size ).batch( batch_size, drop_remainder=True )
+# endregion
@@ -0,0 +1,198 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
+import glob
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import checkpointing
+import custom_losses as cl
+import train
+import utility
+
+"""
+    Sidecar evaluator. Trains with --sidecar_eval True only save each epoch's weights as a candidate checkpoint,
+        and this process validates the candidates, keeps the checkpoint scores and the best checkpoints,
+        and decides on early stopping. Validation then runs on its own device, while training continues
+
+    Example of how to use
+        Training on GPUs 0-2, evaluation on GPU 3, with the same arguments
+        CUDA_VISIBLE_DEVICES=0,1,2 python3 train.py -se True -mn "TRUNET" -ctsm "1979_2009_2014" -mts "{'location':['London']}" -dd "./Data" -bs 48
+        CUDA_VISIBLE_DEVICES=3 python3 evaluator.py -se True -mn "TRUNET" -ctsm "1979_2009_2014" -mts "{'location':['London']}" -dd "./Data" -bs 48
+
+    Candidates are evaluated in the order they were saved. The scores of each epoch are selected with utility.update_checkpoints_epoch,
+        as in training without the sidecar, and selected candidates are copied to './checkpoints/{modelcode}/epoch'.
+        The evaluator can be stopped and restarted, it continues from the first candidate it has not evaluated
+"""
+
+class CheckpointPromoter():
+    """Copies evaluated candidate checkpoints to the epoch checkpoint directory.
+        Has the save() and after_written() interface of the checkpoint manager passed to utility.update_checkpoints_epoch
+    """
+
+    def __init__(self, directory, max_to_keep):
+        """
+            Args:
+                directory (str): directory of the epoch checkpoints and their 'checkpoint' state file
+                max_to_keep (int): number of most recent checkpoints to keep
+        """
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+        self.candidate_path = None
+
+        ckpt_state = tf.train.get_checkpoint_state( directory )
+        self.li_saved = list( ckpt_state.all_model_checkpoint_paths ) if ckpt_state != None else []
+
+    def save(self):
+        """Copies the files of candidate_path to the directory, and updates the directory's state file
+
+            Returns:
+                str: path of the copied checkpoint
+        """
+        save_path = os.path.join( self.directory, os.path.basename(self.candidate_path) )
+        for fp in glob.glob( self.candidate_path + ".*" ):
+            tf.io.gfile.copy( fp, os.path.join( self.directory, os.path.basename(fp) ), overwrite=True )
+
+        if save_path in self.li_saved:
+            self.li_saved.remove(save_path)
+        self.li_saved.append( save_path )
+
+        for old_path in self.li_saved[:-self.max_to_keep]:
+            tf.compat.v1.train.remove_checkpoint( old_path )
+        self.li_saved = self.li_saved[-self.max_to_keep:]
+
+        tf.compat.v1.train.update_checkpoint_state( self.directory, save_path, all_model_checkpoint_paths=self.li_saved )
+        return save_path
+
+    def after_written(self, fn):
+        """Calls fn, since the copies of save() are complete once it returns"""
+        fn()
+
+class SidecarEvaluator():
+    """Validates the candidate checkpoints saved by a training job run with --sidecar_eval True
+    """
+
+    def __init__(self, t_params, m_params, poll_interval=30):
+        """
+            Args:
+                t_params (dict): params for training, the same as the training job's
+                m_params (dict): params for model
+                poll_interval (int, optional): seconds between checks for new candidates. Defaults to 30.
+        """
+        if not t_params.get('sidecar_eval', False):
+            raise ValueError("The evaluator validates the candidates of training with sidecar_eval True")
+
+        # The evaluator's devices are independent of the training job's cluster
+        t_params = { **t_params, 'strategy':'mirrored' }
+        self.poll_interval = poll_interval
+
+        self.weather_model = train.WeatherModel( t_params, m_params )
+        self.weather_model.initialize_scheme_era5Eobs( evaluator=True )
+        self.t_params, self.m_params = self.weather_model.t_params, self.weather_model.m_params
+
+        model_dir = "checkpoints/{}".format( utility.model_name_mkr(self.m_params, t_params=self.t_params, htuning=self.m_params.get('htuning',False)) )
+        self.candidates_dir = os.path.join( model_dir, checkpointing.SIDECAR_CANDIDATES_DIR )
+        self.fp_manifest = os.path.join( self.candidates_dir, checkpointing.SIDECAR_MANIFEST_FN )
+        self.fp_state = os.path.join( model_dir, checkpointing.SIDECAR_STATE_FN )
+
+        self.promoter = CheckpointPromoter( os.path.join(model_dir, "epoch"), self.t_params['checkpoints_to_keep'] )
+        self.state = checkpointing.read_json( self.fp_state, {'entries_evaluated':0, 'last_evaluated_epoch':-1, 'stop_early':False} )
+
+        with self.weather_model.strategy.scope():
+            self.ckpt = tf.train.Checkpoint( model=self.weather_model.model )
+
+    def run(self):
+        """Evaluates candidates as they are written, until early stopping or until training has finished and all candidates are evaluated"""
+        while not self.state['stop_early']:
+            li_entries = checkpointing.read_jsonl( self.fp_manifest )[ self.state['entries_evaluated']: ]
+
+            if len(li_entries) > 0 and li_entries[0].get('finished', False):
+                if len(li_entries) == 1:
+                    print("Training finished, all candidates evaluated")
+                    break
+                # a resumed training job continues the manifest after its earlier finished record
+                self.skip_entry()
+                continue
+
+            if len(li_entries) > 0 and 'resumed_at_epoch' in li_entries[0]:
+                self.skip_entry()
+                continue
+
+            # a resumed trainer retrains the epochs from resumed_at_epoch, so the earlier run's candidates of these epochs are discarded
+            if len(li_entries) > 0 and any( entry.get('resumed_at_epoch', np.inf) <= li_entries[0]['epoch'] for entry in li_entries[1:] ):
+                print("Discarding the candidate of EPOCH {}, since training resumed before it".format( li_entries[0]['epoch'] ))
+                if self.candidate_written( li_entries[0]['checkpoint_path'] ):
+                    tf.compat.v1.train.remove_checkpoint( li_entries[0]['checkpoint_path'] )
+                self.skip_entry()
+                continue
+
+            if len(li_entries) == 0 or not self.candidate_written( li_entries[0]['checkpoint_path'] ):
+                time.sleep( self.poll_interval )
+                continue
+
+            self.evaluate( li_entries[0] )
+
+        self.weather_model.reporter.close()
+
+    def skip_entry(self):
+        """Marks the next manifest record as handled without evaluating it"""
+        self.state['entries_evaluated'] += 1
+        checkpointing.write_json( self.fp_state, self.state )
+
+    def candidate_written(self, ckpt_path):
+        """Returns True once the trainer has completely written a candidate checkpoint"""
+        ckpt_state = tf.train.get_checkpoint_state( self.candidates_dir )
+        return ckpt_state != None and ckpt_path in ckpt_state.all_model_checkpoint_paths
+
+    def evaluate(self, entry):
+        """Validates one candidate, updates the checkpoint scores and the early stopping decision, then removes the candidate
+
+            Args:
+                entry (dict): manifest record of the candidate, {'epoch', 'train_loss', 'train_mse', 'checkpoint_path'}
+        """
+        wm = self.weather_model
+        epoch = entry['epoch']
+        bounds = cl.central_region_bounds( self.m_params['region_grid_params'] )
+        print("\n\nEvaluating EPOCH {} from {}".format( epoch, entry['checkpoint_path'] ))
+
+        with wm.strategy.scope():
+            self.ckpt.restore( entry['checkpoint_path'] ).expect_partial()
+
+        start_time = time.time()
+        wm.validate( bounds )
+        wm.reporter.scalars( {'Validation Loss':wm.loss_agg_val.result(), 'Validation MSE':wm.mse_agg_val.result()}, epoch )
+        wm.reporter.timings( {'validation':time.time()-start_time}, epoch )
+
+        # the training scores of the epoch, as recorded by the trainer
+        wm.loss_agg_epoch.reset_states()
+        wm.mse_agg_epoch.reset_states()
+        wm.loss_agg_epoch.update_state( entry['train_loss'] )
+        wm.mse_agg_epoch.update_state( entry['train_mse'] )
+
+        print("\tEpoch:{}\t Train Loss:{:.8f}\t Train MSE:{:.5f}\t Val Loss:{:.5f}\t Val MSE:{:.5f}".format( epoch, entry['train_loss'], entry['train_mse'],
+                    wm.loss_agg_val.result(), wm.mse_agg_val.result() ))
+
+        self.promoter.candidate_path = entry['checkpoint_path']
+        wm.df_training_info = utility.update_checkpoints_epoch( wm.df_training_info, epoch, wm.loss_agg_epoch, wm.loss_agg_val, self.promoter, self.t_params,
+                                    self.m_params, wm.mse_agg_epoch, wm.mse_agg_val, self.t_params['objective'], wm.reporter )
+
+        stop_early = epoch > ( max( wm.df_training_info.loc[:, 'Epoch'], default=0 ) + self.t_params['early_stopping_period'] )
+        if stop_early:
+            print("Model Stopping Early at EPOCH {}".format(epoch))
+            print(wm.df_training_info)
+
+        # the state is written before the candidate is removed, so a restarted evaluator never looks for a removed candidate
+        self.state = { 'entries_evaluated':self.state['entries_evaluated']+1, 'last_evaluated_epoch':epoch, 'stop_early':bool(stop_early) }
+        checkpointing.write_json( self.fp_state, self.state )
+        tf.compat.v1.train.remove_checkpoint( entry['checkpoint_path'] )
+
+if __name__ == "__main__":
+    s_dir = utility.get_script_directory(sys.argv[0])
+    args_dict = utility.parse_arguments(s_dir)
+
+    t_params, m_params = utility.load_params(args_dict)
+
+    SidecarEvaluator( t_params, m_params ).run()
@@ -93,7 +93,7 @@ class model_TRUNET_hparameters(MParams):
         # endregion
 
         # region --- Key Model Size Settings
-        seq_len_for_highest_hierachy_level = 4 # Seq length of GRU operations in highest level of encoder
+        seq_len_for_highest_hierachy_level = model_type_settings.get('chunk_weeks', 4) # Seq length of GRU operations in highest level of encoder
 
         seq_len_factor_reduction = [4, 7]   # This represents the reduction in seq_len when going from layer 1 
                                                 #to layer 2 and layer 2 to layer 3 in the encoder / decoder
@@ -118,8 +118,9 @@ class model_TRUNET_hparameters(MParams):
 
 
         kernel_size_enc        = [ (4,4) ] * ( enc_layer_count )             
-        print("Check appropriate stateful is being used for multi gpu status")
-        stateful = False                       
+        # stateful ConvGRUs carry their hidden states across consecutive windows of a location, see train.py
+        stateful = model_type_settings.get('stateful', False)
+        recompute = kwargs.get('recompute', 'none') # gradient checkpointing of the ConvGRUs, see layers_convgru2D.ConvRNN2D
 
         # Attention params
         attn_heads = [ model_type_settings.get('heads', 8) ]*attn_layers_count            
@@ -155,7 +156,7 @@ class model_TRUNET_hparameters(MParams):
             {'filters':filters , 'kernel_size':ks, 'padding':'same', 
                 'return_sequences':True, 'dropout':ido, 'recurrent_dropout':rdo,
                 'stateful':stateful, 'recurrent_regularizer': recurrent_reg, 'kernel_regularizer':kernel_reg,
-                'bias_regularizer':bias_reg, 'implementation':1 ,'layer_norm':None }
+                'bias_regularizer':bias_reg, 'implementation':1 ,'layer_norm':None, 'recompute':recompute }
              for ks in kernel_size_enc
         ] #list of params for each ConvGRU layer in the Encoder
       
@@ -184,7 +185,7 @@ class model_TRUNET_hparameters(MParams):
                 'kernel_regularizer':kernel_reg,
                 'recurrent_regularizer': recurrent_reg,
                 'bias_regularizer':bias_reg,
-                'stateful':stateful,
+                'stateful':stateful, 'recompute':recompute,
                 'implementation':1 ,'layer_norm':[ None, None ]  }
              for ks in kernel_size_dec ] #list of dictionaries containing params for each ConvGRU layer in decoder
 
@@ -244,8 +245,8 @@ class model_HCGRU_hparamaters(MParams):
         #region --- ConvLayers
         layer_count = 4 
         filters = 80
-        print("Check appropriate stateful is being used for multi gpu status")
-        stateful = False
+        stateful = model_type_settings.get('stateful', False)
+        recompute = kwargs.get('recompute', 'none')
         kernel_sizes = [[4,4]]*layer_count
         paddings = ['same']*layer_count
         return_sequences = [True]*layer_count
@@ -258,7 +259,7 @@ class model_HCGRU_hparamaters(MParams):
                                 'recurrent_regularizer': None,
                                 'bias_regularizer':tf.keras.regularizers.l2(0.0),
                                 'layer_norm': None,
-                                'implementation':1, 'stateful':stateful  }
+                                'implementation':1, 'stateful':stateful, 'recompute':recompute  }
                                 for ks,ps,rs,dp,rdp in zip( kernel_sizes, paddings, return_sequences, input_dropout, recurrent_dropout)  ]
 
         conv1_layer_params = {'filters': int(  8*(((filters*2)/3)//8)) , 'kernel_size':[3,3], 'activation':'relu','padding':'same','bias_regularizer':tf.keras.regularizers.l2(0.0) }  
@@ -268,7 +269,7 @@ class model_HCGRU_hparamaters(MParams):
 
         #region --- Data pipeline and optimizers
         target_to_feature_time_ratio = 4
-        lookback_feature = 28*target_to_feature_time_ratio  
+        lookback_feature = 7*model_type_settings.get('chunk_weeks', 4)*target_to_feature_time_ratio  
         DATA_PIPELINE_PARAMS = {
             'lookback_feature':lookback_feature,
             'lookback_target': int(lookback_feature/target_to_feature_time_ratio),
@@ -358,6 +359,12 @@ class train_hparameters_ati(HParams):
         
         # data formulation method
         self.custom_train_split_method = kwargs.get('ctsm') 
+
+        # optional date-set specification, overrides the contiguous blocks in ctsm
+        self.train_dates = kwargs.get('train_dates', None)
+        self.val_dates = kwargs.get('val_dates', None)
+        self.months = kwargs.get('months', None)
+        self.continual = kwargs.get('continual', None)
             
         if self.custom_train_split_method == "4ds_10years":
             self.four_year_idx_train = kwargs['fyi_train'] #index for training set
@@ -416,6 +423,22 @@ class train_hparameters_ati(HParams):
         TRAIN_SET_SIZE_ELEMENTS = ( np.timedelta64(train_end_date - start_date,'D')).astype(int)  // WINDOW_SHIFT  
         VAL_SET_SIZE_ELEMENTS   = ( np.timedelta64(val_end_date - val_start_date,'D')  // WINDOW_SHIFT  ).astype(int)               
         
+        # Date-set specification: list of [start, end) ranges and/or a month mask, compiled into
+            # an index of window start dates. The data readers then only seek to these windows
+        train_window_dates = None
+        val_window_dates = None
+        if self.train_dates!=None or self.val_dates!=None or self.months!=None or self.continual!=None:
+            if self.continual != None:
+                # Continual training: the newly arrived windows, mixed with a replay sample of the earlier windows
+                if self.train_dates != None:
+                    raise ValueError("continual and train_dates can not both be set")
+                train_window_dates = continual_window_dates_mkr( dates_str[0:2], WINDOW_SHIFT, self.months, **self.continual )
+            else:
+                train_window_dates = window_dates_mkr( self.train_dates or [ dates_str[0:2] ], WINDOW_SHIFT, self.months )
+            val_window_dates = window_dates_mkr( self.val_dates or [ dates_str[1:3] ], WINDOW_SHIFT, self.months )
+
+            TRAIN_SET_SIZE_ELEMENTS = len(train_window_dates)
+            VAL_SET_SIZE_ELEMENTS = len(val_window_dates)
         # endregion
         
         DATA_DIR = self.dd
@@ -434,6 +457,7 @@ class train_hparameters_ati(HParams):
 
             'checkpoints_to_keep':CHECKPOINTS_TO_KEEP,
             'reporting_freq':0.25,
+            'shuffle_seed':0,
 
             'train_monte_carlo_samples':1,
             'data_dir': DATA_DIR,
@@ -447,6 +471,8 @@ class train_hparameters_ati(HParams):
             'start_date':start_date,
             'val_start_date':val_start_date,
             'val_end_date':val_end_date,
+            'train_window_dates':train_window_dates,
+            'val_window_dates':val_window_dates,
 
             'feature_start_date':feature_start_date,
             'target_start_date':target_start_date,
@@ -562,3 +588,67 @@ class test_hparameters_ati(HParams):
             'parallel_calls':self.parallel_calls
 
         }
+
+def window_dates_mkr(date_ranges, window_len, months=None):
+    """Compiles a date-set specification into a window index
+
+        Each date range is intersected with the month mask. Windows of window_len days are then tiled 
+            from the start of every contiguous run of selected days, so no window crosses an excluded period
+
+        Args:
+            date_ranges (list): list of [start, end) pairs of date strings e.g. [ ['1979','1990'], ['1995','2009-03-01'] ]
+            window_len (int): number of days in each window
+            months (list, optional): months to keep e.g. [12,1,2] for DJF. Defaults to None, all months kept
+
+        Returns:
+            np.ndarray: sorted array of np.datetime64[D], the start date of each window
+    """
+    li_window_dates = []
+    for start, end in date_ranges:
+        days = np.arange( np.datetime64(start,'D'), np.datetime64(end,'D'), dtype='datetime64[D]' )
+        
+        if months == None:
+            bool_selected = np.ones( days.shape, dtype=bool )
+        else:
+            bool_selected = np.isin( days.astype('datetime64[M]').astype(int) % 12 + 1, months )
+        
+        # start and end idxs of each contiguous run of selected days
+        edges = np.diff( np.concatenate( [ [0], bool_selected.astype(np.int8), [0] ] ) )
+        run_starts = np.where( edges==1 )[0]
+        run_ends = np.where( edges==-1 )[0]
+
+        for run_start, run_end in zip(run_starts, run_ends):
+            window_count = (run_end - run_start)//window_len
+            li_window_dates.append( days[run_start] + np.arange(window_count)*window_len )
+
+    if len(li_window_dates) == 0:
+        return np.array( [], dtype='datetime64[D]' )
+
+    return np.unique( np.concatenate(li_window_dates) )
+
+def continual_window_dates_mkr(date_range, window_len, months=None, new_start=None, replay_windows=None, seed=0):
+    """Compiles the window index of continual training: every window of the newly arrived data,
+        and a fixed size random sample of the earlier windows, replayed to limit forgetting
+
+        Args:
+            date_range (list): [start, end) pair of date strings of the training period e.g. ['1979','2020-02']
+            window_len (int): number of days in each window
+            months (list, optional): months to keep e.g. [12,1,2] for DJF. Defaults to None, all months kept
+            new_start (str): first date of the newly arrived data, within date_range
+            replay_windows (int, optional): number of earlier windows to sample. Defaults to None, as many as there are new windows
+            seed (int, optional): seed of the replay sample. Defaults to 0.
+
+        Returns:
+            np.ndarray: sorted array of np.datetime64[D], the start date of each window
+    """
+    if new_start == None:
+        raise ValueError("continual training needs new_start, the first date of the newly arrived data")
+
+    new_window_dates = window_dates_mkr( [ [new_start, date_range[1]] ], window_len, months )
+    old_window_dates = window_dates_mkr( [ [date_range[0], new_start] ], window_len, months )
+
+    replay_windows = len(new_window_dates) if replay_windows == None else replay_windows
+    if replay_windows < len(old_window_dates):
+        old_window_dates = np.random.RandomState(seed).choice( old_window_dates, replay_windows, replace=False )
+
+    return np.unique( np.concatenate( [ old_window_dates, new_window_dates ] ) )
@@ -0,0 +1,178 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+import argparse
+import ast
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import utility
+
+"""
+    Trains one model for each of several ctsm splits, reading and pre-processing the data only once.
+        The windows of all splits are first written to a window store, see data_generators.save_window_store,
+        then one train.py process per split selects its training and validation windows from the store.
+        Executor specific arguments are passed first, all remaining arguments are the usual train.py arguments, without -ctsm
+
+    Example of how to use
+        Three splits, each on its own GPU
+        python3 kfold.py -sp "['1979_2009_2014','1984_2014_2019','1989_2019_2020']" -kd "['0','1','2']" -mn "TRUNET" -mts "{'location':['London']}" -dd "./Data" -bs 48
+
+        Two splits at a time on the CPU
+        python3 kfold.py -sp "['1979_2009_2014','1984_2014_2019','1989_2019_2020']" -kc 2 -mn "HCGRU" ...
+
+    Each split's model is saved under its own modelcode, as when training on that ctsm directly.
+        Split output is logged to ./logs/kfold_{ctsm}.log. The store is kept, and is reused while it holds every split's windows
+"""
+
+def split_window_dates(train_args, ctsm):
+    """Returns the training and validation window index of a split, as train.py computes them
+
+        Args:
+            train_args (list): training arguments
+            ctsm (str): split, as passed to train.py -ctsm
+
+        Returns:
+            tuple: t_params, m_params, window index of the training and validation windows
+    """
+    import hparameters
+
+    sys.argv = sys.argv[:1] + train_args + [ '-ctsm', ctsm ]
+    t_params, m_params = utility.load_params( utility.parse_arguments( utility.get_script_directory(sys.argv[0]) ) )
+
+    dates_str = ctsm.split("_")
+    li_window_dates = []
+    for key, date_range in [ ('train', dates_str[0:2]), ('val', dates_str[1:3]) ]:
+        window_dates = t_params[key+'_window_dates']
+        if window_dates is None:
+            window_dates = hparameters.window_dates_mkr( [date_range], t_params['window_shift'] )
+        li_window_dates.append( window_dates )
+
+    return t_params, m_params, np.concatenate(li_window_dates)
+
+def prepare_store(train_args, li_splits, store_dir, compression):
+    """Reads and pre-processes the union of the splits' windows once, and saves them to the window store
+
+        Args:
+            train_args (list): training arguments
+            li_splits (list): splits, as passed to train.py -ctsm
+            store_dir (str): directory of the window store
+            compression (str): one of data_generators.CACHE_COMPRESSIONS
+    """
+    import data_generators
+
+    li_window_dates = []
+    for ctsm in li_splits:
+        t_params, m_params, window_dates = split_window_dates( train_args, ctsm )
+        li_window_dates.append( window_dates )
+    window_dates = np.unique( np.concatenate(li_window_dates) )
+
+    if data_generators.window_store_complete(store_dir):
+        stored_dates = data_generators.read_window_store_dates(store_dir)
+        if np.all( np.isin(window_dates, stored_dates) ):
+            print("Reusing the window store {}".format(store_dir))
+            return
+        print("The window store {} does not hold every split's windows, it is rewritten".format(store_dir))
+
+    # windows are stored unbatched, so that each split batches its own selection
+    era5_eobs = data_generators.Era5_Eobs( { **t_params, 'batch_size':1 }, m_params )
+    ds, _ = era5_eobs.load_data_era5eobs( len(window_dates)*era5_eobs.loc_count, t_params['start_date'], t_params['parallel_calls'], window_dates=window_dates )
+
+    start_time = time.time()
+    data_generators.save_window_store( ds.unbatch(), store_dir, window_dates, era5_eobs.loc_count, compression )
+    print("Saved {} windows to {} in {:.0f}s".format( len(window_dates)*era5_eobs.loc_count, store_dir, time.time()-start_time ))
+
+def main(li_splits, li_devices, concurrency, store_dir, compression, train_args):
+    """Prepares the window store, then trains each split in its own train.py process
+
+        Args:
+            li_splits (list): splits, as passed to train.py -ctsm
+            li_devices (list): CUDA_VISIBLE_DEVICES of each concurrent process, assigned in turn. Empty to keep this process's devices
+            concurrency (int): number of splits trained at once, 0 for one per device, or all splits at once without devices
+            store_dir (str): directory of the window store
+            compression (str): one of data_generators.CACHE_COMPRESSIONS
+            train_args (list): arguments passed to train.py
+
+        Returns:
+            int: 0 if every split trained successfully
+    """
+    # the store is prepared in a subprocess on the CPU, so that this process holds no device memory while the splits train
+    cmd = [ sys.executable, os.path.realpath(__file__), '--prepare_only', 'True', '-sp', str(li_splits), '-ks', store_dir, '-kcomp', compression ] + train_args
+    env = dict(os.environ)
+    env['CUDA_VISIBLE_DEVICES'] = ""
+    proc = subprocess.run( cmd, env=env )
+    if proc.returncode != 0:
+        print("Preparing the window store failed with exit code {}".format(proc.returncode))
+        return proc.returncode
+
+    if concurrency == 0:
+        concurrency = len(li_devices) if len(li_devices) > 0 else len(li_splits)
+
+    os.makedirs("logs", exist_ok=True)
+    script = os.path.join( os.path.dirname(os.path.realpath(__file__)), "train.py" )
+
+    li_pending = list(li_splits)
+    li_procs = []
+    exit_code = 0
+    try:
+        while len(li_pending) > 0 or len(li_procs) > 0:
+            for proc, f_log, ctsm, device in [ record for record in li_procs if record[0].poll() != None ]:
+                f_log.close()
+                li_procs.remove( (proc, f_log, ctsm, device) )
+                print("Split {} finished with exit code {}".format(ctsm, proc.returncode))
+                if exit_code == 0 and proc.returncode != 0:
+                    exit_code = proc.returncode
+
+            while len(li_pending) > 0 and len(li_procs) < concurrency:
+                ctsm = li_pending.pop(0)
+                used = [ device for _, _, _, device in li_procs ]
+                device = next( (device for device in li_devices if device not in used), None )
+
+                env = dict(os.environ)
+                if device != None:
+                    env['CUDA_VISIBLE_DEVICES'] = device
+
+                cmd = [ sys.executable, script ] + train_args + [ '-ctsm', ctsm, '--window_store', store_dir ]
+                print("Starting split {}: {}".format(ctsm, " ".join(cmd)))
+                f_log = open( os.path.join("logs", "kfold_{}.log".format(ctsm)), "w" )
+                li_procs.append( ( subprocess.Popen(cmd, env=env, stdout=f_log, stderr=subprocess.STDOUT), f_log, ctsm, device ) )
+
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for proc, f_log, _, _ in li_procs:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+            f_log.close()
+        exit_code = 1
+
+    return exit_code
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Receive executor params, remaining params are passed to train.py", allow_abbrev=False)
+
+    parser.add_argument('-sp','--splits', type=str, required=True, help="list of ctsm splits e.g. \"['1979_2009_2014','1984_2014_2019']\"")
+
+    parser.add_argument('-kd','--kfold_devices', type=str, required=False, default="[]",
+                        help="list of CUDA_VISIBLE_DEVICES values, one per concurrent split e.g. \"['0','1','2,3']\". Defaults to [], each split sees this process's devices")
+
+    parser.add_argument('-kc','--kfold_concurrency', type=int, required=False, default=0, help="number of splits trained at once, 0 for one per device")
+
+    parser.add_argument('-ks','--kfold_store', type=str, required=False, default="./Data/data_cache/kfold_store", help="directory of the window store")
+
+    parser.add_argument('-kcomp','--kfold_compression', type=str, required=False, default="none", choices=['none','zlib','snappy'], help="compression of the window store")
+
+    parser.add_argument('--prepare_only', type=eval, required=False, default=False, choices=[True,False], help=argparse.SUPPRESS)
+
+    kfold_args, train_args = parser.parse_known_args()
+
+    li_splits = ast.literal_eval(kfold_args.splits)
+    li_devices = ast.literal_eval(kfold_args.kfold_devices)
+
+    if kfold_args.prepare_only:
+        prepare_store( train_args, li_splits, kfold_args.kfold_store, kfold_args.kfold_compression )
+        sys.exit(0)
+
+    sys.exit( main( li_splits, li_devices, kfold_args.kfold_concurrency, kfold_args.kfold_store, kfold_args.kfold_compression, train_args ) )
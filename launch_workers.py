@@ -0,0 +1,131 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+"""
+    Launches the workers of multi-worker CPU data-parallel training, with train.py --strategy multi_worker.
+        Each worker gets a TF_CONFIG describing the cluster, and where numactl is available, is bound to one NUMA node.
+        All arguments after the launcher arguments are passed to every worker's train.py
+
+    Example of how to use
+        4 workers on this host
+        python3 launch_workers.py -nw 4 -mn "TRUNET" -ctsm "1979_2009_2014" -mts "{...}" -dd "./Data" -bs 16
+
+        2 hosts with 2 workers each, run once on each host with its host index
+        python3 launch_workers.py -wh "node1:2,node2:2" -hi 0 -mn "TRUNET" ...
+        python3 launch_workers.py -wh "node1:2,node2:2" -hi 1 -mn "TRUNET" ...
+
+    Worker 0 is the chief, its checkpoints and records are saved under the usual modelcode.
+        The other workers save under modelcode_worker{idx}. Worker output is logged to ./logs/worker_{idx}.log
+"""
+
+def main(worker_hosts, host_index, base_port, numa, intra_op_threads, train_args):
+    """Starts this host's workers and waits for them to finish
+
+        Args:
+            worker_hosts (list): list of (host, worker_count) for every host in the cluster
+            host_index (int): index of this host in worker_hosts
+            base_port (int): port of a host's first worker, the host's other workers use the following ports
+            numa (bool): whether to bind each worker to a NUMA node with numactl
+            intra_op_threads (int): threads per op for each worker, 0 to split this host's cores evenly between its workers
+            train_args (list): arguments passed to train.py
+
+        Returns:
+            int: 0 if all of this host's workers exited successfully
+    """
+    li_workers = [ "{}:{}".format(host, base_port+idx) for host, count in worker_hosts for idx in range(count) ]
+    first_worker_idx = sum( count for _, count in worker_hosts[:host_index] )
+    local_count = worker_hosts[host_index][1]
+
+    numa_nodes = numa_node_count() if numa else 0
+    if numa and numa_nodes == 0:
+        print("numactl or NUMA topology not found, workers will not be bound to NUMA nodes")
+
+    if intra_op_threads == 0:
+        intra_op_threads = max( 1, os.cpu_count() // local_count )
+
+    os.makedirs("logs", exist_ok=True)
+    script = os.path.join( os.path.dirname(os.path.realpath(__file__)), "train.py" )
+
+    li_procs = []
+    for local_idx in range(local_count):
+        worker_idx = first_worker_idx + local_idx
+
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps( { 'cluster':{'worker':li_workers}, 'task':{'type':'worker', 'index':worker_idx} } )
+        env['OMP_NUM_THREADS'] = str(intra_op_threads)
+
+        cmd = [ sys.executable, script, '--strategy', 'multi_worker', '--intra_op_threads', str(intra_op_threads) ] + train_args
+        if numa_nodes > 0:
+            node = local_idx % numa_nodes
+            cmd = [ 'numactl', '--cpunodebind={}'.format(node), '--membind={}'.format(node) ] + cmd
+
+        print("Starting worker {}: {}".format(worker_idx, " ".join(cmd)))
+        f_log = open( os.path.join("logs", "worker_{}.log".format(worker_idx)), "w" )
+        li_procs.append( ( subprocess.Popen(cmd, env=env, stdout=f_log, stderr=subprocess.STDOUT), f_log ) )
+
+    # A failed worker would leave the others waiting on collectives, so the remaining workers are then stopped
+    exit_code = 0
+    try:
+        while any( proc.poll() == None for proc, _ in li_procs ):
+            failed = [ proc for proc, _ in li_procs if proc.poll() not in [None, 0] ]
+            if len(failed) > 0 and exit_code == 0:
+                exit_code = failed[0].returncode
+                print("A worker exited with code {}, stopping the remaining workers".format(exit_code))
+                for proc, _ in li_procs:
+                    if proc.poll() == None:
+                        proc.send_signal(signal.SIGTERM)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for proc, _ in li_procs:
+            proc.send_signal(signal.SIGTERM)
+        exit_code = 1
+
+    for proc, f_log in li_procs:
+        proc.wait()
+        f_log.close()
+        if exit_code == 0 and proc.returncode != 0:
+            exit_code = proc.returncode
+
+    return exit_code
+
+def numa_node_count():
+    """Returns the number of NUMA nodes on this host, 0 if numactl is unavailable"""
+    if shutil.which('numactl') == None:
+        return 0
+    return len( glob.glob("/sys/devices/system/node/node[0-9]*") )
+
+def parse_worker_hosts(str_hosts):
+    """Parses 'host1:count1,host2:count2' into [(host1, count1), (host2, count2)]"""
+    li_hosts = []
+    for entry in str_hosts.split(","):
+        host, count = entry.rsplit(":", 1)
+        li_hosts.append( (host, int(count)) )
+    return li_hosts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Receive launcher params, remaining params are passed to train.py", allow_abbrev=False)
+
+    parser.add_argument('-nw','--num_workers', type=int, required=False, default=2, help="number of workers on this host, if --worker_hosts is not passed")
+
+    parser.add_argument('-wh','--worker_hosts', type=str, required=False, default=None, help="cluster as 'host1:workers1,host2:workers2'")
+
+    parser.add_argument('-hi','--host_index', type=int, required=False, default=0, help="index of this host in --worker_hosts")
+
+    parser.add_argument('-bp','--base_port', type=int, required=False, default=23456)
+
+    parser.add_argument('-numa','--numa', type=eval, required=False, default='True', choices=[True,False], help="bind each worker to a NUMA node with numactl")
+
+    parser.add_argument('-wiot','--worker_intra_op_threads', type=int, required=False, default=0, help="threads per op for each worker, 0 to split the cores evenly")
+
+    launch_args, train_args = parser.parse_known_args()
+
+    worker_hosts = parse_worker_hosts(launch_args.worker_hosts) if launch_args.worker_hosts != None else [ ('localhost', launch_args.num_workers) ]
+
+    sys.exit( main( worker_hosts, launch_args.host_index, launch_args.base_port, launch_args.numa, launch_args.worker_intra_op_threads, train_args ) )
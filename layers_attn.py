@@ -1,7 +1,6 @@
 
 import numpy as np
 import tensorflow as tf
-tf.keras.backend.set_floatx('float16')
 
 from tensorflow.python.ops import inplace_ops
 
@@ -183,9 +182,9 @@ class MultiHead2DAttention_v2(Layer):
         if self.conv_ops_qk == False:
             #Link To Paper - Equation 2, 3D avg pool operations
             q_antecedent = tf.cast( tf.nn.avg_pool3d( tf.cast(inputs,tf.float32), strides=self.kq_downscale_stride,
-                                        ksize=self.kq_downscale_kernelshape, padding="SAME"), tf.float16) #( batch_size, seq_len, height/M,width/M, filters_in) 
+                                        ksize=self.kq_downscale_kernelshape, padding="SAME"), inputs.dtype) #( batch_size, seq_len, height/M,width/M, filters_in) 
             k_antecedent = tf.cast(tf.nn.avg_pool3d( tf.cast(k_antecedent,tf.float32), strides=self.kq_downscale_stride,
-                                    ksize=self.kq_downscale_kernelshape, padding="SAME"), tf.float16)
+                                    ksize=self.kq_downscale_kernelshape, padding="SAME"), k_antecedent.dtype)
         else:
             q_antecedent = inputs #(bs, seq_len, h, w, c)
             k_antecedent = inputs #(bs, seq_len, h, w, c)
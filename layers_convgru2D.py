@@ -1,6 +1,5 @@
 import numpy as np
 import tensorflow as tf
-tf.keras.backend.set_floatx('float16')
 
 from tensorflow.python.ops import inplace_ops
 
@@ -23,6 +22,9 @@ from tensorflow.python.util.tf_export import keras_export
 from tensorflow.keras.layers import Conv2D, RNN
 from layers_attn import MultiHead2DAttention_v2, _generate_relative_positions_embeddings, _relative_attention_inner, attn_shape_adjust
 
+# Gradient checkpointing options of ConvRNN2D
+RECOMPUTE_MODES = ['none', 'layer', 'step']
+
 
 class ConvRNN2D(RNN):
   """Base class for convolutional-recurrent layers.
@@ -53,6 +55,10 @@ class ConvRNN2D(RNN):
       stateful: Boolean (default False). If True, the last state
         for each sample at index i in a batch will be used as initial
         state for the sample of index i in the following batch.
+      recompute: String (default 'none'). Gradient checkpointing of the
+        recurrence. 'layer' keeps only the layer's inputs and outputs for the
+        backward pass, 'step' keeps each timestep's inputs and states. The
+        remaining activations are recomputed in the backward pass.
       input_shape: Use this argument to specify the shape of the
         input when this layer is the first one in a model.
 
@@ -150,6 +156,7 @@ class ConvRNN2D(RNN):
                go_backwards=False,
                stateful=False,
                unroll=False,
+               recompute='none',
                **kwargs):
     if unroll:
       raise TypeError('Unrolling isn\'t possible with '
@@ -169,6 +176,10 @@ class ConvRNN2D(RNN):
     self.states = None
     self._num_constants = None
 
+    if recompute not in RECOMPUTE_MODES:
+      raise ValueError('recompute must be one of {}, found {}'.format(RECOMPUTE_MODES, recompute))
+    self.recompute = recompute
+
   @tf_utils.shape_type_conversion
   def compute_output_shape(self, input_shape):
     if isinstance(input_shape, list):
@@ -373,13 +384,17 @@ class ConvRNN2D(RNN):
       def step(inputs, states):
         return self.cell.call(inputs, states, **kwargs)
 
-    last_output, outputs, states = K.rnn(step,
-                                         inputs,
-                                         initial_state,
-                                         constants=constants,
-                                         go_backwards=self.go_backwards,
-                                         mask=mask,
-                                         input_length=timesteps)
+    if self.recompute == 'none':
+      last_output, outputs, states = K.rnn(step,
+                                          inputs,
+                                          initial_state,
+                                          constants=constants,
+                                          go_backwards=self.go_backwards,
+                                          mask=mask,
+                                          input_length=timesteps)
+    else:
+      last_output, outputs, states = self._recomputed_rnn(step, inputs, initial_state, constants, mask, timesteps)
+
     if self.stateful:
       updates = []
       for i in range(len(states)):
@@ -400,6 +415,54 @@ class ConvRNN2D(RNN):
     else:
       return output
 
+  def _recomputed_rnn(self, step, inputs, initial_state, constants, mask, timesteps):
+    """K.rnn with gradient checkpointing, see the recompute argument.
+        The states and constants are passed to the recomputed functions as arguments, so that they receive gradients
+    """
+    constants = list(constants) if constants else []
+    state_count = len(initial_state)
+
+    # The cell's dropout masks are cached on their first use. Sampling them here, outside the recomputed
+    # functions, makes the backward pass recompute the forward pass with the same masks
+    step(inputs[:, 0], tuple(initial_state) + tuple(constants))
+
+    if self.recompute == 'step':
+      @tf.recompute_grad
+      def flat_step(step_inputs, *states):
+        output, new_states = step(step_inputs, states)
+        return [output] + list(new_states)
+
+      def recomputed_step(step_inputs, states):
+        results = flat_step(step_inputs, *states)
+        return results[0], list(results[1:])
+
+      return K.rnn(recomputed_step,
+                  inputs,
+                  initial_state,
+                  constants=constants if constants else None,
+                  go_backwards=self.go_backwards,
+                  mask=mask,
+                  input_length=timesteps)
+
+    @tf.recompute_grad
+    def flat_rnn(layer_inputs, *states_constants):
+      last_output, outputs, states = K.rnn(step,
+                                          layer_inputs,
+                                          list(states_constants[:state_count]),
+                                          constants=list(states_constants[state_count:]) if constants else None,
+                                          go_backwards=self.go_backwards,
+                                          mask=mask,
+                                          input_length=timesteps)
+      return [last_output, outputs] + list(states)
+
+    results = flat_rnn(inputs, *(list(initial_state) + constants))
+    return results[0], results[1], list(results[2:])
+
+  def get_config(self):
+    config = super(ConvRNN2D, self).get_config()
+    config['recompute'] = self.recompute
+    return config
+
   def reset_states(self, states=None):
     if not self.stateful:
       raise AttributeError('Layer must be stateful.')
@@ -437,14 +500,14 @@ class ConvRNN2D(RNN):
     # initialize state if None
     if self.states[0] is None:
       if hasattr(self.cell.state_size, '__len__'):
-        self.states = [K.zeros(get_tuple_shape(dim),dtype=tf.float16)
+        self.states = [K.zeros(get_tuple_shape(dim))
                        for dim in self.cell.state_size]
       else:
         self.states = [K.zeros(get_tuple_shape(self.cell.state_size))]
     elif states is None:
       if hasattr(self.cell.state_size, '__len__'):
         for state, dim in zip(self.states, self.cell.state_size):
-          K.set_value(state, np.zeros(get_tuple_shape(dim),dtype=tf.float16))
+          K.set_value(state, np.zeros(get_tuple_shape(dim)))
       else:
         K.set_value(self.states[0],
                     np.zeros(get_tuple_shape(self.cell.state_size)))
@@ -0,0 +1,239 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+import utility
+
+"""
+    Estimates the parameters, FLOPs and activation memory of each layer of a model built from the usual
+        train.py arguments, and suggests the largest batch size that fits a memory budget.
+        Profiler specific arguments are passed first, all remaining arguments are the usual train.py arguments
+
+    Example of how to use
+        Per layer report, and the largest batch size for 60GB per device
+        python3 model_profiler.py -mb 60000 -mn "TRUNET" -ctsm "1979_2009_2014" -mts "{'location':['London'],'discrete_continuous':True}" -dd "./Data" -bs 16
+
+        train.py --auto_batch_size 60000 runs the same suggestion in a subprocess and trains with it
+
+    The model is run forward once on a batch of one window, recording the output shape of every layer call. Per sample estimates:
+        Params              : parameters, including nested layers
+        Fwd_MFLOPs          : 2 x (kernel weights) x (output positions) for each layer call. Products between activations,
+                                e.g. attention scores, are not counted
+        Bwd_MFLOPs          : 2 x Fwd_MFLOPs, for the gradients of the inputs and of the weights
+        Fwd_Activation_MB   : the layer's outputs, which inference holds at the layer's end
+        Bwd_Activation_MB   : the tensors kept for the backward pass, i.e. outputs of the innermost layer calls
+                                and the per timestep gates of the ConvGRUs, following --recompute
+
+    Reports are saved to './Output/model_profiles/{modelcode}.csv'
+"""
+
+# Per parameter bytes: float32 weights, gradients and the two Adam moments
+BYTES_PER_PARAM = 16
+
+# Tensors kept per timestep of a ConvGRU step, in units of the hidden state and of the step input, see layers_convgru2D.ConvGRU2DCell
+GRU_STATE_TENSORS_PER_STEP = 10
+GRU_INPUT_TENSORS_PER_STEP = 3
+
+def profile_model(t_params, m_params):
+    """Runs the model forward on one window and estimates each layer's cost per sample
+
+        Args:
+            t_params (dict): params for training
+            m_params (dict): params for model
+
+        Returns:
+            pd.DataFrame: one row per layer, in call order, with the whole model in the first row
+    """
+    # train is only imported by the profiler, since it builds the model
+    import tensorflow as tf
+    import models
+    import train
+
+    # A single window, on the mirrored strategy, so no cluster is needed
+    t_params = { **t_params, 'batch_size':1, 'strategy':'mirrored' }
+    weather_model = train.WeatherModel( t_params, m_params )
+    model = models.model_loader( t_params, m_params )
+    feature = tf.zeros( weather_model.static_shapes()[0], dtype=tf.keras.backend.floatx() )
+
+    # The first call builds any layers created in build, and caches each layer's call signature. The second is recorded
+    model( feature, True )
+
+    layers = [ layer for layer in model.submodules if isinstance(layer, tf.keras.layers.Layer) ]
+    records = { id(layer):[] for layer in layers }
+    for layer in layers:
+        _record_calls( layer, records[id(layer)] )
+
+    try:
+        model_outputs = _flatten_tensors( model( feature, True ) )
+    finally:
+        for layer in layers:
+            del layer.call
+
+    called = [ layer for layer in layers if len(records[id(layer)]) > 0 ]
+    called_descendants = { id(layer):[ sub for sub in layer.submodules if id(sub) in records and len(records[id(sub)]) > 0 ] for layer in [model] + called }
+
+    # Each layer's own cost excludes the cost of its recorded sublayers
+    own_costs = {}
+    for layer in called:
+        own_costs[id(layer)] = _own_cost( layer, records[id(layer)], called_descendants[id(layer)] )
+    own_costs[id(model)] = (0.0, 0.0)
+
+    li_records = []
+    for depth, layer in _layer_tree( model, [model] + called, called_descendants ):
+        subtree = [layer] + called_descendants[id(layer)]
+        fwd_flops = sum( own_costs[id(sub)][0] for sub in subtree )
+        bwd_bytes = sum( own_costs[id(sub)][1] for sub in subtree )
+        fwd_bytes = _output_bytes( model_outputs if layer is model else records[id(layer)][-1][1] )
+
+        li_records.append( { 'Layer':"  "*depth + layer.name, 'Class':type(layer).__name__, 'Calls':len(records.get(id(layer), [None])),
+                                'Params':int(layer.count_params()), 'Fwd_MFLOPs':fwd_flops/1e6, 'Bwd_MFLOPs':2*fwd_flops/1e6,
+                                'Fwd_Activation_MB':fwd_bytes/2**20, 'Bwd_Activation_MB':bwd_bytes/2**20 } )
+
+    return pd.DataFrame(li_records)
+
+def suggest_batch_size(df_profile, t_params, memory_budget_mb, overhead=1.5):
+    """Suggests the largest batch size whose training memory fits the budget of each device
+
+        Args:
+            df_profile (pd.DataFrame): output of profile_model
+            t_params (dict): params for training
+            memory_budget_mb (float): memory available on each device
+            overhead (float, optional): multiplier on the activation memory, for the framework's workspace and fragmentation. Defaults to 1.5.
+
+        Returns:
+            tuple: batch size, per replica batch size, fixed MB, MB per sample
+    """
+    import tensorflow as tf
+
+    # each worker of multi-worker training holds one replica, whereas the mirrored strategy splits the batch across the GPUs
+    replicas = 1 if t_params.get('strategy', 'mirrored') == 'multi_worker' else max( len(tf.config.list_physical_devices('GPU')), 1 )
+
+    fixed_mb = df_profile['Params'].iloc[0]*BYTES_PER_PARAM/2**20
+    sample_mb = df_profile['Bwd_Activation_MB'].iloc[0]*overhead
+
+    replica_batch_size = max( int( (memory_budget_mb - fixed_mb) // sample_mb ), 1 )
+    if replica_batch_size == 1 and fixed_mb + sample_mb > memory_budget_mb:
+        print("A batch of one window needs {:.0f} MB, over the budget of {:.0f} MB".format( fixed_mb + sample_mb, memory_budget_mb ))
+
+    return replica_batch_size*replicas, replica_batch_size, fixed_mb, sample_mb
+
+def auto_batch_size(train_args, memory_budget_mb):
+    """Runs the batch size suggestion in a subprocess, so that no TensorFlow state is created in the training process
+
+        Args:
+            train_args (list): training arguments
+            memory_budget_mb (float): memory available on each device
+
+        Returns:
+            int: suggested batch size
+    """
+    cmd = [ sys.executable, os.path.realpath(__file__), '-mb', str(memory_budget_mb) ] + train_args
+    result, returncode = utility.run_for_result( cmd )
+    if result == None:
+        raise RuntimeError("Model profiling failed with exit code {}".format(returncode))
+
+    return result['batch_size']
+
+def _record_calls(layer, li_records):
+    """Wraps the layer's call to record the shapes of its inputs and outputs. Removed with `del layer.call`"""
+    call = layer.call
+
+    def recorded_call(inputs, *args, **kwargs):
+        outputs = call(inputs, *args, **kwargs)
+        li_records.append( ( [ tensor.shape for tensor in _flatten_tensors(inputs) ], [ (tensor.shape, tensor.dtype.size) for tensor in _flatten_tensors(outputs) ] ) )
+        return outputs
+
+    layer.call = recorded_call
+
+def _flatten_tensors(structure):
+    import tensorflow as tf
+    return [ tensor for tensor in tf.nest.flatten(structure) if hasattr(tensor, 'shape') and hasattr(tensor, 'dtype') ]
+
+def _output_bytes(outputs):
+    """Returns the bytes of a list of (shape, dtype size), or of a list of tensors"""
+    return sum( int( np.prod(out[0]) )*out[1] if isinstance(out, tuple) else int( np.prod(out.shape) )*out.dtype.size for out in outputs )
+
+def _own_cost(layer, li_calls, called_descendants):
+    """Returns the FLOPs and backward activation bytes of a layer's calls, excluding those of its recorded sublayers
+
+        Returns:
+            tuple: (FLOPs, bytes)
+    """
+    descendant_weights = { id(weight) for sub in called_descendants for weight in sub.weights }
+    kernel_size = sum( int( np.prod(weight.shape) ) for weight in layer.trainable_weights
+                        if id(weight) not in descendant_weights and len(weight.shape) >= 2 )
+
+    flops = 0.0
+    saved_bytes = 0.0
+    for input_shapes, outputs in li_calls:
+        output_shape, dtype_size = outputs[0]
+        flops += 2*kernel_size*int( np.prod(output_shape[:-1]) )
+
+        # innermost calls keep their outputs for the backward pass
+        if len(called_descendants) == 0:
+            saved_bytes += _output_bytes(outputs)
+
+        # ConvGRUs also keep the gates of every timestep, unless these are recomputed
+        if hasattr(layer, 'cell') and hasattr(layer, 'recompute') and len(output_shape) == 5:
+            timesteps = int(output_shape[1])
+            state_size = int( np.prod(output_shape[2:]) )*dtype_size
+            input_size = int( np.prod(input_shapes[0][2:]) )*dtype_size
+
+            if layer.recompute == 'none':
+                saved_bytes += timesteps*( GRU_STATE_TENSORS_PER_STEP*state_size + GRU_INPUT_TENSORS_PER_STEP*input_size )
+            elif layer.recompute == 'step':
+                saved_bytes += timesteps*( state_size + input_size )
+
+    return flops, saved_bytes
+
+def _layer_tree(model, layers, called_descendants):
+    """Yields (depth, layer) for the model and its recorded layers, each layer followed by its direct sublayers"""
+    ids = { id(layer) for layer in layers }
+
+    def children(layer):
+        descendants = called_descendants[id(layer)]
+        nested = { id(sub) for desc in descendants for sub in called_descendants.get(id(desc), []) }
+        return [ sub for sub in descendants if id(sub) not in nested and id(sub) in ids ]
+
+    def walk(layer, depth):
+        yield depth, layer
+        for child in children(layer):
+            yield from walk(child, depth+1)
+
+    yield from walk(model, 0)
+
+if __name__ == "__main__":
+    s_dir = utility.get_script_directory(sys.argv[0])
+
+    parser = argparse.ArgumentParser(description="Receive profiler params, remaining params are passed to utility.parse_arguments", allow_abbrev=False)
+
+    parser.add_argument('-mb','--memory_budget_mb', type=float, required=False, default=0, help="memory per device in MB for the batch size suggestion, 0 for no suggestion")
+
+    parser.add_argument('-mo','--memory_overhead', type=float, required=False, default=1.5, help="multiplier on the activation memory for the framework's workspace")
+
+    profile_args, remaining_args = parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining_args
+    args_dict = utility.parse_arguments(s_dir)
+
+    t_params, m_params = utility.load_params(args_dict)
+
+    df_profile = profile_model( t_params, m_params )
+
+    f_dir = os.path.join( t_params['output_dir'], "model_profiles" )
+    os.makedirs( f_dir, exist_ok=True )
+    fp_report = os.path.join( f_dir, "{}.csv".format( utility.model_name_mkr(m_params, t_params=t_params) ) )
+    df_profile.to_csv( fp_report, index=False )
+
+    print(df_profile.to_string(index=False))
+    print("Report saved to {}".format(fp_report))
+
+    if profile_args.memory_budget_mb > 0:
+        batch_size, replica_batch_size, fixed_mb, sample_mb = suggest_batch_size( df_profile, t_params, profile_args.memory_budget_mb, profile_args.memory_overhead )
+        print("Fixed memory {:.0f} MB, {:.1f} MB per window. Largest batch size for {:.0f} MB per device: {} ({} per replica)".format(
+                    fixed_mb, sample_mb, profile_args.memory_budget_mb, batch_size, replica_batch_size ))
+        utility.print_subprocess_result( {'batch_size':batch_size, 'replica_batch_size':replica_batch_size, 'fixed_mb':fixed_mb, 'sample_mb':sample_mb} )
@@ -3,6 +3,7 @@ import tensorflow as tf
 from tensorflow.keras.layers import TimeDistributed, Conv2D, Dropout, MaxPooling2D, UpSampling2D, SpatialDropout2D, Conv2DTranspose, BatchNormalization
 import layers
 import layers_convgru2D
+import tracing
 import copy
 
 
@@ -21,6 +22,30 @@ def model_loader(t_params,m_params ):
 
     return model
 
+# Parts of a model that are frozen for fine-tuning: 'encoder' freezes the encoder, 'heads' trains only the output heads
+FREEZE_MODES = ['none', 'encoder', 'heads']
+
+def freeze_layers(model, freeze):
+    """Freezes part of a model, for fine-tuning a model warm started from another run's checkpoint.
+        Must be called before the model is built, so the optimizer only creates slots for the trainable weights
+
+        Args:
+            model (tf.keras.Model): TRUNET, HCGRU or UNET model
+            freeze (str): one of FREEZE_MODES
+    """
+    if freeze == 'none':
+        return
+    
+    groups = model.finetune_groups()
+    if freeze == 'encoder':
+        frozen = groups['encoder']
+    else:
+        head_ids = { id(layer) for layer in groups['heads'] }
+        frozen = [ layer for layer in model.layers if id(layer) not in head_ids ]
+
+    for layer in frozen:
+        layer.trainable = False
+
 class HCGRU(tf.keras.Model):
     def __init__(self, t_params, m_params):
         super(HCGRU, self).__init__()
@@ -58,13 +83,13 @@ class HCGRU(tf.keras.Model):
 
             self.output_activation = layers.CustomRelu_maker(t_params, dtype='float32')
         
-        self.new_shape1 = [0,m_params['region_grid_params']['outer_box_dims'][0], m_params['region_grid_params']['outer_box_dims'][1],  t_params['lookback_target'] ,int(6*4)]
+        self.new_shape1 = [-1,m_params['region_grid_params']['outer_box_dims'][0], m_params['region_grid_params']['outer_box_dims'][1],  t_params['lookback_target'] ,int(6*4)]
     
-    @tf.function
+    @tf.function(experimental_relax_shapes=True)
+    @tracing.counted("HCGRU.call")
     def call(self, _input, training):
         
         x = tf.transpose( _input, [0, 2,3,1,4])     # moving time axis next to channel axis
-        self.new_shape1[0] = _input.shape[0]
         x = tf.reshape( x, self.new_shape1 )        # reshape time and channel axis
         x = tf.transpose( x, [0,3,1,2,4 ] )   # converting back to bs, time, h,w, c
 
@@ -108,12 +133,20 @@ class HCGRU(tf.keras.Model):
             Produces N predictions for each given input
         """
         preds = []
-        for count in tf.range(n_preds):
+        for count in range(n_preds):
             pred = self.call( inputs, training=training ) #shape ( batch_size, output_h, output_w, 1 ) or # (pred_count, bs, seq_len, h, w)
             preds.append( pred )
         
         return preds    
 
+    def finetune_groups(self):
+        """Returns the encoder layers and the output head layers, see freeze_layers"""
+        if self.dc == False:
+            heads = [ self.conv1, self.output_conv ]
+        else:
+            heads = [ self.conv1_val, self.conv1_prob, self.output_conv_val, self.output_conv_prob ]
+        return { 'encoder':list(self.ConvGRU_layers), 'heads':heads }
+
 class TRUNET(tf.keras.Model):
     """
         TRU-NET Encoder Decoder Model
@@ -140,7 +173,8 @@ class TRUNET(tf.keras.Model):
         self.output_layer = layers.TRUNET_OutputLayer( t_params, m_params['output_layer_params'], 
                                 m_params['model_type_settings'], m_params['dropout'])
 
-    @tf.function
+    @tf.function(experimental_relax_shapes=True)
+    @tracing.counted("TRUNET.call")
     def call(self, _input, tape=None, training=False):
     
         hs_list_enc = self.encoder(_input, training=training)
@@ -153,11 +187,15 @@ class TRUNET(tf.keras.Model):
             Produces N predictions for a each input
         """
         preds = []
-        for count in tf.range(n_preds):
+        for count in range(n_preds):
             pred = self.call( inputs, training=training ) #shape ( batch_size, output_h, output_w, 1 ) or # (pred_count, bs, seq_len, h, w)
             preds.append( pred )
         return preds
 
+    def finetune_groups(self):
+        """Returns the encoder layers and the output head layers, see freeze_layers"""
+        return { 'encoder':[ self.encoder ], 'heads':[ self.output_layer ] }
+
 class UNET(tf.keras.Model):
     
     def __init__(self, t_params, m_params, **kwargs):
@@ -218,7 +256,8 @@ class UNET(tf.keras.Model):
             self.output_activation_prob = tf.keras.layers.Activation('sigmoid', dtype='float32')
     
 
-    @tf.function
+    @tf.function(experimental_relax_shapes=True)
+    @tracing.counted("UNET.call")
     def call(self, _input, training=False):
 
         x1 = self.conv2d_1(_input)
@@ -279,11 +318,16 @@ class UNET(tf.keras.Model):
             Produces N predictions for a each input
         """
         preds = []
-        for count in tf.range(n_preds):
+        for count in range(n_preds):
             # First dimension contains two if prob and pred are output
             pred = self.call( inputs, training=training ) #shape ( (2) ,batch_size, output_h, output_w, 1 )
             # new axis added for compatibility purposes
             # predict.py script was designed to work with TRUNET & HCGRU models which produce an output of shape (pred_count, bs, seq_len, h, w, 1)
             pred = tf.expand_dims( pred, axis=-4 )
             preds.append( pred )
-        return preds
\ No newline at end of file
+        return preds
+
+    def finetune_groups(self):
+        """Returns the encoder (contracting path) layers and the output head layers, see freeze_layers"""
+        encoder = [ self.conv2d_1, self.conv2d_12, self.conv2d_2, self.conv2d_22, self.conv2d_3, self.conv2d_32, self.conv2d_4, self.conv2d_42 ]
+        return { 'encoder':encoder, 'heads':[ self.conv_2d_8val, self.conv_2d_8prob ] }
@@ -1,5 +1,4 @@
 from netCDF4 import Dataset, num2date
-from tensorflow.keras.mixed_precision import experimental as mixed_precision
 #from tensorflow.python.keras.mixed_precision import experimental as mixed_precision
 import tensorflow as tf
 from data_generators import Generator_rain
@@ -27,12 +26,12 @@ import time
 
 import hparameters
 import models
+import tracing
 import utility_predict
 import utility
 import custom_losses as cl
 
 
-tf.keras.backend.set_floatx('float16')
 tf.keras.backend.set_epsilon(1e-3)
 try:
     gpu_devices = tf.config.list_physical_devices('GPU')
@@ -45,29 +44,6 @@ except Exception as e:
 for idx, gpu_name in enumerate(gpu_devices):
     tf.config.experimental.set_memory_growth(gpu_name, True)
 
-policy = mixed_precision.Policy('mixed_float16')
-mixed_precision.set_policy(policy)
-
-def is_compatible_with(self, other):
-    """Returns True if the `other` DType will be converted to this DType.
-    The conversion rules are as follows:
-    ```python
-    DType(T)       .is_compatible_with(DType(T))        == True
-    ```
-    Args:
-        other: A `DType` (or object that may be converted to a `DType`).
-    Returns:
-        True if a Tensor of the `other` `DType` will be implicitly converted to
-        this `DType`.
-    """
-    other = tf.dtypes.as_dtype(other)
-    if self._type_enum==19 and other.as_datatype_enum==1:
-        return True
-
-    return self._type_enum in (other.as_datatype_enum,
-                                other.base_dtype.as_datatype_enum)
-tf.DType.is_compatible_with = is_compatible_with
-
 try:
     import tensorflow_addons as tfa
 except Exception as e:
@@ -83,12 +59,39 @@ class TestTruNet():
         self.m_params = m_params
         self.upload_batch_number = 0
 
+        # The hidden states of a stateful model follow the batch elements' streams of windows in train.py, which the test batches do not
+        if self.m_params['model_type_settings'].get('stateful', False):
+            raise ValueError("Stateful models can not be used for prediction, since the test windows are not batched as the contiguous streams they were trained on")
+
+        # The float policy must be set before the model is created
+        utility.set_precision( self.t_params.get('precision', 'mixed_float16') )
+
         print("GPU Available: ", tf.test.is_gpu_available() )
         # retreiving model data
         self.model, checkpoint_code = utility_predict.load_model(t_params, m_params)
+        self.predict_step = self.make_predict_step()
 
         self.era5_eobs = data_generators.Era5_Eobs( self.t_params, self.m_params )
 
+    def make_predict_step(self):
+        """Returns the model's forward pass as a tf.function with the input signature of a feature batch.
+            The batch dimension is left unknown, so a partial last batch runs the same trace.
+            training is a python constant of the step: False, or True for the stochastic forward passes
+
+            Returns:
+                function: predict_step(feature), the predictions, or the stochastic predictions concatenated on the last axis
+        """
+        feature_shape = data_generators.batch_shapes( self.t_params, self.m_params )[0]
+        input_signature = [ tf.TensorSpec( [None] + feature_shape[1:], tf.keras.backend.floatx() ) ]
+
+        if self.m_params['model_type_settings']['stochastic'] == False:
+            step = lambda feature: self.model( feature, training=False )
+        else:
+            f_pass = self.m_params['model_type_settings']['stochastic_f_pass']
+            step = lambda feature: tf.concat( self.model.predict( feature, f_pass, True ), axis=-1 )
+
+        return tf.function( tracing.counted("predict_step")(step), input_signature=input_signature )
+
     def initialize_scheme_era5Eobs(self, location):
         """Initialization for the era5 and eobs datasets
 
@@ -134,8 +137,12 @@ class TestTruNet():
 
 #        os.makedirs(cache_dir, exist_ok=True)
 
-        self.ds = self.ds.cache(os.path.join(os.path.dirname(cache_dir),cache_suffix))
+        ds_range_fn = lambda first_batch, batch_count: self.era5_eobs.load_batch_range( first_batch, batch_count, self.test_batches, self.t_params['start_date'], 
+                                                    self.t_params['parallel_calls'], prefetch=0 )
+        self.ds, _ = data_generators.cache_dataset( ds_range_fn, os.path.join(os.path.dirname(cache_dir),cache_suffix), self.test_batches,
+                                                    self.t_params['cache_compression'], self.t_params['cache_memory_mb'], element_shapes=data_generators.batch_shapes(self.t_params, self.m_params) )
         
+        self.ds = data_generators.cast_features( self.ds, tf.keras.backend.floatx() )
         self.ds = self.ds.repeat(1) 
         
         self.iter_test = enumerate(self.ds)
@@ -170,7 +177,7 @@ class TestTruNet():
             
             if self.m_params['model_type_settings']['stochastic'] == False:
                     
-                preds = self.model(feature,training=False )
+                preds = self.predict_step(feature)
                 preds = tf.squeeze(preds,axis=-1)       #(bs, seq_len, h, w)
                 
                 if self.m_params['model_type_settings']['discrete_continuous'] == True:
@@ -193,8 +200,7 @@ class TestTruNet():
                     target  = target[ :, :, self.idxs_loc_in_region[0], self.idxs_loc_in_region[1]]     #(bs, seq_len, 1)
                 
             elif self.m_params['model_type_settings']['stochastic'] == True:
-                li_preds = self.model.predict( feature, self.m_params['model_type_settings']['stochastic_f_pass'], True )
-                preds = tf.concat(li_preds, axis=-1) #(bs,seq_len,h,w,samples) or #(2, bs,seq_len, h,w,samples)
+                preds = self.predict_step(feature) #(bs,seq_len,h,w,samples) or #(2, bs,seq_len, h,w,samples)
                 
                 if self.m_params['model_type_settings']['discrete_continuous'] == True:
                     preds, probs = tf.unstack( preds, axis=0)
@@ -244,6 +250,7 @@ class TestTruNet():
             pass
 
         # endregion
+        print("Traces: {}, retraces: {}".format( tracing.trace_counts(), tracing.retrace_count() ))
     
     def upload_pred(self):
 
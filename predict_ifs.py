@@ -1,6 +1,7 @@
 import netCDF4
 from netCDF4 import Dataset, num2date
 import data_generators
+import shared_cache
 import argparse
 import ast
 import datetime as dt
@@ -34,25 +35,28 @@ warnings.filterwarnings("ignore")
 """
 
 
-def main(date_start_str, date_end_str, location, data_dir="./", rain_fall_stats=False, region=False ):
+def main(date_start_str, date_end_str, location, data_dir="./", rain_fall_stats=False, region=False, frame_cache_mb=0 ):
     """
         :str date_start: start evaluation date as a string in the following format YYYY-MM-DD
         :str date_end: end evaluation date as a string in the following format YYYY-MM-DD
         :str location: Location to evaluate, pass "All to evaluate whole country
         :bool rain_fall_stats: boolean indicating whether to return statistics explaining the true rainfall of a region
+        :int frame_cache_mb: memory cap of the host-wide shared frame cache, 0 to read directly from the netCDF files
     """
     
     date_start = np.datetime64(date_start_str,'D')
     date_end = np.datetime64(date_end_str,'D')
+
+    frame_cache = shared_cache.FrameCache(frame_cache_mb) if frame_cache_mb > 0 else None
     
     #Extract the IFS Predictions for a given location and time range
     ifs_preds = ifs_pred_extractor(data_dir, date_start, date_end, location, region )
     
     #Extract the True rainfall for a given location and time range
-    true_rain, rain_mask = true_rain_extractor( data_dir, date_start, date_end, location, region )
+    true_rain, rain_mask = true_rain_extractor( data_dir, date_start, date_end, location, region, frame_cache )
 
     #Model fields extractor
-    mf = model_field_extractor(data_dir, date_start, date_end, location, region )
+    mf = model_field_extractor(data_dir, date_start, date_end, location, region, frame_cache )
 
     #Creating a list of the epoch timestamps relating to the days we study. i.e. if we tested from 1978-01-20 till 2000-03-01 
         # this would be a list such as [254102400 ,......,  951868800]
@@ -170,7 +174,7 @@ def ifs_pred_extractor( data_dir, target_start_date, target_end_date, location="
 
     return ifs_preds_24hr
 
-def true_rain_extractor(data_dir, target_start_date, target_end_date, location, region):
+def true_rain_extractor(data_dir, target_start_date, target_end_date, location, region, frame_cache=None):
     
     # Valid Date Check
     rain_start_date = np.datetime64('1979-01-01','D')
@@ -180,16 +184,23 @@ def true_rain_extractor(data_dir, target_start_date, target_end_date, location,
         
     #Extracting from NETCDF4 file 
     fn_rain_Mar =   data_dir+ "/Rain_Data_Mar20/rr_ens_mean_0.1deg_reg_v20.0e_197901-201907_uk.nc"
-    dataset_rain =  Dataset( fn_rain_Mar,'r', format="NETCDF4")
-    data_rain =     dataset_rain.variables['rr'][:]
 
     #Selecting Only relevant time period
     cut_idx_s =     np.timedelta64( target_start_date - rain_start_date, 'D' ).astype(int)
     cut_idx_e =     np.timedelta64( target_end_date - rain_start_date, 'D' ).astype(int) + 1
-    data_rain =     data_rain[cut_idx_s:cut_idx_e, :, :]
     
-    #Aligning Data. The rain data is essential upside down
-    data_rain = data_rain[:, ::-1, :]
+    if frame_cache == None:
+        dataset_rain =  Dataset( fn_rain_Mar,'r', format="NETCDF4")
+        data_rain =     dataset_rain.variables['rr'][:]
+        data_rain =     data_rain[cut_idx_s:cut_idx_e, :, :]
+    
+        #Aligning Data. The rain data is essential upside down
+        data_rain = data_rain[:, ::-1, :]
+    else:
+        #Decoded frames are already aligned
+        rain_data_gen = data_generators.Generator_rain(fp=fn_rain_Mar, frame_cache=frame_cache)
+        _data, _mask = rain_data_gen.read_frames(cut_idx_s, cut_idx_e)
+        data_rain = np.ma.masked_array( _data, mask=np.logical_not(_mask) )
         
     #Selecting location of interest
     data_rain = data_craft( data_rain, location, region)
@@ -200,7 +211,7 @@ def true_rain_extractor(data_dir, target_start_date, target_end_date, location,
     
     return data_rain, rain_mask
 
-def model_field_extractor(data_dir,target_start_date, target_end_date, location, region ):
+def model_field_extractor(data_dir,target_start_date, target_end_date, location, region, frame_cache=None ):
    # Valid Date Check
     feature_start_date = np.datetime64('1970-01-01') + np.timedelta64(78888, 'h')
     feature_end_date  = np.datetime64( feature_start_date + np.timedelta64(59900, '6h'), 'D')
@@ -216,13 +227,17 @@ def model_field_extractor(data_dir,target_start_date, target_end_date, location,
     seq_len =     np.timedelta64( target_end_date - target_start_date, '6h' ).astype(int)
     
     mf_data_gen = data_generators.Generator_mf(fp=fn_mf, vars_for_feature=vars_for_feature, 
-                all_at_once=all_at_once, seq_len=seq_len )
+                all_at_once=all_at_once, seq_len=seq_len, frame_cache=frame_cache )
     
     #Extracting dta
     mf_data_gen.start_idx = np.timedelta64(target_start_date - feature_start_date,'6h').astype(int)
     mf_data_gen.end_idx = np.timedelta64(target_end_date - feature_start_date,'6h').astype(int) + 4
 
-    mf_data = mf_data_gen()
+    if frame_cache == None:
+        mf_data = mf_data_gen()
+    else:
+        #Decoded frames, shape (time, latitude, longitude, variable)
+        mf_data = mf_data_gen.read_frames(mf_data_gen.start_idx, mf_data_gen.end_idx)[0]
     
     #Cropping spatial bounds of data t
     mf_array = data_craft(mf_data, location, region, mf=True)
@@ -275,10 +290,7 @@ def data_craft( data, location, region=False, mf=False ):
         if region==False and mf==True:
             slice_lat = slice(latitude_index,latitude_index+1)
             slice_lon = slice(longitude_index,longitude_index+1)
-            data = data.isel(latitude=slice_lat,longitude=slice_lon)
-            
-            data = data.to_array()
-            data = data.transpose('time','latitude','longitude','variable').values
+            data = crop_mf(data, slice_lat, slice_lon)
 
         elif region == True and mf==False:
             data = data[:,latitude_index-2:latitude_index+2, longitude_index-2:longitude_index+2].astype(np.float64)
@@ -286,10 +298,7 @@ def data_craft( data, location, region=False, mf=False ):
         elif region == True and mf==True:
             slice_lat = slice(latitude_index-8,latitude_index+8)
             slice_lon = slice(longitude_index-8,longitude_index+8)
-            data = data.isel(latitude=slice_lat,longitude=slice_lon)
-            
-            data = data.to_array()
-            data = data.transpose('time','latitude','longitude','variable').values
+            data = crop_mf(data, slice_lat, slice_lon)
 
     elif location == "All":
         pass
@@ -298,6 +307,16 @@ def data_craft( data, location, region=False, mf=False ):
         
     return data
 
+def crop_mf(data, slice_lat, slice_lon):
+    """Crops model field data, held either as an xarray dataset or as decoded frames from the shared frame cache"""
+    if isinstance(data, np.ndarray):
+        return data[:, slice_lat, slice_lon, :]
+    
+    data = data.isel(latitude=slice_lat,longitude=slice_lon)
+    data = data.to_array()
+    data = data.transpose('time','latitude','longitude','variable').values
+    return data
+
 def plot_ifs_preds( ifs_preds, true_val, date_start, date_end, data_dir,loc):
     """"
         Creates a plot of IFS preds against rain precipitation
@@ -351,6 +370,8 @@ if __name__ == "__main__":
     
     parser.add_argument('-rfs','--rain_fall_stats', type=bool, required=False, default=False, help="Pass True to return statistics on the true rainfall of an for the areas of interest")
 
+    parser.add_argument('-fcm','--frame_cache_mb', type=int, required=False, default=0, help="Memory cap in MB of the shared /dev/shm frame cache, shared with other jobs on this host. 0 disables the cache")
+
     args_dict = vars(parser.parse_args() )
 
     li_loc = ast.literal_eval( args_dict.pop('location') )
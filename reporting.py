@@ -0,0 +1,325 @@
+import csv
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+"""
+    Asynchronous reporting of training records. The training loop enqueues records, and a background thread
+        converts any tensors and writes them to file, so the training thread never waits on file I/O or pandas
+
+    Example of how to use
+        reporter = AsyncReporter( "log_tensboard/modelcode" )
+        reporter.scalars( {'train_loss_batch':loss_agg_batch.result()}, step )
+        reporter.write_csv( df_training_info.copy(), "checkpoints/modelcode/checkpoint_scores.csv" )
+        reporter.close()
+
+        Per variable statistics of a sampled training step, computed on the device
+        reporter.variable_stats( var_names, variable_stats(model.trainable_variables, gradients), step )
+
+        Data wait and step times of the training loop, with the prefetch buffer's depth, see PipelineMonitor
+        reporter.scalars( monitor.summary(batch_size), epoch, prefix="input_pipeline/" )
+
+    Outputs in log_dir
+        scalars.csv         : step, wall_time, tag, value
+        records.jsonl       : one json record per scalar group / histogram summary
+        variable_stats.csv  : step, wall_time, variable, and each of VARIABLE_STATS
+        events files        : TensorBoard scalars and histograms
+"""
+
+# Statistics of each variable's weights and gradients. Norms, minima and maxima are over the finite values
+VARIABLE_STATS = ['weight_norm', 'weight_min', 'weight_max', 'weight_nonfinite_frac', 'grad_norm', 'grad_min', 'grad_max', 'grad_nonfinite_frac']
+
+def variable_stats(variables, gradients):
+    """Computes the statistics of each variable and its gradient as a single tensor, so they are
+        copied from the device in one transfer. Missing gradients are treated as zero
+
+        Args:
+            variables (list): tf.Variables
+            gradients (list): gradient of each variable, or None
+
+        Returns:
+            tf.Tensor: float32, shape (len(variables), len(VARIABLE_STATS))
+    """
+    li_stats = []
+    for variable, gradient in zip(variables, gradients):
+        gradient = tf.zeros_like(variable) if gradient is None else gradient
+        li_stats.append( tf.stack( _tensor_stats(variable) + _tensor_stats(gradient) ) )
+    
+    return tf.stack( li_stats )
+
+def _tensor_stats(tensor):
+    """Returns the norm, min, max and non-finite fraction of a tensor"""
+    tensor = tf.cast( tf.convert_to_tensor(tensor), tf.float32 )
+    finite = tf.math.is_finite(tensor)
+
+    return [ tf.norm( tf.where(finite, tensor, 0.0) ), tf.reduce_min( tf.where(finite, tensor, np.inf) ), 
+                tf.reduce_max( tf.where(finite, tensor, -np.inf) ), 1.0 - tf.reduce_mean( tf.cast(finite, tf.float32) ) ]
+
+class AsyncReporter():
+    """Queues records from the training loop and writes them from a background thread
+    """
+
+    def __init__(self, log_dir, max_queue_size=10000):
+        """
+            Args:
+                log_dir (str): directory for the csv, jsonl and TensorBoard outputs
+                max_queue_size (int, optional): records are dropped, instead of blocking training, once this many are waiting. Defaults to 10000.
+        """
+        self.log_dir = log_dir
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self._run, name="AsyncReporter", daemon=True)
+        self.thread.start()
+
+    # region --- training thread methods
+    def scalars(self, dict_scalars, step, prefix=""):
+        """Enqueues a group of scalars. Values may be tensors, they are converted on the writer thread
+
+            Args:
+                dict_scalars (dict): name: value
+                step (int): training step
+                prefix (str, optional): prefix for the names, e.g. 'time/'. Defaults to "".
+        """
+        self._put( ('scalars', { prefix+name:value for name, value in dict_scalars.items() }, step, time.time()) )
+
+    def timings(self, dict_timings, step):
+        """Enqueues a group of timings in seconds"""
+        self.scalars(dict_timings, step, prefix="time/")
+
+    def histograms(self, dict_tensors, step):
+        """Enqueues histograms, written to TensorBoard, with summary statistics written to the jsonl records
+            Variables should be passed as a snapshot (e.g. tf.identity(var)) since they are read later
+
+            Args:
+                dict_tensors (dict): name: tensor
+                step (int): training step
+        """
+        self._put( ('histograms', dict_tensors, step, time.time()) )
+
+    def variable_stats(self, var_names, stats, step):
+        """Enqueues per variable statistics, written to variable_stats.csv, with a summary written as scalars:
+            the global gradient norm, and the numbers of variables with non-finite gradients and with zero gradients
+
+            Args:
+                var_names (list): variable names
+                stats (tf.Tensor): output of variable_stats, converted on the writer thread
+                step (int): training step
+        """
+        self._put( ('variable_stats', var_names, stats, step, time.time()) )
+
+    def write_csv(self, df, fp):
+        """Enqueues a DataFrame to be written to csv. Pass a copy if the DataFrame is modified afterwards
+
+            Args:
+                df (pd.DataFrame): dataframe to save
+                fp (str): filepath
+        """
+        self._put( ('csv', df, fp, time.time()) )
+
+    def flush(self):
+        """Blocks until all enqueued records are written"""
+        self.queue.join()
+
+    def close(self):
+        """Writes all enqueued records and stops the writer thread"""
+        self.queue.put( None )
+        self.thread.join()
+        if self.dropped > 0:
+            print("AsyncReporter: {} records dropped while the queue was full".format(self.dropped))
+    # endregion
+
+    # region --- writer thread methods
+    def _put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        writer = tf.summary.create_file_writer( self.log_dir )
+        self.f_stats = None
+        fp_csv = os.path.join(self.log_dir, "scalars.csv")
+        new_csv = not os.path.exists(fp_csv)
+
+        with open(fp_csv, "a", newline="") as f_csv, open(os.path.join(self.log_dir, "records.jsonl"), "a") as f_jsonl:
+            csv_writer = csv.writer(f_csv)
+            if new_csv:
+                csv_writer.writerow( ['step', 'wall_time', 'tag', 'value'] )
+
+            while True:
+                record = self.queue.get()
+                if record == None:
+                    self.queue.task_done()
+                    break
+
+                try:
+                    self._write(record, writer, csv_writer, f_jsonl)
+                except Exception as e:
+                    print("AsyncReporter: failed to write {} record: {}".format(record[0], e))
+                finally:
+                    self.queue.task_done()
+
+                # flushing when the training thread has no more records waiting
+                if self.queue.empty():
+                    f_csv.flush()
+                    f_jsonl.flush()
+                    writer.flush()
+                    if self.f_stats != None:
+                        self.f_stats.flush()
+
+        writer.close()
+        if self.f_stats != None:
+            self.f_stats.close()
+
+    def _write(self, record, writer, csv_writer, f_jsonl):
+        kind = record[0]
+
+        if kind == 'scalars':
+            _, dict_scalars, step, wall_time = record
+            dict_scalars = { name:float(np.asarray(value)) for name, value in dict_scalars.items() }
+
+            with writer.as_default():
+                for name, value in dict_scalars.items():
+                    tf.summary.scalar( name, value, step=step )
+                    csv_writer.writerow( [step, wall_time, name, value] )
+
+            f_jsonl.write( json.dumps( {'kind':kind, 'step':step, 'wall_time':wall_time, **dict_scalars} ) + "\n" )
+
+        elif kind == 'histograms':
+            _, dict_tensors, step, wall_time = record
+
+            with writer.as_default():
+                for name, tensor in dict_tensors.items():
+                    values = np.asarray(tensor, dtype=np.float32)
+                    tf.summary.histogram( name, values, step=step )
+                    f_jsonl.write( json.dumps( {'kind':kind, 'step':step, 'wall_time':wall_time, 'name':name,
+                                        'mean':float(values.mean()), 'std':float(values.std()), 'min':float(values.min()), 'max':float(values.max()) } ) + "\n" )
+
+        elif kind == 'variable_stats':
+            _, var_names, stats, step, wall_time = record
+            stats = np.asarray(stats, dtype=np.float64)
+
+            # opened on first use, since statistics are optional
+            if self.f_stats == None:
+                fp_stats = os.path.join(self.log_dir, "variable_stats.csv")
+                new_stats = not os.path.exists(fp_stats)
+                self.f_stats = open(fp_stats, "a", newline="")
+                self.stats_writer = csv.writer(self.f_stats)
+                if new_stats:
+                    self.stats_writer.writerow( ['step', 'wall_time', 'variable'] + VARIABLE_STATS )
+
+            for name, var_stats in zip(var_names, stats):
+                self.stats_writer.writerow( [step, wall_time, name] + var_stats.tolist() )
+
+            grad_norm = stats[:, VARIABLE_STATS.index('grad_norm')]
+            grad_nonfinite = stats[:, VARIABLE_STATS.index('grad_nonfinite_frac')]
+            dict_summary = { 'stats/global_grad_norm':float(np.sqrt(np.sum(grad_norm**2))), 'stats/nonfinite_grad_variables':float(np.sum(grad_nonfinite > 0)),
+                                'stats/zero_grad_variables':float(np.sum( (grad_norm == 0) & (grad_nonfinite == 0) )),
+                                'stats/max_abs_weight':float(np.max( np.abs( stats[:, [VARIABLE_STATS.index('weight_min'), VARIABLE_STATS.index('weight_max')]] ) )) }
+            self._write( ('scalars', dict_summary, step, wall_time), writer, csv_writer, f_jsonl )
+
+        elif kind == 'csv':
+            _, df, fp, _ = record
+            df.to_csv( path_or_buf=fp, header=True, index=False )
+    # endregion
+
+# region --- input pipeline telemetry
+# Fraction of the training loop's time spent waiting for batches, above which an epoch is input-bound
+INPUT_BOUND_WAIT_FRACTION = 0.1
+
+class PipelineMonitor():
+    """Separates the training loop's time waiting for batches from the time of its steps, and samples the 
+        number of batches waiting in the prefetch buffer, to tell whether training is input-bound or compute-bound
+
+        Example of how to use
+            ds = monitor.count_produced( ds ).prefetch( tf.data.experimental.AUTOTUNE )
+            monitor.start_epoch()
+            feature, target, mask = monitor.next( iterator )    # a single step's batch
+            monitor.draw( 4 )                                   # batches drawn inside a multi-step call
+            monitor.summary( batch_size )
+
+        Batches drawn inside a multi-step call can not be timed, so with steps_per_execution > 1 the verdict 
+            also counts the blocks which started with an empty prefetch buffer
+    """
+
+    def __init__(self):
+        # counted on the host as each batch enters the prefetch buffer
+        with tf.device("/cpu:0"):
+            self.produced = tf.Variable( 0, dtype=tf.int64, trainable=False, name="batches_produced" )
+        self.start_epoch()
+
+    def count_produced(self, ds):
+        """Counts the batches of ds as they are produced. Applied directly before the dataset's prefetch"""
+        def count(*element):
+            with tf.control_dependencies( [ self.produced.assign_add(1) ] ):
+                return tuple( tf.identity(tensor) for tensor in element )
+        return ds.map( count )
+
+    def start_epoch(self):
+        """Resets the records, before the epoch's iterator is made"""
+        self.produced.assign(0)
+        self.consumed = 0
+        self.li_depths = []
+        self.wait_time = 0.0
+        self.excluded_time = 0.0
+        self.start_time = time.time()
+
+        self.group_wait_time = 0.0
+        self.group_start_time = self.start_time
+
+    def next(self, iterator):
+        """Returns the next batch of iterator, timing the wait for it"""
+        self._sample_depth()
+        start_time = time.time()
+        element = next(iterator)
+        wait_time = time.time() - start_time
+
+        self.wait_time += wait_time
+        self.group_wait_time += wait_time
+        self.consumed += 1
+        return element
+
+    def draw(self, batch_count):
+        """Records batch_count batches drawn from the iterator inside a multi-step call"""
+        self._sample_depth()
+        self.consumed += batch_count
+
+    def exclude(self, seconds):
+        """Removes time spent on other work within the training loop, e.g. validation, from the step time"""
+        self.excluded_time += seconds
+
+    def group_wait(self):
+        """Returns the time waiting for batches since the last call, and resets it"""
+        wait_time, self.group_wait_time = self.group_wait_time, 0.0
+        return wait_time
+
+    def summary(self, batch_size):
+        """Returns the epoch's data wait and step times, prefetch buffer depth, throughput, and verdict
+
+            Args:
+                batch_size (int): windows per batch
+
+            Returns:
+                dict: data_wait_s, step_s, data_wait_frac, prefetch_depth_mean, prefetch_empty_frac, batches_per_s, windows_per_s, input_bound
+        """
+        loop_time = max( time.time() - self.start_time - self.excluded_time, 1e-9 )
+        depths = np.array( self.li_depths if len(self.li_depths) > 0 else [0] )
+        empty_frac = float( np.mean(depths <= 0) )
+        wait_frac = self.wait_time / loop_time
+
+        return { 'data_wait_s':self.wait_time, 'step_s':loop_time - self.wait_time, 'data_wait_frac':wait_frac, 
+                    'prefetch_depth_mean':float( np.mean(depths) ), 'prefetch_empty_frac':empty_frac,
+                    'batches_per_s':self.consumed/loop_time, 'windows_per_s':self.consumed*batch_size/loop_time,
+                    'input_bound':float( wait_frac >= INPUT_BOUND_WAIT_FRACTION or empty_frac > 0.5 ) }
+
+    def _sample_depth(self):
+        self.li_depths.append( int( self.produced.numpy() ) - self.consumed )
+# endregion
@@ -0,0 +1,300 @@
+import atexit
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+"""
+    Host-wide cache of decoded data frames, shared between concurrent processes (training, predict.py,
+        predict_ifs.py, hypertuning trials) through a tmpfs directory.
+
+    Example of how to use
+        frame_cache = FrameCache( max_mb=4096 )
+        rain_gen = Generator_rain( fp=fn, frame_cache=frame_cache )
+
+    Layout of cache_dir
+        index.json          : { key: {'nbytes':int, 'last_used':float} }
+        index.lock          : lock file, all updates of index.json happen under an exclusive flock.
+                                index.json is replaced in one step, so lookups read it without the lock
+        <key>.data.npy      : decoded data for one block of frames. Each reference to the block holds a shared flock on this file
+        <key>.mask.npy      : mask for one block of frames
+
+    Lookups do not write the index. Each process keeps the times it used blocks in memory, and merges them into
+        the index when it adds a block, the only time blocks are evicted, and when it exits.
+        References are counted by the kernel as the shared flocks on the blocks' data files, so they are dropped
+        when a process exits, and a block is only evicted under an exclusive flock, i.e. once no process references it
+"""
+
+class FrameCache():
+    """Reference counted, LRU evicted store of decoded (data, mask) blocks of frames
+
+        Blocks are referenced by a process while it copies frames out of them. Only unreferenced blocks are evicted,
+            least recently used first, whenever a new block would take the cache above max_mb, so the bytes of
+            every block still in use are in the index and counted against max_mb
+    """
+
+    def __init__(self, max_mb, cache_dir="/dev/shm/trunet_frame_cache"):
+        """
+            Args:
+                max_mb (int): memory cap for the cache in MB. This is enforced by the process adding a block
+                cache_dir (str, optional): directory holding the cache. Should be on a tmpfs mount. Defaults to "/dev/shm/trunet_frame_cache".
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int( max_mb * 2**20 )
+        self.pid = str( os.getpid() )
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.fp_index = os.path.join(self.cache_dir, "index.json")
+        self.fp_lock = os.path.join(self.cache_dir, "index.lock")
+
+        self.file_ids = {}
+        # key: file descriptors of this process's references to a block, each holding a shared flock. See _acquire
+        self.refs = {}
+        # last use times of blocks, see _sync
+        self.last_used = {}
+        # the parsed index, and the identity of the index file it was read from
+        self.index = {}
+        self.index_id = None
+        self.hits = 0
+        self.misses = 0
+
+        atexit.register(self.release_all)
+
+    def key(self, fp, tag, block_idx, block_len):
+        """Returns the key of a block of frames
+
+            Args:
+                fp (str): filepath of the source file
+                tag (str): description of the decoding, e.g. the variables extracted
+                block_idx (int): index of the block within the source file
+                block_len (int): number of frames per block
+
+            Returns:
+                str: key for the block
+        """
+        if fp not in self.file_ids:
+            # source file identity, so a modified or different copy of a file never matches
+            stat = os.stat(fp)
+            self.file_ids[fp] = "{}_{}_{}".format( os.path.realpath(fp), stat.st_size, stat.st_mtime_ns )
+
+        _str = "{}_{}_{}_{}".format( self.file_ids[fp], tag, block_len, block_idx )
+        return hashlib.md5(_str.encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached block and adds a reference to it from this process.
+            The reference must be dropped with release(key) once the frames have been copied out
+
+            Args:
+                key (str): key of block
+
+            Returns:
+                tuple: (data, mask) read only memory mapped arrays, or None if the block is not cached
+        """
+        fd = self._acquire(key) if key in self._read_index() else None
+        if fd == None:
+            self.misses += 1
+            return None
+
+        try:
+            data = np.load( self._segment_fp(key, 'data'), mmap_mode='r' )
+            mask = np.load( self._segment_fp(key, 'mask'), mmap_mode='r' )
+        except (FileNotFoundError, ValueError):
+            os.close(fd)
+            self.misses += 1
+            return None
+
+        self.refs.setdefault(key, []).append(fd)
+        self.last_used[key] = time.time()
+        self.hits += 1
+        return data, mask
+
+    def put(self, key, data, mask):
+        """Adds a block to the cache, evicting unreferenced blocks if needed
+
+            Args:
+                key (str): key of block
+                data (np.ndarray): decoded data
+                mask (np.ndarray): mask
+
+            Returns:
+                bool: True if the block is in the cache after the call
+        """
+        nbytes = data.nbytes + mask.nbytes
+        if nbytes > self.max_bytes:
+            return False
+
+        # Segment files are written outside the lock, then moved into place
+        li_fp_tmp = []
+        for name, arr in [ ('data',data), ('mask',mask) ]:
+            fp_tmp = self._segment_fp(key, name) + ".{}.tmp".format(self.pid)
+            with open(fp_tmp, "wb") as f:
+                np.save(f, arr)
+            li_fp_tmp.append(fp_tmp)
+
+        with self._locked_index() as index:
+            self._sync(index)
+            if key in index or not self._evict(index, nbytes):
+                # another process cached this block first, or the cache is full of referenced blocks
+                for fp_tmp in li_fp_tmp:
+                    os.remove(fp_tmp)
+                return key in index
+
+            for name, fp_tmp in zip( ['data','mask'], li_fp_tmp ):
+                os.replace( fp_tmp, self._segment_fp(key, name) )
+            index[key] = { 'nbytes':nbytes, 'last_used':time.time() }
+
+        return True
+
+    def release(self, key):
+        """Drops one reference to a block from this process
+
+            Args:
+                key (str): key of block
+        """
+        if key not in self.refs:
+            return
+        os.close( self.refs[key].pop() )
+        if len(self.refs[key]) == 0:
+            self.refs.pop(key)
+
+    def release_all(self):
+        """Drops all references held by this process, and saves its last use times of blocks to the index"""
+        for li_fds in self.refs.values():
+            for fd in li_fds:
+                os.close(fd)
+        self.refs = {}
+        if len(self.last_used) == 0 or not os.path.exists(self.fp_lock):
+            return
+        with self._locked_index() as index:
+            self._sync(index)
+
+    # region --- internal helpers
+    def _segment_fp(self, key, name):
+        return os.path.join(self.cache_dir, "{}.{}.npy".format(key, name))
+
+    def _acquire(self, key):
+        """Takes a shared flock on a block's data file, for one reference to the block
+
+            Returns:
+                int: file descriptor holding the flock, or None if the block has been evicted
+        """
+        fp = self._segment_fp(key, 'data')
+        try:
+            fd = os.open(fp, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        fcntl.flock(fd, fcntl.LOCK_SH)
+
+        # the file may have been evicted, or evicted and cached again, between opening it and taking the flock
+        try:
+            current = os.fstat(fd).st_ino == os.stat(fp).st_ino
+        except FileNotFoundError:
+            current = False
+        if not current:
+            os.close(fd)
+            return None
+        return fd
+
+    def _read_index(self):
+        """Returns the index without taking the lock. The file is only parsed again once another process has replaced it"""
+        try:
+            stat = os.stat(self.fp_index)
+        except FileNotFoundError:
+            return {}
+
+        index_id = (stat.st_ino, stat.st_mtime_ns)
+        if index_id != self.index_id:
+            try:
+                with open(self.fp_index, "r") as f:
+                    self.index = json.load(f)
+            except FileNotFoundError:
+                return {}
+            self.index_id = index_id
+        return self.index
+
+    def _sync(self, index):
+        """Merges this process's last use times of blocks into the index
+
+            Args:
+                index (dict): index, must be held under the lock
+        """
+        for key, last_used in self.last_used.items():
+            if key in index:
+                index[key]['last_used'] = max( index[key]['last_used'], last_used )
+        self.last_used = {}
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """Yields the index dictionary under an exclusive lock, and writes it back on exit"""
+        with open(self.fp_lock, "a") as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.fp_index):
+                    with open(self.fp_index, "r") as f:
+                        index = json.load(f)
+                else:
+                    index = {}
+
+                yield index
+
+                fp_tmp = self.fp_index + ".{}.tmp".format(self.pid)
+                with open(fp_tmp, "w") as f:
+                    json.dump(index, f)
+                os.replace(fp_tmp, self.fp_index)
+            finally:
+                fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+    def _evict(self, index, nbytes):
+        """Removes unreferenced blocks, least recently used first, until nbytes can be added under the cap.
+            A block is unreferenced if an exclusive flock on its data file can be taken
+
+            Args:
+                index (dict): index, must be held under the lock
+                nbytes (int): size of block to be added
+
+            Returns:
+                bool: True if there is now space for the block
+        """
+        used = sum( entry['nbytes'] for entry in index.values() )
+        if used + nbytes <= self.max_bytes:
+            return True
+
+        for key in sorted( index.keys(), key=lambda key: index[key]['last_used'] ):
+            if used + nbytes <= self.max_bytes:
+                break
+            if not self._remove_unreferenced(key):
+                continue
+            used -= index.pop(key)['nbytes']
+
+        return used + nbytes <= self.max_bytes
+
+    def _remove_unreferenced(self, key):
+        """Removes a block's files if no process references it
+
+            Returns:
+                bool: True if the block's files were removed, or were already missing
+        """
+        try:
+            fd = os.open( self._segment_fp(key, 'data'), os.O_RDONLY )
+        except FileNotFoundError:
+            fd = None
+
+        try:
+            if fd != None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            for name in ['data','mask']:
+                try:
+                    os.remove( self._segment_fp(key, name) )
+                except FileNotFoundError:
+                    pass
+        except BlockingIOError:
+            return False
+        finally:
+            if fd != None:
+                os.close(fd)
+        return True
+    # endregion
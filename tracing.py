@@ -0,0 +1,95 @@
+import collections
+import contextlib
+
+import tensorflow as tf
+from tensorflow.python.util import tf_decorator
+
+"""
+    Trace counting for tf.functions. Each trace of a counted function runs its python body, which records the trace.
+        A retrace is a trace whose python arguments match an earlier trace of the function, so that it was only caused
+        by new tensor shapes or dtypes, e.g. a partial last batch. Retraces are logged with the signature that caused them
+
+    Example of how to use
+        @tf.function
+        @tracing.counted("HCGRU.call")
+        def call(self, _input, training):
+            ...
+
+        tracing.trace_counts()      # {'HCGRU.call': 2}
+        tracing.retrace_count()     # 0
+
+    Counts are kept for the process, and summed over all instances of a counted method.
+        Traces made within tracing.uncounted(), e.g. building a model's variables, are not recorded
+"""
+
+# name: list of (python arguments, tensor signature) of each trace
+TRACES = collections.defaultdict(list)
+
+# depth of nested uncounted() blocks
+_UNCOUNTED_DEPTH = [0]
+
+@contextlib.contextmanager
+def uncounted():
+    """Context in which traces are not recorded, so they are neither counted nor compared against by later traces"""
+    _UNCOUNTED_DEPTH[0] += 1
+    try:
+        yield
+    finally:
+        _UNCOUNTED_DEPTH[0] -= 1
+
+def counted(name):
+    """Decorator recording each trace of a function, to be applied beneath tf.function
+
+        Args:
+            name (str): name of the function in the trace counts
+
+        Returns:
+            function: decorator
+    """
+    def decorator(fn):
+        def wrapper(*args, **kwargs):
+            if _UNCOUNTED_DEPTH[0] > 0:
+                return fn(*args, **kwargs)
+
+            python_args, tensor_signature = _describe( list(args) + [ kwargs[key] for key in sorted(kwargs) ] )
+            li_traces = TRACES[name]
+
+            if _is_retrace( li_traces, python_args, tensor_signature ):
+                print("Warning: retracing {} (trace {}) for new input shapes {}".format( name, len(li_traces)+1, tensor_signature ))
+            li_traces.append( (python_args, tensor_signature) )
+
+            return fn(*args, **kwargs)
+
+        # the wrapped function's argspec is kept, since Keras inspects the arguments of a layer's call
+        return tf_decorator.make_decorator( fn, wrapper )
+    return decorator
+
+def trace_counts():
+    """Returns the number of traces of each counted function"""
+    return { name:len(li_traces) for name, li_traces in TRACES.items() }
+
+def retrace_count():
+    """Returns the number of retraces of all counted functions"""
+    return sum( _is_retrace( li_traces[:idx], python_args, tensor_signature ) for li_traces in TRACES.values()
+                    for idx, (python_args, tensor_signature) in enumerate(li_traces) )
+
+def _is_retrace(li_traces, python_args, tensor_signature):
+    """Returns True if earlier traces had the same python arguments, but none had this tensor signature"""
+    li_signatures = [ prev_signature for prev_python_args, prev_signature in li_traces if prev_python_args == python_args ]
+    return len(li_signatures) > 0 and tensor_signature not in li_signatures
+
+def _describe(args):
+    """Splits the arguments of a trace into the reprs of the python arguments and the shapes and dtypes of the tensors"""
+    python_args = []
+    tensor_signature = []
+    for arg in tf.nest.flatten( args ):
+        if hasattr(arg, 'shape') and hasattr(arg, 'dtype'):
+            tensor_signature.append( "{}{}".format( arg.dtype.name, arg.shape.as_list() if arg.shape.rank != None else "[?]" ) )
+        elif hasattr(arg, 'element_spec'):
+            tensor_signature.append( str(arg.element_spec) )
+        elif hasattr(arg, 'values') and isinstance( getattr(arg, 'values'), tuple ):
+            # distributed values, e.g. PerReplica
+            tensor_signature.append( _describe( list(arg.values) )[1] )
+        else:
+            python_args.append( repr(arg) )
+    return tuple(python_args), tuple( str(sig) for sig in tensor_signature )
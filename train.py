@@ -5,9 +5,11 @@ os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
 import argparse
 import ast
 import gc
+import hashlib
+import json
 import logging
 import math
-
+import socket
 import sys
 import time
 
@@ -17,19 +19,25 @@ import psutil
 
 import tensorflow as tf
 from tensorflow.keras.mixed_precision import experimental as mixed_precision
+from tensorflow.python.distribute import values as distribute_values
 
 try:
     import tensorflow_addons as tfa
 except Exception as e:
     tfa = None
 
+import benchmarks
 import data_generators
+import checkpointing
 import custom_losses as cl
 import hparameters
+import model_profiler
 import models
+import reporting
+import tracing
 import utility
+import window_sampler
 
-tf.keras.backend.set_floatx('float16')
 tf.keras.backend.set_epsilon(1e-3)
 
 try:
@@ -37,30 +45,6 @@ try:
 except Exception as e:
     gpu_devices = tf.config.experimental.list_physical_devices('GPU')
 
-policy = mixed_precision.Policy('mixed_float16')
-mixed_precision.set_policy(policy)
-
-def is_compatible_with(self, other):
-    """Returns True if the `other` DType will be converted to this DType.
-    Monkey patch: incompatibility issues between tfa.optimizers and mixed precision training
-    The conversion rules are as follows:
-    ```python
-    DType(T)       .is_compatible_with(DType(T))        == True
-    ```
-    Args:
-        other: A `DType` (or object that may be converted to a `DType`).
-    Returns:
-        True if a Tensor of the `other` `DType` will be implicitly converted to
-        this `DType`.
-    """
-    other = tf.dtypes.as_dtype(other)
-    if self._type_enum==19 and other.as_datatype_enum==1:
-        return True
-
-    return self._type_enum in (other.as_datatype_enum,
-                                other.base_dtype.as_datatype_enum)
-tf.DType.is_compatible_with = is_compatible_with
-
 class WeatherModel():
     """Handles the Training of the Deep Learning Weather model
 
@@ -74,14 +58,96 @@ class WeatherModel():
         """
         self.t_params = t_params
         self.m_params = m_params
+
+        # The float policy must be set before any model is created. Loss scaling is only needed for float16 compute
+        self.loss_scaling = utility.set_precision( self.t_params.get('precision', 'mixed_float16') )
+
+        # Thread pools must be sized before the TensorFlow runtime is initialized
+        if self.t_params.get('intra_op_threads', 0) > 0:
+            tf.config.threading.set_intra_op_parallelism_threads( self.t_params['intra_op_threads'] )
+        if self.t_params.get('inter_op_threads', 0) > 0:
+            tf.config.threading.set_inter_op_parallelism_threads( self.t_params['inter_op_threads'] )
+
+        # The multi-worker strategy must be created before any other TensorFlow op. The cluster is read from TF_CONFIG, see launch_workers.py
+        if self.t_params.get('strategy', 'mirrored') == 'multi_worker':
+            self.worker_idx, self.worker_count = utility.worker_info()
+            self.strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+        else:
+            self.worker_idx, self.worker_count = 0, 1
+            self.strategy = tf.distribute.MirroredStrategy( )
+        self.t_params['worker_idx'] = self.worker_idx
+        self.t_params['worker_count'] = self.worker_count
+
+        # Stateful truncated BPTT: hidden states are carried across consecutive windows of a location
+        self.stateful = self.m_params['model_type_settings'].get('stateful', False)
+
+        # Gradient accumulation: the optimizer is applied once every grad_accum batches, to the mean of their gradients
+        self.grad_accum = self.t_params.get('grad_accum', 1)
+        # The batch checkpoint does not hold the gradient accumulators, so it is only saved when they are empty
+        if self.t_params.get('ckpt_batch_freq', 0) % self.grad_accum != 0:
+            raise ValueError("ckpt_batch_freq ({}) must be a multiple of grad_accum ({}), so that batch checkpoints fall between optimizer updates".format( 
+                                self.t_params['ckpt_batch_freq'], self.grad_accum ))
+
+        # Training batches between samples of the per variable weight and gradient statistics, 0 for none
+        self.stats_freq = self.t_params.get('stats_freq', 0)
+        self.var_names = None
+
+        # Data wait, step time and prefetch buffer depth of the training loop, for each epoch's input-bound or compute-bound verdict
+        self.input_monitor = reporting.PipelineMonitor()
+
+        # Step functions with fixed input signatures, one for each set of python arguments, see step_function
+        self.step_functions = {}
         
-    def initialize_scheme_era5Eobs(self):
+    def initialize_scheme_era5Eobs(self, evaluator=False):
         """Initialization scheme for the ERA5 and E-OBS datasets.
             This method creates the datasets
+
+            Args:
+                evaluator (bool, optional): initializes for the sidecar evaluator, see evaluator.py. No checkpoint is restored, 
+                    since the evaluator restores each candidate checkpoint itself. Defaults to False.
         """        
         # region ---- Parameters  related to training length and training reporting frequency 
         era5_eobs = data_generators.Era5_Eobs( self.t_params, self.m_params)
 
+        # With the sidecar evaluator, validation, checkpoint selection and early stopping run in a separate process
+        self.sidecar_eval = self.t_params.get('sidecar_eval', False)
+        if self.sidecar_eval and self.t_params.get('val_every', 0) > 0:
+            raise ValueError("sidecar_eval can not be used with val_every")
+
+        # Stateful training needs each batch element to see the windows of one stream in date order, on a single replica
+        if self.stateful:
+            if self.strategy.num_replicas_in_sync > 1:
+                raise ValueError("Stateful training is only supported on a single replica, found {}".format(self.strategy.num_replicas_in_sync))
+            if len( self.t_params.get('importance_sampling_weights', {}) ) > 0 or self.t_params.get('val_every', 0) > 0:
+                raise ValueError("Stateful training can not be used with importance_sampling_weights or val_every, since both reorder the windows")
+
+        # Windows pre-processed once for several splits by kfold.py, of which this run selects its split's windows
+        self.window_store = self.t_params.get('window_store', "")
+        if self.window_store != "" and self.stateful:
+            raise ValueError("Stateful training can not be used with window_store, since the store holds the windows in date order")
+
+        # Multi-worker training: each worker only reads its own shard of the training and validation windows
+            # Stateful training: the windows are reordered into batch_size interleaved streams
+            # Window store: the windows of the split are selected from the store
+        if self.worker_count > 1 or self.stateful or self.window_store != "":
+            dates_str = self.t_params['ctsm'].split("_")
+            
+            for key, date_range in [ ('train', dates_str[0:2]), ('val', dates_str[1:3]) ]:
+                window_dates = self.t_params[key+'_window_dates']
+                if window_dates is None:
+                    window_dates = hparameters.window_dates_mkr( [date_range], self.t_params['window_shift'] )
+                
+                if self.worker_count > 1:
+                    window_dates = era5_eobs.shard_windows( window_dates, self.worker_idx, self.worker_count )
+                if self.stateful:
+                    window_dates = era5_eobs.stream_order( window_dates, self.t_params['batch_size'] )
+
+                self.t_params[key+'_window_dates'] = window_dates
+                self.t_params[key+'_batches'] = len(self.t_params[key+'_window_dates']) // self.t_params['batch_size']
+            
+            if self.worker_count > 1:
+                print("Worker {} of {}: {} training windows".format(self.worker_idx, self.worker_count, len(self.t_params['train_window_dates'])))
+
         # hparameters files calculates train_batches assuing we are only evaluating one location, 
             # therefore we must adjust got multiple locations (loc_count)
         self.t_params['train_batches'] = int(self.t_params['train_batches'] * era5_eobs.loc_count)
@@ -95,7 +161,7 @@ class WeatherModel():
         # region ---- Restoring/Creating New Training Records and Restoring training progress
             #This training records keeps track of the losses on each epoch
         try:
-            self.df_training_info = pd.read_csv( "checkpoints/{}/checkpoint_scores.csv".format(utility.model_name_mkr(m_params,t_params=self.t_params,htuning=m_params.get('htuning',False))), header=0, index_col=False) 
+            self.df_training_info = pd.read_csv( "checkpoints/{}/checkpoint_scores.csv".format(utility.model_name_mkr(self.m_params,t_params=self.t_params,htuning=self.m_params.get('htuning',False))), header=0, index_col=False) 
             self.df_training_info = self.df_training_info[['Epoch','Train_loss','Train_mse','Val_loss','Val_mse','Checkpoint_Path','Last_Trained_Batch']]
             self.start_epoch =  int(max([self.df_training_info['Epoch'][0]], default=0))
             last_batch = int( self.df_training_info.loc[self.df_training_info['Epoch']==self.start_epoch,'Last_Trained_Batch'].iloc[0] )
@@ -118,75 +184,176 @@ class WeatherModel():
         devices = tf.config.get_visible_devices() #tf.config.experimental.list_physical_devices('GPU')
         #gpus_names = [ device.name for device in devices if  device.device_type == "GPU" ]
         #self.strategy = tf.distribute.MirroredStrategy( devices=gpus_names ) #OneDeviceStrategy(device="/GPU:0") # 
-        self.strategy = tf.distribute.MirroredStrategy( )
-        assert self.t_params['batch_size'] % self.strategy.num_replicas_in_sync  == 0
-        print("Number of Devices used in MirroredStrategy: {}".format(self.strategy.num_replicas_in_sync))
-        with self.strategy.scope():   
-            #Model
-            self.strategy_gpu_count = self.strategy.num_replicas_in_sync    
-            self.t_params['gpu_count'] = self.strategy.num_replicas_in_sync    
-            self.model = models.model_loader( self.t_params, self.m_params )
-            
-            #Optimizer
-            optimizer = tfa.optimizers.RectifiedAdam( **self.m_params['rec_adam_params'], total_steps=self.t_params['train_batches']*20) 
-
-            self.optimizer = mixed_precision.LossScaleOptimizer( optimizer, loss_scale=tf.mixed_precision.experimental.DynamicLossScale() ) 
-                    
-            # These objects will aggregate losses and metrics across batches and epochs
-            self.loss_agg_batch = tf.keras.metrics.Mean(name='loss_agg_batch' )
-            self.loss_agg_epoch = tf.keras.metrics.Mean(name="loss_agg_epoch")
-
-            self.mse_agg_epoch = tf.keras.metrics.Mean(name='mse_agg_epoch')
-            
-            self.loss_agg_val = tf.keras.metrics.Mean(name='loss_agg_val')
-            self.mse_agg_val = tf.keras.metrics.Mean(name='mse_agg_val')
+        # For multi-worker training, batch_size is the per worker batch size
+        self.initialize_model()
             
         #checkpoints  (For Epochs)
             #The CheckpointManagers can be called to serializae the weights within TRUNET
-        checkpoint_path_epoch = "./checkpoints/{}/epoch".format(utility.model_name_mkr(m_params,t_params=self.t_params, htuning=m_params.get('htuning',False) ))
+        checkpoint_path_epoch = "./checkpoints/{}/epoch".format(utility.model_name_mkr(self.m_params,t_params=self.t_params, htuning=self.m_params.get('htuning',False) ))
         os.makedirs(checkpoint_path_epoch,exist_ok=True)
         
-        with self.strategy.scope():
-            ckpt_epoch = tf.train.Checkpoint(model=self.model, optimizer=self.optimizer)
-            self.ckpt_mngr_epoch = tf.train.CheckpointManager(ckpt_epoch, checkpoint_path_epoch, max_to_keep=self.t_params['checkpoints_to_keep'], keep_checkpoint_every_n_hours=None)    
+        if evaluator:
+            # the evaluator promotes the selected candidates to checkpoint_path_epoch itself, see evaluator.CheckpointPromoter
+            self.ckpt_mngr_epoch = None
+
+        else:
+            with self.strategy.scope():
+                ckpt_epoch = tf.train.Checkpoint(model=self.model, optimizer=self.optimizer)
+                # checkpoints are written from a background thread, see checkpointing.py
+                self.ckpt_mngr_epoch = checkpointing.AsyncCheckpointer(ckpt_epoch, checkpoint_path_epoch, max_to_keep=self.t_params['checkpoints_to_keep'])    
+            
+                #restoring last checkpoint if it exists
+                if self.ckpt_mngr_epoch.latest_checkpoint: 
+                    # compat: Initializing model and optimizer before restoring from checkpoint
+                    try:
+                        ckpt_epoch.restore(self.ckpt_mngr_epoch.latest_checkpoint).assert_consumed()            
+                    except AssertionError as e:
+                        ckpt_epoch.restore(self.ckpt_mngr_epoch.latest_checkpoint)              
+                    print (' Restoring model from best checkpoint')
+                elif self.t_params.get('init_from', "") != "":
+                    # warm start from another run, e.g. a model trained on other locations or dates
+                    self.warm_start( self.t_params['init_from'] )
+                elif self.t_params.get('continual', None) != None:
+                    raise ValueError("The first run of continual training needs init_from, the checkpoint directory of the run to continue from")
+                elif self.t_params.get('freeze', 'none') != 'none':
+                    raise ValueError("freeze {} needs trained weights, from this run's checkpoints or from init_from".format( self.t_params['freeze'] ))
+                else:
+                    print (' Initializing model from scratch')
         
-            #restoring last checkpoint if it exists
-            if self.ckpt_mngr_epoch.latest_checkpoint: 
-                # compat: Initializing model and optimizer before restoring from checkpoint
-                try:
-                    ckpt_epoch.restore(self.ckpt_mngr_epoch.latest_checkpoint).assert_consumed()            
-                except AssertionError as e:
-                    ckpt_epoch.restore(self.ckpt_mngr_epoch.latest_checkpoint)              
-                print (' Restoring model from best checkpoint')
-            else:
-                print (' Initializing model from scratch')
+        #checkpoints (For sidecar evaluation)
+            #Every epoch is saved as a candidate, which the sidecar evaluator validates, and removes once evaluated
+        if self.sidecar_eval and not evaluator:
+            self.candidates_dir = os.path.join( os.path.dirname(checkpoint_path_epoch), checkpointing.SIDECAR_CANDIDATES_DIR )
+            os.makedirs(self.candidates_dir, exist_ok=True)
+            self.ckpt_mngr_candidates = checkpointing.AsyncCheckpointer(ckpt_epoch, self.candidates_dir, max_to_keep=None)
         
-        #Tensorboard
-        os.makedirs("log_tensboard/{}".format(utility.model_name_mkr(m_params, t_params=self.t_params, htuning=self.m_params.get('htuning',False) )), exist_ok=True ) 
-        #self.writer = tf.summary.create_file_writer( "log_tensboard/{}".format(utility.model_name_mkr(m_params,t_params=self.t_params, htuning=self.m_params.get('htuning',False) ) ) )
+        #checkpoints (For mid-epoch resume)
+            #Saved every ckpt_batch_freq training batches and at the end of each epoch. Holds the progress counters and the epoch's metrics,
+            # so a preempted job resumes from the last saved batch
+        # Early stopping state of the validation subset, held in the batch checkpoint so a resumed job keeps its best loss and patience
+        with self.strategy.scope():
+            self.best_val_subset_loss = tf.Variable(np.inf, dtype=tf.float64, trainable=False)
+            self.val_checks_since_best = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+        if self.t_params.get('ckpt_batch_freq', 0) > 0 and not evaluator:
+            checkpoint_path_batch = "./checkpoints/{}/batch".format(utility.model_name_mkr(self.m_params,t_params=self.t_params, htuning=self.m_params.get('htuning',False) ))
+            os.makedirs(checkpoint_path_batch,exist_ok=True)
+
+            with self.strategy.scope():
+                self.ckpt_epoch_counter = tf.Variable(0, dtype=tf.int64, trainable=False)
+                self.ckpt_batch_counter = tf.Variable(0, dtype=tf.int64, trainable=False)
+                # the training batches' cardinality and order fingerprint, see data_order_fingerprint. 0 if not recorded
+                self.ckpt_data_cardinality = tf.Variable(0, dtype=tf.int64, trainable=False)
+                self.ckpt_data_fingerprint = tf.Variable(0, dtype=tf.int64, trainable=False)
+                ckpt_batch = tf.train.Checkpoint(model=self.model, optimizer=self.optimizer, epoch=self.ckpt_epoch_counter, batch=self.ckpt_batch_counter,
+                                                    loss_agg_epoch=self.loss_agg_epoch, mse_agg_epoch=self.mse_agg_epoch,
+                                                    best_val_subset_loss=self.best_val_subset_loss, val_checks_since_best=self.val_checks_since_best,
+                                                    data_cardinality=self.ckpt_data_cardinality, data_fingerprint=self.ckpt_data_fingerprint)
+                self.ckpt_mngr_batch = checkpointing.AsyncCheckpointer(ckpt_batch, checkpoint_path_batch, max_to_keep=1)
+
+                # The mid-epoch checkpoint is always at least as recent as the epoch checkpoint
+                if self.ckpt_mngr_batch.latest_checkpoint:
+                    ckpt_batch.restore(self.ckpt_mngr_batch.latest_checkpoint)
+                    self.start_epoch = int(self.ckpt_epoch_counter.numpy())
+                    self.batches_to_skip = int(self.ckpt_batch_counter.numpy())
+                    print(' Resuming from epoch {} batch {}'.format(self.start_epoch, self.batches_to_skip))
+        else:
+            self.ckpt_mngr_batch = None
+
+        # A resumed trainer retrains the epochs from start_epoch, so the evaluator discards any earlier candidates of these epochs
+        if self.sidecar_eval and not evaluator:
+            fp_manifest = os.path.join(self.candidates_dir, checkpointing.SIDECAR_MANIFEST_FN)
+            if len( checkpointing.read_jsonl(fp_manifest) ) > 0:
+                checkpointing.append_jsonl( fp_manifest, {'resumed_at_epoch':self.start_epoch} )
+
+        #Tensorboard, csv and jsonl records, written from a background thread
+        self.reporter = reporting.AsyncReporter( "log_tensboard/{}{}".format(utility.model_name_mkr(self.m_params, t_params=self.t_params, htuning=self.m_params.get('htuning',False) ),
+                                                    "/evaluator" if evaluator else "") )
         # endregion
         
         # region ---- Making Datasets
         
         #caching dataset to file post pre-processing steps have been completed 
-        cache_suffix = utility.cache_suffix_mkr( m_params, self.t_params )
+        cache_suffix = utility.cache_suffix_mkr( self.m_params, self.t_params )
         os.makedirs( './Data/data_cache/', exist_ok=True  )
 
-        _ds_train_val, _  = era5_eobs.load_data_era5eobs( self.t_params['train_batches'] + self.t_params['val_batches'] , self.t_params['start_date'], self.t_params['parallel_calls'] )
-
-        ds_train = _ds_train_val.take(self.t_params['train_batches'] )
-        ds_val = _ds_train_val.skip(self.t_params['train_batches'] ).take(self.t_params['val_batches'])
-
-        #TODO: undo cache
-        ds_train = ds_train.cache('Data/data_cache/train'+cache_suffix ) 
-        ds_val = ds_val.cache('Data/data_cache/val'+cache_suffix )
-
-        ds_train = ds_train.unbatch().shuffle( self.t_params['batch_size']*int(self.t_params['train_batches']/5), reshuffle_each_iteration=True).batch(self.t_params['batch_size']) #.repeat(self.t_params['epochs']-self.start_epoch)
-
-        ds_train_val = ds_train.concatenate(ds_val)
-        ds_train_val = ds_train_val.repeat(self.t_params.get('epochs',100)-self.start_epoch)
-        self.ds_train_val = self.strategy.experimental_distribute_dataset(dataset=ds_train_val)
-        self.iter_train_val = enumerate(self.ds_train_val)
+        # window index for date-set specifications (seasonal/ multi-range training), None for contiguous ctsm blocks
+        if self.t_params.get('train_window_dates', None) is not None:
+            window_dates = np.concatenate( [ self.t_params['train_window_dates'], self.t_params['val_window_dates'] ] )
+        else:
+            window_dates = None
+
+        if self.window_store != "":
+            # The store holds the windows of all splits, so this split's selection is cached, and the store is read only to fill the cache
+            store_range_fn = lambda split_window_dates: ( lambda first_batch, batch_count: data_generators.window_store_dataset( self.window_store, 
+                                                            split_window_dates, self.t_params['batch_size'], first_batch, batch_count ) )
+
+            ds_train, train_cache_mb = data_generators.cache_dataset( store_range_fn(self.t_params['train_window_dates']), 'Data/data_cache/train_store'+cache_suffix, 
+                                                        self.t_params['train_batches'], self.t_params['cache_compression'], self.t_params['cache_memory_mb'], element_shapes=self.static_shapes() )
+            ds_val, _ = data_generators.cache_dataset( store_range_fn(self.t_params['val_window_dates']), 'Data/data_cache/val_store'+cache_suffix, 
+                                                        self.t_params['val_batches'], self.t_params['cache_compression'], self.t_params['cache_memory_mb'] - train_cache_mb, element_shapes=self.static_shapes() )
+        
+        else:
+            # training batches are followed by the validation batches. Each cache tier reads only its own range of batches
+            total_batches = self.t_params['train_batches'] + self.t_params['val_batches']
+            ds_range_fn = lambda first_batch, batch_count: era5_eobs.load_batch_range( first_batch, batch_count, total_batches, self.t_params['start_date'], 
+                                                                self.t_params['parallel_calls'], window_dates=window_dates )
+
+            # caching in RAM up to the memory budget, remainder on disk with selected compression. Training batches are given priority in RAM
+            ds_train, train_cache_mb = data_generators.cache_dataset( ds_range_fn, 'Data/data_cache/train'+cache_suffix, self.t_params['train_batches'], 
+                                                        self.t_params['cache_compression'], self.t_params['cache_memory_mb'], element_shapes=self.static_shapes() )
+            ds_val, _ = data_generators.cache_dataset( lambda first_batch, batch_count: ds_range_fn( self.t_params['train_batches']+first_batch, batch_count ), 
+                                                        'Data/data_cache/val'+cache_suffix, self.t_params['val_batches'], 
+                                                        self.t_params['cache_compression'], self.t_params['cache_memory_mb'] - train_cache_mb, element_shapes=self.static_shapes() )
+
+        bounds = cl.central_region_bounds( self.m_params['region_grid_params'] )
+
+        # Intensity-aware sampling of training windows, from an index of each window's rain statistics
+        if len( self.t_params.get('importance_sampling_weights', {}) ) > 0 and not evaluator:
+            self.sampler = window_sampler.WindowSampler( self.t_params['importance_sampling_weights'], self.t_params.get('shuffle_seed',0) )
+            self.sampler.load_or_compute_stats( ds_train, bounds, 'Data/data_cache/window_stats'+cache_suffix+'.npy' )
+        else:
+            self.sampler = None
+
+        # Fixed subset of the validation windows, stratified by location and intensity class, evaluated every val_every training batches
+        if self.t_params.get('val_every', 0) > 0:
+            self.val_subset_batches = min( self.t_params['val_subset_batches'] if self.t_params.get('val_subset_batches', 0) > 0 else self.t_params['val_batches']//10, self.t_params['val_batches'] )
+            self.val_subset_batches = max( self.val_subset_batches, 1 )
+
+            val_stats = window_sampler.load_or_compute_stats( ds_val, bounds, 'Data/data_cache/window_stats_val'+cache_suffix+'.npy' )
+            loc_idxs = np.minimum( np.arange(len(val_stats)) // (len(val_stats)//era5_eobs.loc_count), era5_eobs.loc_count-1 )
+            keep = window_sampler.stratified_subset( loc_idxs*len(window_sampler.INTENSITY_CLASSES) + window_sampler.class_idxs(val_stats), 
+                                                        self.val_subset_batches*self.t_params['batch_size'] )
+
+            ds_val_subset = tf.data.Dataset.zip( (ds_val.unbatch(), tf.data.Dataset.from_tensor_slices(keep)) )
+            ds_val_subset = ds_val_subset.filter( lambda window, selected: selected ).map( lambda window, selected: window )
+            ds_val_subset = ds_val_subset.batch( self.t_params['batch_size'], drop_remainder=True ).cache()
+            ds_val_subset = data_generators.cast_features( ds_val_subset, tf.keras.backend.floatx() )
+        else:
+            ds_val_subset = None
+
+        # A mid-epoch resume replays the epoch's batch order, so it needs the same training batches and the same inputs to their order
+        if self.ckpt_mngr_batch != None:
+            cardinality, fingerprint = self.data_order_fingerprint( ds_train, cache_suffix )
+            saved_cardinality, saved_fingerprint = int(self.ckpt_data_cardinality.numpy()), int(self.ckpt_data_fingerprint.numpy())
+            if self.batches_to_skip > 0 and saved_fingerprint != 0 and (saved_cardinality, saved_fingerprint) != (cardinality, fingerprint):
+                raise ValueError("The batch checkpoint was saved with {} training batches and order fingerprint {}, this run has {} and {}, so its epoch "
+                                    "can not be resumed in the same order. Remove the batch checkpoint to resume from the epoch checkpoint".format( 
+                                    saved_cardinality, saved_fingerprint, cardinality, fingerprint ))
+            self.ckpt_data_cardinality.assign( cardinality )
+            self.ckpt_data_fingerprint.assign( fingerprint )
+
+        # Features are cached as float16, and cast to the compute dtype of the precision policy after the cache
+        ds_train = data_generators.cast_features( ds_train, tf.keras.backend.floatx() )
+        ds_val = data_generators.cast_features( ds_val, tf.keras.backend.floatx() )
+
+        # Training batches are shuffled per epoch in train_dataset, validation batches are in a fixed order
+        self.ds_train = ds_train.unbatch()
+        if self.t_params.get('xla', False) or self.stateful:
+            ds_val = ds_val.map( self.ensure_static_shapes )
+            ds_val_subset = ds_val_subset.map( self.ensure_static_shapes ) if ds_val_subset != None else None
+        self.ds_val = self.distribute_dataset( lambda: ds_val )
+        self.ds_val_subset = self.distribute_dataset( lambda: ds_val_subset ) if ds_val_subset != None else None
 
         bc_ds_in_train = int( self.t_params['train_batches']/era5_eobs.loc_count  ) #batch_count
         bc_ds_in_val = int( self.t_params['val_batches']/era5_eobs.loc_count )
@@ -195,6 +362,98 @@ class WeatherModel():
         self.reset_idxs_validation = np.cumsum( [bc_ds_in_val]*era5_eobs.loc_count )        
         # endregion
 
+    def initialize_model(self):
+        """Creates the model, optimizer and metrics within the distribution strategy's scope.
+            With --xla, also creates the XLA compiled loss and gradient functions
+        """
+        assert self.worker_count > 1 or self.t_params['batch_size'] % self.strategy.num_replicas_in_sync  == 0
+        print("Number of Devices used in {}: {}".format(type(self.strategy).__name__, self.strategy.num_replicas_in_sync))
+        with self.strategy.scope():   
+            #Model
+            self.strategy_gpu_count = self.strategy.num_replicas_in_sync    
+            self.t_params['gpu_count'] = self.strategy.num_replicas_in_sync    
+            self.model = models.model_loader( self.t_params, self.m_params )
+            models.freeze_layers( self.model, self.t_params.get('freeze', 'none') )
+            
+            #Optimizer
+            # total_steps counts optimizer updates, of which there is one per grad_accum batches
+            optimizer = tfa.optimizers.RectifiedAdam( **self.m_params['rec_adam_params'], total_steps=math.ceil(self.t_params['train_batches']/self.grad_accum)*20) 
+
+            if self.loss_scaling:
+                self.optimizer = mixed_precision.LossScaleOptimizer( optimizer, loss_scale=tf.mixed_precision.experimental.DynamicLossScale() ) 
+            else:
+                self.optimizer = optimizer
+                    
+            # These objects will aggregate losses and metrics across batches and epochs
+            self.loss_agg_batch = tf.keras.metrics.Mean(name='loss_agg_batch' )
+            self.loss_agg_epoch = tf.keras.metrics.Mean(name="loss_agg_epoch")
+
+            self.mse_agg_epoch = tf.keras.metrics.Mean(name='mse_agg_epoch')
+            
+            self.loss_agg_val = tf.keras.metrics.Mean(name='loss_agg_val')
+            self.mse_agg_val = tf.keras.metrics.Mean(name='mse_agg_val')
+
+            # Count of training steps with non-finite gradients, i.e. float16 overflows, reported with the variable statistics
+            if self.stats_freq > 0:
+                self.nonfinite_grad_steps = tf.Variable(0, dtype=tf.int64, trainable=False, aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+        
+        # building the model's variables outside of the compiled functions
+        if self.t_params.get('xla', False) or self.stateful or self.grad_accum > 1:
+            self.build_model()
+
+        # Per replica sums of the unclipped gradients of the batches since the last optimizer update
+        if self.grad_accum > 1:
+            with self.strategy.scope():
+                self.accum_gradients = [ tf.Variable( tf.zeros(var.shape, dtype=var.dtype), trainable=False, 
+                                            synchronization=tf.VariableSynchronization.ON_READ, aggregation=tf.VariableAggregation.SUM )
+                                            for var in self.model.trainable_variables ]
+            print("Accumulating gradients over {} batches, effective batch size {}".format( self.grad_accum, self.grad_accum*self.t_params['batch_size'] ))
+
+        # XLA compiled functions. The bounds are passed as python ints, so the central region slices are compile time constants
+        if self.t_params.get('xla', False):
+            xla_bounds = [ int(b) for b in cl.central_region_bounds(self.m_params['region_grid_params']) ]
+            self.xla_train_gradients = tf.function( lambda feature, target, mask: self.compute_gradients(feature, target, mask, xla_bounds, self.grad_accum == 1), experimental_compile=True )
+            self.xla_val_losses = tf.function( lambda feature, target, mask: self.masked_losses(feature, target, mask, xla_bounds, False), experimental_compile=True )
+
+    def build_model(self):
+        """Creates the model's variables by calling it on a batch of zeros, of the per replica training batch shape.
+            Stateful layers need the full batch size for their states. The build's trace is not counted, so the
+            steps' traces for their input signatures are not reported as retraces of it
+        """
+        build_shape = self.static_shapes()[0]
+        build_shape = [ build_shape[0]//len(self.strategy.extended.worker_devices) ] + build_shape[1:]
+        with self.strategy.scope(), tracing.uncounted():
+            _ = self.model( tf.zeros( build_shape, dtype=tf.keras.backend.floatx() ), False )
+        self.reset_model_states()
+
+    def warm_start(self, init_from):
+        """Loads the model weights of another run's checkpoint. The optimizer's state is not loaded, so training restarts its schedule
+
+            Args:
+                init_from (str): checkpoint path, or a directory of checkpoints e.g. './checkpoints/{modelcode}' or its 'epoch' subdirectory,
+                    in which case the checkpoint with the lowest validation loss in the run's checkpoint_scores.csv is loaded, 
+                    or else the directory's latest checkpoint
+        """
+        ckpt_path = init_from
+        if os.path.isdir(init_from):
+            ckpt_path = tf.train.latest_checkpoint(init_from) or tf.train.latest_checkpoint( os.path.join(init_from, "epoch") )
+            
+            fp_scores = os.path.join( init_from, "checkpoint_scores.csv" )
+            if os.path.exists(fp_scores):
+                df_scores = pd.read_csv( fp_scores, header=0, index_col=False ).dropna( subset=['Val_loss','Checkpoint_Path'] )
+                if len(df_scores.index) > 0:
+                    ckpt_path = df_scores.sort_values(by=['Val_loss'])['Checkpoint_Path'].iloc[0]
+            if ckpt_path == None:
+                raise FileNotFoundError("No checkpoint found in {}".format(init_from))
+        
+        with self.strategy.scope():
+            # The optimizer's values in the checkpoint are not loaded. Every model variable must be, so the model is built to check them
+            status = tf.train.Checkpoint(model=self.model).restore(ckpt_path).expect_partial()
+        if not self.model.built:
+            self.build_model()
+        status.assert_existing_objects_matched()
+        print (' Initializing model from {}, freezing: {}'.format(ckpt_path, self.t_params.get('freeze', 'none')))
+
     def train_model(self):
         """During training we produce a prediction for a (n by n) square patch. 
             But we caculate losses on a central (h, w) region within the (n by n) patch
@@ -202,21 +461,40 @@ class WeatherModel():
         """        
 
         bounds = cl.central_region_bounds(self.m_params['region_grid_params']) #list [ lower_h_bound[0], upper_h_bound[0], lower_w_bound[1], upper_w_bound[1] ]
+
+        if self.t_params.get('prewarm_traces', False):
+            self.prewarm_traces( bounds )
+
+        # Batches are run in blocks of up to steps_per_execution batches, each block in a single tf.function call. 
+            # Blocks end on every reporting, state reset and checkpoint batch, so the bookkeeping below only runs between blocks
+        train_boundaries = list( range(self.train_batch_report_freq, self.t_params['train_batches']+1, self.train_batch_report_freq) ) + list(self.reset_idxs_training)
+        if self.ckpt_mngr_batch != None:
+            train_boundaries += list( range(self.t_params['ckpt_batch_freq'], self.t_params['train_batches']+1, self.t_params['ckpt_batch_freq']) )
+        if self.ds_val_subset != None:
+            train_boundaries += list( range(self.t_params['val_every'], self.t_params['train_batches'], self.t_params['val_every']) )
+        if self.grad_accum > 1:
+            train_boundaries += list( range(self.grad_accum, self.t_params['train_batches']+1, self.grad_accum) )
+        if self.stats_freq > 0:
+            # statistics batches are run as single steps, since their statistics are returned
+            train_boundaries += [ b + offset for b in range(self.stats_freq, self.t_params['train_batches']+1, self.stats_freq) for offset in [-1, 0] ]
         
         #Training for n epochs
         #self.t_params['train_batches'] = self.t_params['train_batches'] if self.m_params['time_sequential'] else int(self.t_params['train_batches']*self.t_params['lookback_target'] )
         #self.t_params['val_batches'] = self.t_params['val_batches'] if self.m_params['time_sequential'] else int(self.t_params['val_batches']*self.t_params['lookback_target'] )
 
+        # Early stopping on the validation subset: patience of early_stopping_period epochs of subset validations
+        if self.ds_val_subset != None:
+            self.val_subset_patience = self.t_params['early_stopping_period'] * math.ceil( self.t_params['train_batches']/self.t_params['val_every'] )
+        stop_early = False
+
         for epoch in range(self.start_epoch, int(self.t_params['epochs']) ):
             
             #region resetting metrics, losses, records, timers
             self.loss_agg_batch.reset_states()
-            self.loss_agg_epoch.reset_states()
-            self.mse_agg_epoch.reset_states()
-            
-            
-            self.loss_agg_val.reset_states()
-            self.mse_agg_val.reset_states()
+            if self.batches_to_skip == 0:
+                # On a mid-epoch resume, these hold the restored aggregates of the epoch's completed batches
+                self.loss_agg_epoch.reset_states()
+                self.mse_agg_epoch.reset_states()
             
             self.df_training_info = self.df_training_info.append( { 'Epoch':epoch, 'Last_Trained_Batch':0 }, ignore_index=True )
             
@@ -225,93 +503,428 @@ class WeatherModel():
             batch=0           
             
             print("\n\nStarting EPOCH {}".format(epoch ))
+
+            # On a mid-epoch resume, the hidden states of the skipped batches are not restored, so states restart from zero
+            self.reset_model_states()
+
+            self.input_monitor.start_epoch()
+            iter_train = iter( self.distribute_dataset( lambda: self.train_dataset(epoch, self.batches_to_skip) ) )
+            self.accum_start_batch = self.batches_to_skip
             #endregion 
             
             # --- Training Loops
-            for batch in range(self.batches_to_skip+1,self.t_params['train_batches'] +1):
+            for first_batch, batch in self.step_blocks( self.batches_to_skip+1, self.t_params['train_batches'], train_boundaries ):
                                
-                # get next set of training datums
-                idx, (feature, target, mask) = next(self.iter_train_val)
+                stats_batch = self.stats_freq > 0 and batch % self.stats_freq == 0
+                if first_batch == batch:
+                    # get next set of training datums
+                    feature, target, mask = self.input_monitor.next(iter_train)
+                    
+                    gradients = self.distributed_train_step( feature, target, mask, bounds, 0.0, stats_batch )
+                else:
+                    self.input_monitor.draw( batch-first_batch+1 )
+                    self.distributed_train_steps( iter_train, bounds, tf.constant(batch-first_batch+1) )
                 
+                self.apply_accumulated_gradients( batch, self.t_params['train_batches'] )
 
-                gradients = self.distributed_train_step( feature, target, mask, bounds, 0.0 )
-                #print(gradients)
-                
                 # reporting
+                step = batch + (epoch)*self.t_params['train_batches']
                 if( batch % self.train_batch_report_freq==0 or batch == self.t_params['train_batches']):
                     batch_group_time =  time.time() - start_batch_group_time
+                    batch_group_wait = self.input_monitor.group_wait()
                     est_completion_time_seconds = (batch_group_time/self.t_params['reporting_freq']) * (1 - batch/self.t_params['train_batches'])
                     est_completion_time_mins = est_completion_time_seconds/60
 
-                    print("\t\tBatch:{}/{}\tTrain Loss: {:.8f} \t Batch Time:{:.4f}\tEpoch mins left:{:.1f}".format(batch, self.t_params['train_batches'], self.loss_agg_batch.result(), batch_group_time, est_completion_time_mins ) )
+                    print("\t\tBatch:{}/{}\tTrain Loss: {:.8f} \t Batch Time:{:.4f}\tData Wait:{:.4f}\tEpoch mins left:{:.1f}".format(batch, self.t_params['train_batches'], self.loss_agg_batch.result(), 
+                            batch_group_time, batch_group_wait, est_completion_time_mins ) )
                     
                     # resetting time and losses
                     start_batch_group_time = time.time()
 
                     # Updating record of the last batch to be operated on in training epoch
                     self.df_training_info.loc[ ( self.df_training_info['Epoch']==epoch) , ['Last_Trained_Batch'] ] = batch
-                    self.df_training_info.to_csv( path_or_buf="checkpoints/{}/checkpoint_scores.csv".format(utility.model_name_mkr(self.m_params,t_params=self.t_params, htuning=m_params.get('htuning',False) )), header=True, index=False )
+                    if not self.sidecar_eval:
+                        # with the sidecar evaluator, the scores file is only written by the evaluator
+                        self.reporter.write_csv( self.df_training_info.copy(), "checkpoints/{}/checkpoint_scores.csv".format(utility.model_name_mkr(self.m_params,t_params=self.t_params, htuning=self.m_params.get('htuning',False) )) )
+                    self.reporter.timings( {'train_batch_group':batch_group_time, 'train_data_wait':batch_group_wait}, step )
 
-
-                li_losses = [self.loss_agg_batch.result()]
-                li_names = ['train_loss_batch']
-                step = batch + (epoch)*self.t_params['train_batches']
-                #utility.tensorboard_record( self.writer.as_default(), li_losses, li_names, step, gradients, self.model.trainable_variables )
-                #utility.tensorboard_record( self.writer.as_default(), li_losses, li_names, step, None, None )
+                self.reporter.scalars( {'train_loss_batch':self.loss_agg_batch.result()}, step )
                 self.loss_agg_batch.reset_states()
 
+                if stats_batch:
+                    self.report_variable_stats( gradients, step )
+
                 if batch in self.reset_idxs_training:
-                    self.model.reset_states()
+                    self.reset_model_states()
+
+                # mid-epoch checkpoint
+                if self.ckpt_mngr_batch != None and batch % self.t_params['ckpt_batch_freq'] == 0:
+                    self.save_batch_checkpoint(epoch, batch)
+                
+                # validation on the fixed subset, the epoch's last check is after the training loop
+                if self.ds_val_subset != None and batch % self.t_params['val_every'] == 0 and batch < self.t_params['train_batches']:
+                    start_val_time = time.time()
+                    stop_early = self.validate_subset( bounds, step )
+                    self.input_monitor.exclude( time.time() - start_val_time )
+                    if stop_early:
+                        break
+            
+            self.batches_to_skip = 0
+
+            # Input-bound: the loop waited on the data pipeline for a large part of its time, or often found the prefetch buffer empty
+            pipeline = self.input_monitor.summary( self.t_params['batch_size'] )
+            self.reporter.scalars( pipeline, epoch, prefix="input_pipeline/" )
+            print("\tInput pipeline: data wait {:.1f}s of {:.1f}s ({:.0%}), mean prefetch depth {:.1f}, {:.1f} windows/s: {}".format( pipeline['data_wait_s'], 
+                    pipeline['data_wait_s']+pipeline['step_s'], pipeline['data_wait_frac'], pipeline['prefetch_depth_mean'], pipeline['windows_per_s'],
+                    "input-bound" if pipeline['input_bound'] else "compute-bound" ) )
                     
             # --- Tensorboard record          
-            li_losses = [self.loss_agg_epoch.result(), self.mse_agg_epoch.result()]
-            li_names = ['train_loss_epoch','train_mse_epoch']
-            #utility.tensorboard_record( self.writer.as_default(), li_losses, li_names, epoch)
+            self.reporter.scalars( {'train_loss_epoch':self.loss_agg_epoch.result(), 'train_mse_epoch':self.mse_agg_epoch.result()}, epoch )
+            self.reporter.timings( {'train_epoch':time.time()-start_epoch_train}, epoch )
+            self.reporter.scalars( {'traces':sum( tracing.trace_counts().values() ), 'retraces':tracing.retrace_count()}, epoch, prefix="tracing/" )
             
             
-            print("\tStarting Validation")
-            start_batch_group_time = time.time()
+            # With val_every, the full validation set is only evaluated every full_val_freq epochs. With sidecar_eval, it is evaluated by the evaluator
+            full_validation = not self.sidecar_eval and ( self.ds_val_subset == None or epoch % self.t_params.get('full_val_freq', 1) == 0 )
+            if full_validation:
+                self.validate( bounds )
+                self.reporter.scalars( {'Validation Loss':self.loss_agg_val.result(), 'Validation MSE':self.mse_agg_val.result()}, epoch )
 
-            # --- Validation Loops
-            for batch in range(1, self.t_params['val_batches']+1):
-                
-                # next datum
-                idx, (feature, target, mask) = next(self.iter_train_val)
-                
-                bool_cmpltd = self.distributed_val_step(feature, target, mask, bounds)
-
-                # Reporting for validation
-                if batch % self.val_batch_report_freq == 0 or batch==self.t_params['val_batches'] :
-                    batch_group_time            =  time.time() - start_batch_group_time
-                    est_completion_time_seconds = (batch_group_time/self.t_params['reporting_freq']) * (1 -  batch/self.t_params['val_batches'])
-                    est_completion_time_mins    = est_completion_time_seconds/60
-
-                    print("\t\tCompleted Validation Batch:{}/{} \t Time:{:.4f} \tEst Time Left:{:.1f}".format( batch, self.t_params['val_batches'], batch_group_time, est_completion_time_mins))
-                                                
-                    start_batch_group_time = time.time()
-                
-                if batch in self.reset_idxs_validation:
-                    self.model.reset_states()
+            # Checkpoints are selected, and training is stopped early, on the validation subset scores
+            if self.ds_val_subset != None:
+                stop_early = self.validate_subset( bounds, (epoch+1)*self.t_params['train_batches'] ) or stop_early
 
             # region - End of Epoch Reporting and Early iteration Callback
             print("\tEpoch:{}\t Train Loss:{:.8f}\t Train MSE:{:.5f}\t Val Loss:{:.5f}\t Val MSE:{:.5f}\t  Time:{:.5f}".format(epoch, self.loss_agg_epoch.result(), self.mse_agg_epoch.result(),
                          
                         self.loss_agg_val.result(), self.mse_agg_val.result()  ,time.time()-start_epoch_train  ) )
                     
-            #utility.tensorboard_record( self.writer.as_default(), [self.loss_agg_val.result(), self.mse_agg_val.result()], ['Validation Loss', 'Validation MSE' ], epoch  )                    
-            self.df_training_info = utility.update_checkpoints_epoch(self.df_training_info, epoch, self.loss_agg_epoch, self.loss_agg_val, self.ckpt_mngr_epoch, self.t_params, 
-                    self.m_params, self.mse_agg_epoch ,self.mse_agg_val,  self.t_params['objective'] )
+            if self.t_params.get('histogram_freq', 0) > 0 and epoch % self.t_params['histogram_freq'] == 0:
+                self.reporter.histograms( { "Weights:{}".format(var.name):tf.identity(var) for var in self.model.trainable_variables }, epoch )
+
+            if self.sidecar_eval:
+                # the evaluator lags behind training, so its early stopping decision is applied a few epochs late
+                self.save_candidate( epoch )
+                stop_early = checkpointing.read_json( self.sidecar_state_fp(), {} ).get('stop_early', False)
+            else:
+                self.df_training_info = utility.update_checkpoints_epoch(self.df_training_info, epoch, self.loss_agg_epoch, self.loss_agg_val, self.ckpt_mngr_epoch, self.t_params, 
+                        self.m_params, self.mse_agg_epoch ,self.mse_agg_val,  self.t_params['objective'], self.reporter )
+            
+            if self.ckpt_mngr_batch != None:
+                self.save_batch_checkpoint(epoch+1, 0)
             
             # Early Stop Callback 
-            if epoch > ( max( self.df_training_info.loc[:, 'Epoch'], default=0 ) + self.t_params['early_stopping_period']) :
+            if stop_early or ( self.ds_val_subset == None and not self.sidecar_eval and epoch > ( max( self.df_training_info.loc[:, 'Epoch'], default=0 ) + self.t_params['early_stopping_period']) ):
                 print("Model Stopping Early at EPOCH {}".format(epoch))
                 print(self.df_training_info)
                 break
             # endregion
         
+        # waiting for the checkpoints still being written
+        self.ckpt_mngr_epoch.close()
+        if self.ckpt_mngr_batch != None:
+            self.ckpt_mngr_batch.close()
+        if self.sidecar_eval:
+            self.ckpt_mngr_candidates.close()
+            checkpointing.append_jsonl( os.path.join(self.candidates_dir, checkpointing.SIDECAR_MANIFEST_FN), {'finished':True} )
+        self.reporter.close()
         print("Model Training Finished")
 
-    def train_step(self, feature, target, mask, bounds, _init):
+    def validate(self, bounds):
+        """Evaluates the full validation set. The scores are left in loss_agg_val and mse_agg_val
+
+            Args:
+                bounds (list): bounds of the central region
+        """
+        val_boundaries = list( range(self.val_batch_report_freq, self.t_params['val_batches']+1, self.val_batch_report_freq) ) + list(self.reset_idxs_validation)
+
+        iter_val = iter( self.ds_val )
+        self.loss_agg_val.reset_states()
+        self.mse_agg_val.reset_states()
+
+        print("\tStarting Validation")
+        start_batch_group_time = time.time()
+        self.reset_model_states()
+
+        # --- Validation Loops
+        for first_batch, batch in self.step_blocks( 1, self.t_params['val_batches'], val_boundaries ):
+        
+            if first_batch == batch:
+                # next datum
+                feature, target, mask = next(iter_val)
+            
+                bool_cmpltd = self.distributed_val_step(feature, target, mask, bounds)
+            else:
+                self.distributed_val_steps( iter_val, bounds, tf.constant(batch-first_batch+1) )
+
+            # Reporting for validation
+            if batch % self.val_batch_report_freq == 0 or batch==self.t_params['val_batches'] :
+                batch_group_time            =  time.time() - start_batch_group_time
+                est_completion_time_seconds = (batch_group_time/self.t_params['reporting_freq']) * (1 -  batch/self.t_params['val_batches'])
+                est_completion_time_mins    = est_completion_time_seconds/60
+
+                print("\t\tCompleted Validation Batch:{}/{} \t Time:{:.4f} \tEst Time Left:{:.1f}".format( batch, self.t_params['val_batches'], batch_group_time, est_completion_time_mins))
+                                        
+                start_batch_group_time = time.time()
+        
+            if batch in self.reset_idxs_validation:
+                self.reset_model_states()
+
+    def validate_subset(self, bounds, step):
+        """Evaluates the fixed validation subset, and updates the early stopping patience.
+            The subset's scores are left in loss_agg_val and mse_agg_val
+
+            Args:
+                bounds (list): bounds of the central region
+                step (int): training step, for the records
+
+            Returns:
+                bool: True if the subset loss has not improved within the patience
+        """
+        self.loss_agg_val.reset_states()
+        self.mse_agg_val.reset_states()
+        
+        iter_val = iter( self.ds_val_subset )
+        for first_batch, batch in self.step_blocks( 1, self.val_subset_batches, [] ):
+            if first_batch == batch:
+                feature, target, mask = next(iter_val)
+                self.distributed_val_step( feature, target, mask, bounds )
+            else:
+                self.distributed_val_steps( iter_val, bounds, tf.constant(batch-first_batch+1) )
+        
+        loss = float( self.loss_agg_val.result() )
+        print("\t\tValidation Subset Loss:{:.5f}\t MSE:{:.5f}".format( loss, self.mse_agg_val.result() ))
+        self.reporter.scalars( {'val_subset_loss':loss, 'val_subset_mse':self.mse_agg_val.result()}, step )
+
+        if loss < float( self.best_val_subset_loss.numpy() ):
+            self.best_val_subset_loss.assign( loss )
+            self.val_checks_since_best.assign( 0 )
+        else:
+            self.val_checks_since_best.assign_add( 1 )
+        
+        return int( self.val_checks_since_best.numpy() ) >= self.val_subset_patience
+
+    def train_dataset(self, epoch, batches_to_skip=0):
+        """Returns the training batches for an epoch. The shuffle seed is derived from the epoch, 
+            so the batch order of an epoch is reproduced when training resumes mid-epoch
+
+            Args:
+                epoch (int): epoch
+                batches_to_skip (int, optional): number of batches of the epoch already trained on. Defaults to 0.
+
+            Returns:
+                tf.data.Dataset: training batches
+        """
+        ds_train = self.ds_train
+        if self.sampler != None:
+            # masks become float loss weights, which the masked losses apply
+            ds_train = self.sampler.resample( ds_train, epoch )
+
+        # stateful training keeps the stream order, see initialize_scheme_era5Eobs
+        if not self.stateful:
+            ds_train = ds_train.shuffle( self.t_params['batch_size']*int(self.t_params['train_batches']/5), seed=self.t_params.get('shuffle_seed',0)+epoch, reshuffle_each_iteration=False )
+        
+        static_shapes = self.t_params.get('xla', False) or self.stateful
+        ds_train = ds_train.batch(self.t_params['batch_size'], drop_remainder=static_shapes ).skip(batches_to_skip)
+        
+        if static_shapes:
+            ds_train = ds_train.map( self.ensure_static_shapes )
+
+        return self.input_monitor.count_produced( ds_train ).prefetch( tf.data.experimental.AUTOTUNE )
+
+    def data_order_fingerprint(self, ds_train, cache_suffix):
+        """Returns the cardinality of the cached training batches, and a hash of the inputs that set the batch order of an epoch
+
+            Args:
+                ds_train (tf.data.Dataset): cached training batches
+                cache_suffix (str): suffix of the dataset caches, which identifies the data and its windows
+
+            Returns:
+                tuple: (int, int) cardinality, negative if unknown, and a 60 bit hash
+        """
+        cardinality = int( tf.data.experimental.cardinality(ds_train) )
+
+        window_dates = self.t_params.get('train_window_dates', None)
+        order_inputs = [ cache_suffix, self.t_params['batch_size'], self.t_params['train_batches'], self.t_params.get('shuffle_seed',0),
+                            self.stateful, self.t_params.get('xla', False), sorted( self.t_params.get('importance_sampling_weights', {}).items() ),
+                            self.window_store, [ str(date) for date in window_dates ] if window_dates is not None else None ]
+        fingerprint = int( hashlib.md5( json.dumps(order_inputs, default=str).encode() ).hexdigest()[:15], 16 )
+
+        return cardinality, fingerprint
+
+    def static_shapes(self):
+        """Returns the shapes of a (feature, target, mask) batch
+
+            Returns:
+                tuple: feature shape, target shape, mask shape
+        """
+        return data_generators.batch_shapes( self.t_params, self.m_params )
+
+    def reset_model_states(self):
+        """Resets the hidden states of all stateful layers. Model.reset_states only reaches the model's direct layers,
+            whereas TRUNET's ConvGRUs are nested within its encoder and decoder layers
+        """
+        if not self.stateful:
+            return
+
+        for layer in self.model.submodules:
+            if getattr(layer, 'stateful', False) and hasattr(layer, 'reset_states') and layer.built:
+                layer.reset_states()
+
+    def ensure_static_shapes(self, feature, target, mask):
+        """Sets the static shape of a batch, so that XLA compiles the steps for a single fixed shape"""
+        feature_shape, target_shape, mask_shape = self.static_shapes()
+        return tf.ensure_shape(feature, feature_shape), tf.ensure_shape(target, target_shape), tf.ensure_shape(mask, mask_shape)
+
+    def distribute_dataset(self, dataset_fn):
+        """Distributes the dataset returned by dataset_fn across the replicas
+
+            Args:
+                dataset_fn (function): returns a tf.data.Dataset
+                
+            Returns:
+                tf.distribute.DistributedDataset: distributed dataset
+        """
+        if self.worker_count > 1:
+            # Each worker's dataset is already its own shard, so it is passed to the worker's replicas as is
+            return self.strategy.experimental_distribute_datasets_from_function( lambda input_context: dataset_fn() )
+        
+        return self.strategy.experimental_distribute_dataset( dataset=dataset_fn() )
+
+    def save_candidate(self, epoch):
+        """Saves the epoch's weights as a candidate for the sidecar evaluator, and records the epoch's training scores
+
+            Args:
+                epoch (int): epoch
+        """
+        # Candidates are numbered by their manifest record, which is never reused, whereas the checkpoint's save_counter
+            # is restored with the weights when training resumes
+        fp_manifest = os.path.join(self.candidates_dir, checkpointing.SIDECAR_MANIFEST_FN)
+        ckpt_path = self.ckpt_mngr_candidates.save( checkpoint_number=len( checkpointing.read_jsonl(fp_manifest) ) + 1 )
+        checkpointing.append_jsonl( fp_manifest, {'epoch':epoch, 'train_loss':float(self.loss_agg_epoch.result()), 'train_mse':float(self.mse_agg_epoch.result()), 'checkpoint_path':ckpt_path} )
+
+    def sidecar_state_fp(self):
+        """Returns the filepath of the sidecar evaluator's state"""
+        return "checkpoints/{}/{}".format( utility.model_name_mkr(self.m_params,t_params=self.t_params, htuning=self.m_params.get('htuning',False)), checkpointing.SIDECAR_STATE_FN )
+
+    def report_variable_stats(self, replica_stats, step):
+        """Hands the statistics of a sampled training step to the reporter, without waiting for them on the device. 
+            The statistics are those of the first replica
+
+            Args:
+                replica_stats (PerReplica): output of distributed_train_step with stats
+                step (int): training step
+        """
+        if self.var_names == None:
+            self.var_names = [ var.name for var in self.model.trainable_variables ]
+
+        self.reporter.variable_stats( self.var_names, self.strategy.experimental_local_results(replica_stats)[0], step )
+
+        dict_scalars = { 'nonfinite_grad_steps':tf.identity(self.nonfinite_grad_steps) }
+        if self.loss_scaling:
+            # The dynamic loss scale is halved after each overflow
+            dict_scalars['loss_scale'] = self.optimizer.loss_scale()
+        self.reporter.scalars( dict_scalars, step, prefix="stats/" )
+
+    def save_batch_checkpoint(self, epoch, batch):
+        """Saves the mid-epoch checkpoint
+
+            Args:
+                epoch (int): epoch in progress
+                batch (int): last completed training batch of the epoch
+        """
+        self.ckpt_epoch_counter.assign(epoch)
+        self.ckpt_batch_counter.assign(batch)
+        self.ckpt_mngr_batch.save()
+
+    def step_function(self, name, fn, mask_dtype, bounds, *static_args):
+        """Returns fn as a tf.function with the input signature of a batch, made once for each set of python arguments.
+            A batch of another shape or dtype then raises an error, rather than silently retracing the step
+
+            Args:
+                name (str): name of the step, for the trace counts of tracing.py
+                fn (function): function of (feature, target, mask, bounds, *static_args)
+                mask_dtype (tf.DType): dtype of the masks, float32 for loss weights
+                bounds (list): central region bounds, passed as python ints
+                static_args: further python arguments e.g. _init, stats
+
+            Returns:
+                tf.function: function of (feature, target, mask)
+        """
+        bounds = [ int(b) for b in bounds ]
+        key = ( name, tuple(bounds) ) + static_args
+        if key not in self.step_functions:
+            self.step_functions[key] = tf.function( tracing.counted(name)( lambda feature, target, mask: fn(feature, target, mask, bounds, *static_args) ),
+                                                    input_signature=self.batch_signature(mask_dtype) )
+        return self.step_functions[key]
+
+    def batch_signature(self, mask_dtype):
+        """Returns the input signature of a (feature, target, mask) batch, as drawn from a distributed dataset.
+            The batch dimension is left unknown, so a partial last batch runs the same trace, unless batches have static shapes
+
+            Args:
+                mask_dtype (tf.DType): dtype of the masks
+
+            Returns:
+                list: tf.TensorSpec of the feature, target and mask, or PerReplicaSpec with several replicas on this host
+        """
+        static_shapes = self.t_params.get('xla', False) or self.stateful
+        local_replicas = len( self.strategy.extended.worker_devices )
+
+        li_specs = []
+        for shape, dtype in zip( self.static_shapes(), [ tf.keras.backend.floatx(), tf.float32, mask_dtype ] ):
+            spec = tf.TensorSpec( [ shape[0]//local_replicas if static_shapes else None ] + shape[1:], dtype )
+            li_specs.append( distribute_values.PerReplicaSpec( *[spec]*local_replicas ) if local_replicas > 1 else spec )
+        
+        return li_specs
+
+    def train_mask_dtype(self):
+        """Returns the dtype of the training masks, which are float32 loss weights with importance sampling"""
+        return tf.float32 if getattr(self, 'sampler', None) != None else tf.bool
+
+    def prewarm_traces(self, bounds):
+        """Traces the training and validation steps for their input signatures before the first batch, 
+            so that tracing is not timed as part of the first steps
+
+            Args:
+                bounds (list): central region bounds
+        """
+        start_time = time.time()
+        for stats in [False] + ( [True] if self.stats_freq > 0 else [] ):
+            self.step_function( "distributed_train_step", self.run_train_step, self.train_mask_dtype(), bounds, 0.0, stats ).get_concrete_function()
+        if not self.sidecar_eval:
+            self.step_function( "distributed_val_step", self.run_val_step, tf.bool, bounds ).get_concrete_function()
+
+        print("Traced the training and validation steps in {:.1f}s".format( time.time() - start_time ))
+        self.reporter.timings( {'prewarm_traces':time.time() - start_time}, 0 )
+
+    def step_blocks(self, start_batch, end_batch, boundaries):
+        """Splits the batches from start_batch to end_batch into blocks of at most steps_per_execution batches.
+            A block always ends on a boundary batch
+
+            Args:
+                start_batch (int): first batch
+                end_batch (int): last batch
+                boundaries (list): batches which must end a block
+
+            Returns:
+                list: list of (first_batch, last_batch) pairs
+        """
+        steps_per_execution = self.t_params.get('steps_per_execution', 1)
+        boundaries = sorted( set( [ b for b in boundaries if start_batch <= b < end_batch ] + [end_batch] ) )
+
+        li_blocks = []
+        first_batch = start_batch
+        for boundary in boundaries:
+            while first_batch <= boundary:
+                last_batch = min( first_batch + steps_per_execution - 1, boundary )
+                li_blocks.append( (first_batch, last_batch) )
+                first_batch = last_batch + 1
+        
+        return li_blocks
+
+    def train_step(self, feature, target, mask, bounds, _init, stats=False):
+        """One training step. Returns the gradients, or with stats the per variable statistics of reporting.variable_stats"""
         
         if _init==1.0:
             if self.m_params['time_sequential'] == True:
@@ -319,181 +932,240 @@ class WeatherModel():
             else:
                 inp_shape = [self.t_params['batch_size'] ] + self.m_params['region_grid_params']['outer_box_dims'] + [ int(self.t_params['lookback_feature']*len(self.t_params['vars_for_feature'])) ]
            
-            _ = self.model( tf.zeros( inp_shape, dtype=tf.float16), self.t_params['trainable'] )    #( bs, tar_seq_len, h, w)
+            _ = self.model( tf.zeros( inp_shape, dtype=tf.keras.backend.floatx()), self.t_params['trainable'] )    #( bs, tar_seq_len, h, w)
 
             gradients = [ tf.zeros_like(t_var, dtype=tf.float32 ) for t_var in self.model.trainable_variables  ]
             self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
             return [0]
 
-        with tf.GradientTape(persistent=False) as tape:
-                                   
-            # non conditional continuous training
-            if self.m_params['model_type_settings']['discrete_continuous'] == False:
-                
-                #making predictions
-                preds = self.model( feature, self.t_params['trainable'] ) #( bs, tar_seq_len, h, w)
-                preds = tf.squeeze( preds,axis=[-1] )
+        if self.t_params.get('xla', False):
+            loss_to_optimize, metric_mse, gradients = self.xla_train_gradients( feature, target, mask )
+        else:
+            loss_to_optimize, metric_mse, gradients = self.compute_gradients( feature, target, mask, bounds, self.grad_accum == 1 )
+        
+        if self.grad_accum > 1:
+            # the optimizer update is made by apply_accumulated_step
+            for accum_gradient, gradient in zip( self.accum_gradients, gradients ):
+                if gradient is not None:
+                    accum_gradient.assign_add( gradient )
+        else:
+            # The optimizer update uses a cross-replica merge_call, so it is kept outside of the XLA compiled function
+            self.optimizer.apply_gradients( zip(gradients, self.model.trainable_variables))
 
-                
-                preds   = cl.extract_central_region(preds, bounds)
-                mask    = cl.extract_central_region(mask, bounds)
-                target  = cl.extract_central_region(target, bounds)
+        # Metrics (batchwise, epoch)  
+        self.loss_agg_batch( loss_to_optimize )
+        self.loss_agg_epoch( loss_to_optimize )
+        self.mse_agg_epoch( metric_mse )
 
-                #Applying mask
-                preds_masked = tf.boolean_mask( preds, mask )
-                target_masked = tf.boolean_mask( target, mask ) 
+        if self.stats_freq > 0:
+            # a single reduction over the gradients, cheap enough for every step
+            self.nonfinite_grad_steps.assign_add( tf.cast( tf.logical_not( tf.math.is_finite( tf.linalg.global_norm( [ g for g in gradients if g is not None ] ) ) ), tf.int64 ) )
+        
+        if stats:
+            return reporting.variable_stats( self.model.trainable_variables, gradients )
 
-                # reversing standardization
-                preds_masked = utility.standardize_ati( preds_masked, self.t_params['normalization_shift']['rain'], self.t_params['normalization_scales']['rain'], reverse=True)
+        return gradients
 
-                # getting losses for records and/or optimizer
-                metric_mse = cl.mse(target_masked, preds_masked) 
-                loss_to_optimize = metric_mse
+    def compute_gradients(self, feature, target, mask, bounds, clip=True):
+        """Forward pass, losses and clipped gradients of one training batch, with static shapes throughout
 
-            # conditional continuous training        
-            elif self.m_params['model_type_settings']['discrete_continuous'] == True:
-                
-                # Producing predictions - conditional rain value and prob of rain
-                preds   = self.model( feature, self.t_params['trainable'] ) # ( bs, seq_len, h, w, 1)
-                preds   = tf.squeeze(preds, axis=[-1])
-                preds, probs = tf.unstack(preds, axis=0) 
+            Args:
+                clip (bool, optional): clip the gradients. With gradient accumulation, the accumulated gradients are clipped instead. Defaults to True.
 
-                # extracting the central region of interest
-            
-                preds   = cl.extract_central_region(preds, bounds)
-                probs   = cl.extract_central_region(probs, bounds)
-                mask    = cl.extract_central_region(mask, bounds)
-                target  = cl.extract_central_region(target, bounds)
-
-                # applying mask to predicted values
-                preds_masked    = tf.boolean_mask(preds, mask )
-                probs_masked    = tf.boolean_mask(probs, mask ) 
-                target_masked   = tf.boolean_mask(target, mask )
-                
-                # Reverising standardization of predictions 
-                preds_masked    = utility.standardize_ati( preds_masked, self.t_params['normalization_shift']['rain'], 
-                                                        self.t_params['normalization_scales']['rain'], reverse=True) 
-                                                        
-                # Getting true labels and predicted labels for whether or not it rained [ 1 if if did rain, 0 if it did not rain]
-                labels_true = tf.where( target_masked > 0.0, 1.0, 0.0 )
-                labels_pred = probs_masked 
-
-                all_count = tf.size( labels_true, out_type=tf.int64 )                
-                
-                # region Calculating Losses and Metrics
-                metric_mse  = cl.mse( target_masked, cl.cond_rain(preds_masked, probs_masked, threshold=0.5) )   
-                    # To calculate metric_mse for CC model we assume that pred_rain=0 if pred_prob<=0.5 
-
-                # CC Normal loss
-                loss_to_optimize = 0
-                loss_to_optimize += cl.mse( target_masked, preds_masked, all_count )    
-                loss_to_optimize += tf.reduce_mean( tf.keras.backend.binary_crossentropy(labels_true, labels_pred, from_logits=False) )         
-                # endregion
+            Returns:
+                tuple: loss to optimize, mse, gradients
+        """
+        with tf.GradientTape(persistent=False) as tape:
+            loss_to_optimize, metric_mse = self.masked_losses( feature, target, mask, bounds, self.t_params['trainable'] )
 
             loss_to_optimize_agg = tf.grad_pass_through( lambda x:  x/self.strategy_gpu_count )(loss_to_optimize)
-            scaled_loss = self.optimizer.get_scaled_loss( loss_to_optimize_agg )
-            scaled_gradients = tape.gradient( scaled_loss, self.model.trainable_variables )
-            unscaled_gradients = self.optimizer.get_unscaled_gradients(scaled_gradients)
-             
-            gradients, _ = tf.clip_by_global_norm( unscaled_gradients, clip_norm=self.m_params['clip_norm'] ) #gradient clipping
-            self.optimizer.apply_gradients( zip(gradients, self.model.trainable_variables))
+            scaled_loss = self.optimizer.get_scaled_loss( loss_to_optimize_agg ) if self.loss_scaling else loss_to_optimize_agg
         
-        # Metrics (batchwise, epoch)  
-        self.loss_agg_batch( loss_to_optimize )
-        self.loss_agg_epoch( loss_to_optimize )
-        self.mse_agg_epoch( metric_mse )    
+        scaled_gradients = tape.gradient( scaled_loss, self.model.trainable_variables )
+        unscaled_gradients = self.optimizer.get_unscaled_gradients(scaled_gradients) if self.loss_scaling else scaled_gradients
+        if not clip:
+            return loss_to_optimize, metric_mse, unscaled_gradients
         
-        val = cl.rNmse(target_masked, preds_masked, 10.0)
+        gradients, _ = tf.clip_by_global_norm( unscaled_gradients, clip_norm=self.m_params['clip_norm'] ) #gradient clipping
 
-        
+        return loss_to_optimize, metric_mse, gradients
 
-        return gradients
-                
-    def val_step(self, feature, target, mask, bounds):
-                    
-        # Non CC distribution
-        if self.m_params['model_type_settings']['discrete_continuous'] == False:
-            
-            # Get predictions
-            preds = self.model(feature, False )
-            preds = tf.squeeze(preds)
-
-            # Extracting central region for evaluation
-            preds   = cl.extract_central_region(preds, bounds)
-            mask    = cl.extract_central_region(mask, bounds)
-            target  = cl.extract_central_region(target, bounds)
-            
-            # Applying masks to predictions
-            preds_masked = tf.boolean_mask( preds, mask )
-            target_masked = tf.boolean_mask( target, mask )
-            preds_masked = utility.standardize_ati( preds_masked, self.t_params['normalization_shift']['rain'], 
-                                                    self.t_params['normalization_scales']['rain'], reverse=True)
-            # Updating losses
-            mse = cl.mse( target_masked , preds_masked ) 
-            loss = mse                
-
-        # CC distribution
-        elif self.m_params['model_type_settings']['discrete_continuous'] == True:
-            
-            # Get predictions
-            preds = self.model(feature, training=False )
-            preds = tf.squeeze(preds,axis=[-1])
+    def apply_accumulated_step(self, count):
+        """Applies the optimizer to the clipped mean of the accumulated gradients, then resets the accumulators.
+            With loss scaling, the update is skipped if any accumulated batch overflowed, since the sums are then not finite
+
+            Args:
+                count (tf.Tensor): number of accumulated batches
+        """
+        gradients = [ tf.convert_to_tensor(accum_gradient) / tf.cast(count, accum_gradient.dtype) for accum_gradient in self.accum_gradients ]
+        gradients, _ = tf.clip_by_global_norm( gradients, clip_norm=self.m_params['clip_norm'] ) #gradient clipping
+
+        self.optimizer.apply_gradients( zip(gradients, self.model.trainable_variables) )
+
+        for accum_gradient in self.accum_gradients:
+            accum_gradient.assign( tf.zeros_like(accum_gradient) )
+
+    def apply_accumulated_gradients(self, batch, end_batch):
+        """With gradient accumulation, makes the optimizer update on every grad_accum-th batch and on the last batch.
+            Blocks of steps end on these batches, see train_model
+
+            Args:
+                batch (int): last completed batch
+                end_batch (int): last batch of the epoch
+        """
+        if self.grad_accum > 1 and ( batch % self.grad_accum == 0 or batch == end_batch ):
+            self.distributed_apply_accumulated( tf.constant( batch - self.accum_start_batch ) )
+            self.accum_start_batch = batch
+
+    def masked_losses(self, feature, target, mask, bounds, training):
+        """Calculates the loss and mse of a batch. Masked out points are given zero weight instead of being removed
+            with tf.boolean_mask, so that all tensor shapes are static
+
+            For the conditional continuous (CC) model, the loss is the mse of the conditional rain value plus the 
+                cross entropy of the rain / no rain prediction. The mse metric assumes no rain where the predicted probability is below 0.5
+
+            Returns:
+                tuple: loss, mse
+        """
+        preds = self.model( feature, training )
+        preds = tf.squeeze( preds, axis=[-1] )
+
+        if self.m_params['model_type_settings']['discrete_continuous'] == True:
             preds, probs = tf.unstack(preds, axis=0)
+            probs = cl.extract_central_region(probs, bounds)
 
-            # Extracting central region for evaluation
-        
-            preds   = cl.extract_central_region(preds, bounds)
-            probs   = cl.extract_central_region(probs, bounds)
-            mask    = cl.extract_central_region(mask,  bounds)
-            target  = cl.extract_central_region(target,bounds)
-
-            # Applying masks to predictions
-            preds_masked    = tf.boolean_mask( preds, mask )
-            probs_masked    = tf.boolean_mask( probs, mask)
-            target_masked   = tf.boolean_mask( target, mask )
-            preds_masked    = utility.standardize_ati( preds_masked, self.t_params['normalization_shift']['rain'], 
-                                                    self.t_params['normalization_scales']['rain'], reverse=True)
-
-            # Getting classification labels for whether or not it rained
-            
-            labels_true = tf.where( target_masked > 0.0, 1.0, 0.0 )
-            labels_pred = probs_masked 
+        preds   = cl.extract_central_region(preds, bounds)
+        mask    = cl.extract_central_region(mask, bounds)
+        target  = cl.extract_central_region(target, bounds)
 
-            all_count = tf.size( labels_true, out_type=tf.int64 )
+        # reversing standardization
+        preds = utility.standardize_ati( preds, self.t_params['normalization_shift']['rain'], self.t_params['normalization_scales']['rain'], reverse=True)
 
-            # calculating seperate mse for reporting
-                # This mse metric assumes that if probability of rain is predicted below 0.5, the rain value is 0
-            mse = cl.mse( target_masked, cl.cond_rain( preds_masked, probs_masked, threshold=0.5) )
+        if self.m_params['model_type_settings']['discrete_continuous'] == False:
+            metric_mse = cl.masked_mse( target, preds, mask )
+            loss = metric_mse
+        
+        else:
+            metric_mse = cl.masked_cond_rain_mse( target, preds, probs, mask, threshold=0.5 )
+            loss = cl.masked_mse( target, preds, mask ) + cl.masked_bce( tf.where( target > 0.0, 1.0, 0.0 ), probs, mask )
 
-            # Calculating cross entropy loss                         
-            loss = tf.reduce_mean(  tf.keras.backend.binary_crossentropy( labels_true, labels_pred, from_logits=False) )
+        return loss, metric_mse
+                
+    def val_step(self, feature, target, mask, bounds):
 
-            # Calculating conditinal continuous loss
-            loss    += cl.mse( target_masked, preds_masked, all_count )
+        if self.t_params.get('xla', False):
+            loss, mse = self.xla_val_losses( feature, target, mask )
+        else:
+            loss, mse = self.masked_losses( feature, target, mask, bounds, False )
 
         self.loss_agg_val(loss)
         self.mse_agg_val(mse)
                     
         return True
     
+    def distributed_train_step(self, feature, target, mask, bounds, _init, stats=False):
+        return self.step_function( "distributed_train_step", self.run_train_step, self.train_mask_dtype(), bounds, _init, stats )( feature, target, mask )
+
+    def run_train_step(self, feature, target, mask, bounds, _init, stats):
+        return self.strategy.run( self.train_step, args=(feature, target, mask, bounds, _init, stats) )
+    
+    @tf.function(input_signature=[ tf.TensorSpec([], tf.int32) ])
+    @tracing.counted("distributed_apply_accumulated")
+    def distributed_apply_accumulated(self, count):
+        self.strategy.run( self.apply_accumulated_step, args=(count,) )
+    
+    def distributed_val_step(self, feature, target, mask, bounds):
+        return self.step_function( "distributed_val_step", self.run_val_step, tf.bool, bounds )( feature, target, mask )
+
+    def run_val_step(self, feature, target, mask, bounds):
+        return self.strategy.run( self.val_step, args=(feature, target, mask, bounds) )
+
     @tf.function
-    def distributed_train_step(self, feature, target, mask, bounds, _init):
-        gradients = self.strategy.run( self.train_step, args=(feature, target, mask, bounds, _init) )
-        return gradients
+    @tracing.counted("distributed_train_steps")
+    def distributed_train_steps(self, iterator, bounds, steps):
+        """Runs steps training steps, drawn from the distributed iterator, in one call"""
+        for _ in tf.range(steps):
+            feature, target, mask = next(iterator)
+            self.strategy.run( self.train_step, args=(feature, target, mask, bounds, 0.0) )
     
     @tf.function
-    def distributed_val_step(self, feature, target, mask, bounds):
-        bool_completed = self.strategy.run( self.val_step, args=(feature, target, mask, bounds))
-        return bool_completed
+    @tracing.counted("distributed_val_steps")
+    def distributed_val_steps(self, iterator, bounds, steps):
+        """Runs steps validation steps, drawn from the distributed iterator, in one call"""
+        for _ in tf.range(steps):
+            feature, target, mask = next(iterator)
+            self.strategy.run( self.val_step, args=(feature, target, mask, bounds) )
+
+
+def benchmark_sweep(t_params, train_args):
+    """Runs benchmarks.benchmark_step once for each batch size and thread count in t_params, each in a separate process,
+        so that thread pools are sized before TensorFlow starts and the peak memory of one run does not hide another's
+
+        Args:
+            t_params (dict): params for training
+            train_args (list): training arguments
+
+        Returns:
+            list: one result record per run
+    """
+    li_results = []
+    for batch_size in t_params['benchmark_batch_sizes']:
+        for threads in t_params['benchmark_threads']:
+            env = dict(os.environ)
+            if threads > 0:
+                env['OMP_NUM_THREADS'] = str(threads)
+            
+            cmd = [ sys.executable, os.path.realpath(__file__) ] + train_args + [ '--benchmark_batch_sizes', "[]", '--benchmark_threads', "[]", 
+                                                                                    '--batch_size', str(batch_size), '--intra_op_threads', str(threads) ]
+            result, returncode = utility.run_for_result( cmd, env )
+            if result == None:
+                print("Benchmark with batch size {} and {} threads failed with exit code {}".format(batch_size, threads, returncode))
+                continue
+
+            li_results += result
+            print("Batch size {}, {} threads: {:.1f} examples/s".format( batch_size, threads, li_results[-1]['Examples_per_s'] ))
+    
+    return li_results
+
+def save_benchmark_report(li_results, t_params, m_params, fn_suffix=""):
+    """Saves benchmark results, with a description of the host, to json and csv in './Output/benchmarks'"""
+    f_dir = os.path.join( t_params['output_dir'], "benchmarks" )
+    os.makedirs( f_dir, exist_ok=True )
+    fp_report = os.path.join( f_dir, "train_{}{}_{}".format( m_params['model_name'], fn_suffix, socket.gethostname() ) )
 
+    report = { 'host':socket.gethostname(), 'cpu_count':os.cpu_count(), 'tensorflow':tf.__version__, 
+                'args':sys.argv[1:], 'time':time.strftime("%Y-%m-%dT%H:%M:%S"), 'results':li_results }
+    with open( fp_report+".json", "w" ) as f_report:
+        json.dump( report, f_report, indent=2 )
+    pd.DataFrame(li_results).to_csv( fp_report+".csv", index=False )
+
+    print(pd.DataFrame(li_results).to_string(index=False))
+    print("Report saved to {}.json".format(fp_report))
 
 if __name__ == "__main__":
     s_dir = utility.get_script_directory(sys.argv[0])
     args_dict = utility.parse_arguments(s_dir)
 
+    # replacing the batch size with the largest that fits the memory budget
+    if args_dict.get('auto_batch_size', 0) > 0:
+        args_dict['batch_size'] = model_profiler.auto_batch_size( sys.argv[1:], args_dict['auto_batch_size'] )
+        print("Batch size set to {} for a memory budget of {:.0f} MB".format( args_dict['batch_size'], args_dict['auto_batch_size'] ))
+
     # get training and model params
     t_params, m_params = utility.load_params(args_dict)
     
+    # Throughput on synthetic data, for one setting in this process or for a sweep of settings in subprocesses
+    if t_params.get('benchmark', False):
+        if len(t_params['benchmark_batch_sizes']) == 0 and len(t_params['benchmark_threads']) == 0:
+            li_records = json.loads( benchmarks.benchmark_step( t_params, m_params, t_params['benchmark_batches'] ).to_json(orient='records') )
+            utility.print_subprocess_result( li_records )
+            save_benchmark_report( li_records, t_params, m_params, "_bs{}_iot{}".format( li_records[0]['Batch_Size'], li_records[0]['Intra_Op_Threads'] ) )
+        else:
+            t_params['benchmark_batch_sizes'] = t_params['benchmark_batch_sizes'] or [ t_params['batch_size'] ]
+            t_params['benchmark_threads'] = t_params['benchmark_threads'] or [ t_params.get('intra_op_threads', 0) ]
+            save_benchmark_report( benchmark_sweep(t_params, sys.argv[1:]), t_params, m_params )
+        sys.exit(0)
+
     # Initialize and  train model
     weather_model = WeatherModel(t_params, m_params)
     weather_model.initialize_scheme_era5Eobs()
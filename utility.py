@@ -11,10 +11,11 @@ import copy
 import datetime
 import re
 import pickle
+import subprocess
 
 # region - Reporting
 def update_checkpoints_epoch(df_training_info, epoch, train_loss_epoch, val_loss_epoch, ckpt_manager_epoch, t_params, m_params, train_metric_mse=None,
-                                val_metric_mse=None,  objective="mse"  ):
+                                val_metric_mse=None,  objective="mse", reporter=None  ):
     """Updates the checkpoint and epoch records associated with an instance of training
 
         Args:
@@ -22,11 +23,13 @@ def update_checkpoints_epoch(df_training_info, epoch, train_loss_epoch, val_loss
             epoch (int): current epoch
             train_loss_epoch (tf.keras.loss.Mean): aggregated loss from training batches within epoch
             val_loss_epoch (tf.keras.metric.Mean): aggregated loss from validation batches within epoch
-            ckpt_manager_epoch (tf.train.CheckpointManager): ckpt manager for epoch 
+            ckpt_manager_epoch (checkpointing.AsyncCheckpointer): ckpt manager for epoch, saves are written in the background.
+                The scores are saved once the checkpoint is written, so they never refer to a checkpoint that does not exist
             t_params (dict): params related to training/testing
             m_params (dict): params related to model
             train_metric_mse (tf.keras.metric.Mean): aggregated mse from train batches within epoch
             val_metric_mse (tf.keras.metric.Mean): aggregated mse from validation batches within epoch
+            reporter (reporting.AsyncReporter, optional): if passed, the scores are saved from the reporter's writer thread. Defaults to None.
 
         Returns:
             dictionary: Updated df_training_info
@@ -67,8 +70,12 @@ def update_checkpoints_epoch(df_training_info, epoch, train_loss_epoch, val_loss
 
         print(df_training_info[['Epoch','Train_loss','Train_mse','Val_loss','Val_mse']] )
 
-        df_training_info.to_csv( path_or_buf="checkpoints/{}/checkpoint_scores.csv".format(model_name_mkr(m_params, t_params=t_params,  htuning=m_params.get('htuning',False)),
-                                    header=True, index=False) ) #saving df of scores                      
+        fp_scores = "checkpoints/{}/checkpoint_scores.csv".format(model_name_mkr(m_params, t_params=t_params,  htuning=m_params.get('htuning',False)))
+        df_scores = df_training_info.copy()
+        if reporter != None:
+            ckpt_manager_epoch.after_written( lambda: reporter.write_csv( df_scores, fp_scores ) )
+        else:
+            ckpt_manager_epoch.after_written( lambda: df_scores.to_csv( path_or_buf=fp_scores, header=True, index=False ) ) #saving df of scores
     
     return df_training_info
 
@@ -95,6 +102,32 @@ def tensorboard_record(writer, li_metrics, li_names, step, gradients=None, train
                     tf.summary.histogram( "Weights:{}".format(_tensor.name), _tensor , step = step ) 
 # endregion
 
+# region - Subprocess results
+# stdout prefix of the json result printed by a script run with run_for_result
+SUBPROCESS_RESULT_PREFIX = "SUBPROCESS_RESULT "
+
+def print_subprocess_result(result):
+    """Prints a json serializable result to stdout, for run_for_result in the parent process"""
+    print( SUBPROCESS_RESULT_PREFIX + json.dumps(result), flush=True )
+
+def run_for_result(cmd, env=None):
+    """Runs a script in a subprocess, and returns the last result it printed with print_subprocess_result
+
+        Args:
+            cmd (list): command, e.g. [ sys.executable, script ] + arguments
+            env (dict, optional): environment of the subprocess. Defaults to None, this process's environment.
+
+        Returns:
+            tuple: the result, or None if the subprocess failed or printed no result, and the subprocess's exit code
+    """
+    proc = subprocess.run( cmd, env=env, stdout=subprocess.PIPE, universal_newlines=True )
+
+    li_results = [ line[len(SUBPROCESS_RESULT_PREFIX):] for line in proc.stdout.splitlines() if line.startswith(SUBPROCESS_RESULT_PREFIX) ]
+    if proc.returncode != 0 or len(li_results) == 0:
+        return None, proc.returncode
+    return json.loads(li_results[-1]), proc.returncode
+# endregion
+
 # region - Loading params
 def get_script_directory(_path):
     if(_path==None):
@@ -117,6 +150,11 @@ def load_params(args_dict, train_test="train"):
     init_m_params.update( {'model_type_settings': ast.literal_eval( args_dict.pop('model_type_settings') ) } )
     init_t_params.update( {'t_settings': ast.literal_eval( args_dict.pop('t_settings') ) } )
 
+    # date-set specification for training data selection
+    for key in ['train_dates','val_dates','months','continual']:
+        if init_m_params['model_type_settings'].get(key, None) != None:
+            init_t_params.update( { key: init_m_params['model_type_settings'][key] } )
+
     if(args_dict['model_name'] == "TRUNET"):
         m_params = hparameters.model_TRUNET_hparameters( **init_m_params, **args_dict )()
         init_t_params.update( { 'lookback_target': m_params['data_pipeline_params']['lookback_target'] } )
@@ -172,6 +210,73 @@ def parse_arguments(s_dir=None):
     parser.add_argument('-pc','--parallel_calls', type=int, required=False, default=-1)
 
     parser.add_argument('-ep','--epochs', default=100, type=int, required=False)
+
+    parser.add_argument('-cc','--cache_compression', type=str, required=False, default="none", choices=["none","zlib","snappy"],
+                        help="compression of the on-disk dataset cache. Use benchmarks.py cache to compare size against read speed on a host")
+
+    parser.add_argument('-cmb','--cache_memory_mb', type=int, required=False, default=0, help="memory budget in MB for holding cached batches in RAM, the remainder is cached on disk")
+
+    parser.add_argument('-cbf','--ckpt_batch_freq', type=int, required=False, default=0, help="training batches between mid-epoch checkpoints used to resume preempted jobs, 0 for none")
+
+    parser.add_argument('-hf','--histogram_freq', type=int, required=False, default=0, help="epochs between TensorBoard histograms of the model weights, 0 for none")
+
+    parser.add_argument('-strat','--strategy', type=str, required=False, default="mirrored", choices=["mirrored","multi_worker"],
+                        help="distribution strategy. multi_worker reads the cluster from TF_CONFIG, use launch_workers.py to start the workers")
+
+    parser.add_argument('-iot','--intra_op_threads', type=int, required=False, default=0, help="threads per op, 0 for the TensorFlow default")
+
+    parser.add_argument('-eot','--inter_op_threads', type=int, required=False, default=0, help="threads for running independent ops, 0 for the TensorFlow default")
+
+    parser.add_argument('-spe','--steps_per_execution', type=int, required=False, default=1, help="number of training/validation steps to run inside a single tf.function call")
+
+    parser.add_argument('-xla','--xla', type=eval, required=False, default=False, choices=[True,False], help="XLA compile the training and validation steps, with static batch shapes")
+
+    parser.add_argument('-prec','--precision', type=str, required=False, default="mixed_float16", choices=PRECISIONS, 
+                        help="float policy. mixed policies keep float32 variables, loss scaling is only used for mixed_float16")
+
+    parser.add_argument('-isw','--importance_sampling_weights', type=ast.literal_eval, required=False, default={}, 
+                        help="relative sampling rates of training windows by intensity class, e.g. \"{'heavy':4.0, 'wet':1.0, 'dry':0.25}\". Empty for uniform sampling")
+
+    parser.add_argument('-ve','--val_every', type=int, required=False, default=0, help="training batches between validations on a fixed validation subset, 0 to validate on the full set each epoch")
+
+    parser.add_argument('-vsb','--val_subset_batches', type=int, required=False, default=0, help="batches in the validation subset, 0 for 10%% of the validation batches")
+
+    parser.add_argument('-bm','--benchmark', type=eval, required=False, default=False, choices=[True,False], 
+                        help="measure training throughput on synthetic in-memory data instead of training, see benchmarks.benchmark_step")
+
+    parser.add_argument('-bmbs','--benchmark_batch_sizes', type=ast.literal_eval, required=False, default=[], help="with benchmark, batch sizes to sweep, e.g. \"[8,16,32]\"")
+
+    parser.add_argument('-bmt','--benchmark_threads', type=ast.literal_eval, required=False, default=[], help="with benchmark, intra-op thread counts to sweep, e.g. \"[8,16]\"")
+
+    parser.add_argument('-bmb','--benchmark_batches', type=int, required=False, default=50, help="with benchmark, number of timed batches")
+
+    parser.add_argument('-abs','--auto_batch_size', type=float, required=False, default=0,
+                        help="memory budget in MB per device. If set, bs is replaced by the largest batch size estimated to fit, see model_profiler.py")
+
+    parser.add_argument('-rc','--recompute', type=str, required=False, default="none", choices=['none','layer','step'],
+                        help="gradient checkpointing of the ConvGRUs: recompute each layer's, or each timestep's, activations in the backward pass")
+
+    parser.add_argument('-se','--sidecar_eval', type=eval, required=False, default=False, choices=[True,False],
+                        help="save each epoch as a candidate checkpoint and leave validation, checkpoint selection and early stopping to evaluator.py")
+
+    parser.add_argument('-if','--init_from', type=str, required=False, default="", 
+                        help="checkpoint, or checkpoint directory, of another run to initialize the model's weights from when this run has no checkpoint")
+
+    parser.add_argument('-frz','--freeze', type=str, required=False, default="none", choices=['none','encoder','heads'],
+                        help="layers to freeze when fine-tuning: the encoder, or all but the output heads")
+
+    parser.add_argument('-ga','--grad_accum', type=int, required=False, default=1, help="number of batches whose gradients are accumulated for each optimizer update")
+
+    parser.add_argument('-sf','--stats_freq', type=int, required=False, default=0, 
+                        help="training batches between samples of per variable weight and gradient statistics, 0 for none. See reporting.variable_stats")
+
+    parser.add_argument('-wst','--window_store', type=str, required=False, default="", 
+                        help="window store written by kfold.py, from which this run's training and validation windows are read")
+
+    parser.add_argument('-pwt','--prewarm_traces', type=eval, required=False, default=False, choices=[True,False],
+                        help="trace the training and validation steps for their input signatures before the first batch")
+
+    parser.add_argument('-fvf','--full_val_freq', type=int, required=False, default=1, help="with val_every, epochs between validations on the full validation set")
        
     args_dict = vars(parser.parse_args() )
 
@@ -274,6 +379,12 @@ def model_name_mkr(m_params, train_test="train", t_params={}, custom_test_loc=No
 
     if m_params['model_type_settings'].get('heads',8) != 8:
         model_name = model_name + "_heads_{}".format( str(m_params['model_type_settings']['heads']) )
+
+    model_name = model_name + date_set_suffix_mkr(m_params['model_type_settings']) + stateful_suffix_mkr(m_params['model_type_settings'])
+
+    # non-chief workers of multi-worker training keep their records apart from the chief's
+    if t_params.get('worker_idx', 0) > 0:
+        model_name = model_name + "_worker{}".format(t_params['worker_idx'])
     
     if htuning==True:
         model_name = model_name + f"_htune_v{m_params['htune_version']:03d}"
@@ -303,9 +414,112 @@ def cache_suffix_mkr(m_params, t_params):
         cache_suffix = '_{}_bs_{}_{}_{}'.format(m_params['model_name'], t_params['batch_size'],
                             loc_name_shrtner(m_params['model_type_settings']['location']),
                             m_params['ctsm']  )    
+    
+    # stateful training changes the window order, and chunk_weeks the window length
+    cache_suffix = cache_suffix + date_set_suffix_mkr(m_params['model_type_settings']) + stateful_suffix_mkr(m_params['model_type_settings'])
+
+    # each worker of multi-worker training caches its own data shard
+    if t_params.get('worker_count', 1) > 1:
+        cache_suffix = cache_suffix + "_wkr{}of{}".format(t_params['worker_idx'], t_params['worker_count'])
         
     return cache_suffix
 
+def stateful_suffix_mkr(model_type_settings):
+    """Creates a suffix identifying stateful training and a custom window length
+
+        Args:
+            model_type_settings (dict): may contain stateful and chunk_weeks
+
+        Returns:
+            str: suffix, empty for the default stateless training on 4 week windows
+    """
+    suffix = ""
+    if model_type_settings.get('chunk_weeks', 4) != 4:
+        suffix = suffix + "_chunk{}w".format(model_type_settings['chunk_weeks'])
+
+    if model_type_settings.get('stateful', False):
+        suffix = suffix + "_stateful"
+
+    return suffix
+
+def date_set_suffix_mkr(model_type_settings):
+    """Creates a suffix identifying a custom date-set specification
+
+        Args:
+            model_type_settings (dict): may contain train_dates, val_dates, months and continual
+
+        Returns:
+            str: suffix, empty if no date-set specification is used
+    """    
+    suffix = ""
+    
+    for key, code in [ ('train_dates','tr'), ('val_dates','vl') ]:
+        if model_type_settings.get(key, None) != None:
+            # full dates, so that date sets differing only within a year do not share checkpoints or caches. '1979' and '1979-01-01' are the same date
+            suffix = suffix + "_{}{}".format( code, "_".join( [ "{}-{}".format( _compact_date(start), _compact_date(end) ) for start, end in model_type_settings[key] ] ) )
+
+    if model_type_settings.get('months', None) != None:
+        suffix = suffix + "_mths{}".format( "-".join( [ str(mth) for mth in model_type_settings['months'] ] ) )
+
+    if model_type_settings.get('continual', None) != None:
+        continual = model_type_settings['continual']
+        suffix = suffix + "_ct{}".format( _compact_date(continual['new_start']) )
+        if continual.get('replay_windows', None) != None:
+            suffix = suffix + "_rp{}".format( continual['replay_windows'] )
+
+    return suffix
+
+def _compact_date(date):
+    """Returns a date string normalised to its day, as YYYYMMDD"""
+    return str( np.datetime64(date, 'D') ).replace("-", "")
+
+def worker_info():
+    """Returns the index of this worker and the number of workers, from the cluster spec in the TF_CONFIG environment variable
+
+        Returns:
+            tuple: (worker_idx, worker_count), (0, 1) if TF_CONFIG is not set
+    """
+    tf_config = json.loads( os.environ.get('TF_CONFIG', '{}') )
+    worker_count = len( tf_config.get('cluster', {}).get('worker', [None]) )
+    worker_idx = tf_config.get('task', {}).get('index', 0)
+    
+    return worker_idx, worker_count
+
+PRECISIONS = ['float32', 'bfloat16', 'mixed_bfloat16', 'mixed_float16']
+
+_dtype_is_compatible_with = tf.DType.is_compatible_with
+
+def set_precision(precision):
+    """Sets the keras float type and the mixed precision policy. Must be called before any model is created
+
+        Args:
+            precision (str): one of PRECISIONS. The mixed policies keep variables in float32 and compute in 16 bit floats
+
+        Returns:
+            bool: True if the loss must be scaled during training, which is only the case for mixed_float16
+    """
+    from tensorflow.keras.mixed_precision import experimental as mixed_precision
+
+    compute_dtype = precision.replace("mixed_", "")
+    tf.keras.backend.set_floatx( compute_dtype )
+    mixed_precision.set_policy( mixed_precision.Policy(precision) )
+
+    # Monkey patch: incompatibility issues between tfa.optimizers and 16 bit floatx, only applied for 16 bit compute
+    tf.DType.is_compatible_with = _dtype_is_compatible_with if compute_dtype == 'float32' else _half_is_compatible_with
+
+    return precision == 'mixed_float16'
+
+def _half_is_compatible_with(self, other):
+    """Returns True if the `other` DType will be converted to this DType.
+        As DType.is_compatible_with, except that float16 and bfloat16 are also treated as compatible with float32
+    """
+    other = tf.dtypes.as_dtype(other)
+    if self._type_enum in (tf.float16.as_datatype_enum, tf.bfloat16.as_datatype_enum) and other.as_datatype_enum==tf.float32.as_datatype_enum:
+        return True
+
+    return self._type_enum in (other.as_datatype_enum,
+                                other.base_dtype.as_datatype_enum)
+
 def location_getter(model_settings):
 
     if model_settings.get('location_test', None) == None:
@@ -24,19 +24,19 @@ def load_model(t_params, m_params):
     if(model_name=="TRUNET"):
         model = models.TRUNET(t_params, m_params)
         inp_shape = [t_params['batch_size'], t_params['lookback_feature']] + m_params['region_grid_params']['outer_box_dims'] + [len(t_params['vars_for_feature'])]
-        init_inp = tf.zeros(inp_shape, dtype=tf.float16 )
+        init_inp = tf.zeros(inp_shape, dtype=tf.keras.backend.floatx() )
         model(init_inp, training=False )
     
     elif(model_name=="HCGRU"):
         model = models.HCGRU(t_params,m_params)
         inp_shape = [t_params['batch_size'], t_params['lookback_feature']] + m_params['region_grid_params']['outer_box_dims'] + [len(t_params['vars_for_feature'])]
-        init_inp = tf.zeros(inp_shape, dtype=tf.float16 )
+        init_inp = tf.zeros(inp_shape, dtype=tf.keras.backend.floatx() )
         model(init_inp, training=False )
 
     elif(model_name=="UNET"):
         model = models.UNET(t_params,m_params)
         inp_shape = [t_params['batch_size'] ] + m_params['region_grid_params']['outer_box_dims'] + [int(t_params['lookback_feature']*len(t_params['vars_for_feature']))]
-        init_inp = tf.zeros(inp_shape, dtype=tf.float16 )
+        init_inp = tf.zeros(inp_shape, dtype=tf.keras.backend.floatx() )
         model(init_inp, training=False )
 
     ckpt = tf.train.Checkpoint(model=model)
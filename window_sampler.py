@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import custom_losses as cl
+
+"""
+    Intensity-aware importance sampling of training windows. Heavy rain windows are rare, so they are drawn
+        more often than dry windows, and each window's loss is weighted by the inverse of its sampling rate so
+        that the losses remain estimates over the full training set. The weighted losses are divided by the number of
+        unmasked points rather than the sum of the weights, see custom_losses.masked_mse, so a batch of heavy windows
+        counts for less than a batch of dry windows, as it would in the full training set
+
+    Example of how to use
+        sampler = WindowSampler( {'heavy':4.0, 'wet':1.0, 'dry':0.25}, seed=0 )
+        sampler.load_or_compute_stats( ds_train, bounds, "Data/data_cache/window_stats_modelcode.npy" )
+        ds_epoch = sampler.resample( ds_train.unbatch(), epoch )
+
+        Fixed subset of 100 validation windows, stratified by location and intensity class
+        stats = load_or_compute_stats( ds_val, bounds, "Data/data_cache/window_stats_val_modelcode.npy" )
+        keep = stratified_subset( loc_idxs*len(INTENSITY_CLASSES) + class_idxs(stats), 100 )
+
+    Window statistics, computed over the unmasked points of the central region of each window's target rain
+        max         : maximum rain (mm)
+        mean        : mean rain (mm)
+        r10_frac    : fraction of points with at least 10mm of rain
+"""
+
+STAT_NAMES = ['max', 'mean', 'r10_frac']
+
+# A window's intensity class is the first class whose threshold its maximum rain reaches
+INTENSITY_CLASSES = { 'heavy':10.0, 'wet':1.0, 'dry':-np.inf }
+
+class WindowSampler():
+    """Samples training windows with replacement, with per window probabilities set by the window's intensity class
+    """
+
+    def __init__(self, class_weights, seed=0):
+        """
+            Args:
+                class_weights (dict): relative sampling rate for each intensity class in INTENSITY_CLASSES. Missing classes have weight 1.0
+                seed (int, optional): the samples of an epoch are drawn with seed+epoch. Defaults to 0.
+        """
+        unknown_classes = set(class_weights.keys()) - set(INTENSITY_CLASSES.keys())
+        if len(unknown_classes) > 0:
+            raise ValueError("Unknown intensity classes {}, expected a subset of {}".format(sorted(unknown_classes), list(INTENSITY_CLASSES.keys())))
+
+        self.class_weights = { cls:float(class_weights.get(cls, 1.0)) for cls in INTENSITY_CLASSES.keys() }
+        self.seed = seed
+        self.stats = None
+
+    def load_or_compute_stats(self, ds, bounds, fp_stats):
+        """Loads the window statistics index, or computes it with one pass over the dataset and saves it
+
+            Args:
+                ds (tf.data.Dataset): batched training dataset of (feature, target, mask), in a fixed order
+                bounds (list): bounds of the central region, see custom_losses.central_region_bounds
+                fp_stats (str): filepath of the index
+        """
+        self.stats = load_or_compute_stats(ds, bounds, fp_stats)
+
+        classes = window_classes(self.stats)
+        weights = np.array( [ self.class_weights[cls] for cls in classes ] )
+
+        self.probs = weights / weights.sum()
+        self.loss_weights = ( 1.0 / (len(self.probs)*self.probs) ).astype(np.float32)
+
+        print("Importance sampling windows: {}".format( ", ".join( [ "{} {}".format( np.sum(classes==cls), cls ) for cls in INTENSITY_CLASSES.keys() ] ) ))
+
+    def resample(self, ds, epoch):
+        """Draws an epoch of windows with replacement. Drawn windows are repeated in place, so the dataset should be shuffled afterwards.
+            Masks are returned as float32 loss weights: the window's importance weight at unmasked points, 0 elsewhere
+
+            Args:
+                ds (tf.data.Dataset): unbatched dataset of (feature, target, mask), in the order used for the statistics
+                epoch (int): epoch, the draws are reproduced for the same epoch
+
+            Returns:
+                tf.data.Dataset: dataset of (feature, target, weighted mask) with as many elements as ds
+        """
+        counts = np.random.RandomState( self.seed + epoch ).multinomial( len(self.probs), self.probs )
+        ds_draws = tf.data.Dataset.from_tensor_slices( (counts, self.loss_weights) )
+
+        return tf.data.Dataset.zip( (ds, ds_draws) ).flat_map(
+                    lambda window, draws: tf.data.Dataset.from_tensors( (window[0], window[1], tf.cast(window[2], tf.float32)*draws[1]) ).repeat(draws[0]) )
+
+def load_or_compute_stats(ds, bounds, fp_stats):
+    """Loads a window statistics index, or computes it with one pass over the dataset and saves it
+
+        Args:
+            ds (tf.data.Dataset): batched dataset of (feature, target, mask), in a fixed order
+            bounds (list): bounds of the central region, see custom_losses.central_region_bounds
+            fp_stats (str): filepath of the index
+
+        Returns:
+            np.ndarray: shape (window_count, len(STAT_NAMES))
+    """
+    if os.path.exists(fp_stats):
+        return np.load(fp_stats)
+
+    stats = window_stats(ds, bounds)
+    fp_tmp = fp_stats + ".{}.tmp.npy".format(os.getpid())
+    np.save(fp_tmp, stats)
+    os.replace(fp_tmp, fp_stats)
+    return stats
+
+def class_idxs(stats):
+    """Returns the index in INTENSITY_CLASSES of each window's intensity class"""
+    li_conds = [ stats[:, STAT_NAMES.index('max')] >= threshold for threshold in INTENSITY_CLASSES.values() ]
+    return np.select( li_conds, list(range(len(INTENSITY_CLASSES))), default=len(INTENSITY_CLASSES)-1 )
+
+def window_classes(stats):
+    """Returns the intensity class name of each window"""
+    return np.array( list(INTENSITY_CLASSES.keys()) )[ class_idxs(stats) ]
+
+def stratified_subset(strata, count):
+    """Selects a fixed subset of windows, allocated to each stratum in proportion to its size.
+        Windows are ordered by stratum then position, and selected at evenly spaced points in this order
+
+        Args:
+            strata (np.ndarray): stratum index of each window
+            count (int): number of windows to select
+
+        Returns:
+            np.ndarray: bool, True for the selected windows
+    """
+    count = min( count, len(strata) )
+    order = np.lexsort( ( np.arange(len(strata)), strata ) )
+    selected = order[ np.round( np.linspace(0, len(strata)-1, count) ).astype(int) ]
+
+    keep = np.zeros( len(strata), dtype=bool )
+    keep[selected] = True
+    return keep
+
+def window_stats(ds, bounds):
+    """Computes the rainfall statistics of each window, over the unmasked points of the central region
+
+        Args:
+            ds (tf.data.Dataset): batched dataset of (feature, target, mask)
+            bounds (list): bounds of the central region
+
+        Returns:
+            np.ndarray: shape (window_count, len(STAT_NAMES))
+    """
+    li_stats = []
+    for _, target, mask in ds:
+        target = cl.extract_central_region(target, bounds).numpy()
+        mask = cl.extract_central_region(mask, bounds).numpy()
+
+        target = np.where( mask, target, 0.0 ).reshape( target.shape[0], -1 )
+        mask = mask.reshape( mask.shape[0], -1 )
+        count = np.maximum( mask.sum(axis=1), 1 )
+
+        li_stats.append( np.stack( [ target.max(axis=1), target.sum(axis=1)/count, ( (target >= 10.0) & mask ).sum(axis=1)/count ], axis=1 ) )
+
+    return np.concatenate( li_stats, axis=0 ).astype(np.float32)